@@ -0,0 +1,60 @@
+"""Add match_jobs table
+
+Revision ID: ca0aeae27443
+Revises: 0e381789f24e
+Create Date: 2026-10-18 06:02:34.000000
+
+"""
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "ca0aeae27443"
+down_revision = "0e381789f24e"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "match_jobs",
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=True,
+        ),
+        sa.Column(
+            "updated_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=True,
+        ),
+        sa.Column("round_id", postgresql.UUID(), nullable=False),
+        sa.Column("run_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column(
+            "status",
+            sa.Enum("PENDING", "RUNNING", "DONE", "FAILED", name="match_job_statuses"),
+            server_default="PENDING",
+            nullable=False,
+        ),
+        sa.Column("stage", sa.String(), nullable=True),
+        sa.Column("error", sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(["round_id"], ["rounds.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("round_id"),
+    )
+    # Rounds that have not been matched yet are handed to the worker
+    op.execute(
+        "INSERT INTO match_jobs (id, round_id, run_at) "
+        "SELECT md5(random()::text || id::text)::uuid, id, end_time "
+        "FROM rounds WHERE NOT is_concluded"
+    )
+
+
+def downgrade():
+    op.drop_table("match_jobs")
+    postgresql.ENUM(name="match_job_statuses").drop(op.get_bind())
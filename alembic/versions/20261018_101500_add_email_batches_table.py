@@ -0,0 +1,54 @@
+"""Add email_batches table
+
+Revision ID: 5b1f0d7c9e24
+Revises: ca0aeae27443
+Create Date: 2026-10-18 10:15:00.000000
+
+"""
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5b1f0d7c9e24"
+down_revision = "ca0aeae27443"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "email_batches",
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=True,
+        ),
+        sa.Column(
+            "updated_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=True,
+        ),
+        sa.Column("round_id", postgresql.UUID(), nullable=False),
+        sa.Column("template", sa.String(), nullable=False),
+        sa.Column("recipients", postgresql.ARRAY(sa.String()), nullable=False),
+        sa.Column(
+            "status",
+            sa.Enum("PENDING", "SENT", "FAILED", name="email_batch_statuses"),
+            server_default="PENDING",
+            nullable=False,
+        ),
+        sa.Column("attempts", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("error", sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(["round_id"], ["rounds.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade():
+    op.drop_table("email_batches")
+    postgresql.ENUM(name="email_batch_statuses").drop(op.get_bind())
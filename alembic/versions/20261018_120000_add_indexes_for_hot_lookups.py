@@ -0,0 +1,71 @@
+"""Add indexes for hot lookups
+
+Revision ID: 9d3c47a1e2b8
+Revises: 5b1f0d7c9e24
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9d3c47a1e2b8"
+down_revision = "5b1f0d7c9e24"
+branch_labels = None
+depends_on = None
+
+# name, table, columns, partial index condition
+INDEXES = [
+    ("ix_users_auth_token", "users", ["auth_token"], None),
+    ("ix_sell_orders_round_id", "sell_orders", ["round_id"], None),
+    ("ix_sell_orders_user_id_round_id", "sell_orders", ["user_id", "round_id"], None),
+    (
+        "ix_sell_orders_unassigned_user_id",
+        "sell_orders",
+        ["user_id"],
+        "round_id IS NULL",
+    ),
+    ("ix_buy_orders_round_id", "buy_orders", ["round_id"], None),
+    ("ix_buy_orders_user_id_round_id", "buy_orders", ["user_id", "round_id"], None),
+    ("ix_buy_orders_unassigned_user_id", "buy_orders", ["user_id"], "round_id IS NULL"),
+    ("ix_rounds_active_end_time", "rounds", ["end_time"], "NOT is_concluded"),
+    (
+        "ix_user_chat_room_association_chat_room_id",
+        "user_chat_room_association",
+        ["chat_room_id"],
+        None,
+    ),
+    ("ix_chats_chat_room_id_created_at", "chats", ["chat_room_id", "created_at"], None),
+    (
+        "ix_offers_chat_room_id_offer_status",
+        "offers",
+        ["chat_room_id", "offer_status"],
+        None,
+    ),
+    (
+        "ix_user_requests_open_user_id",
+        "user_requests",
+        ["user_id"],
+        "closed_by_user_id IS NULL",
+    ),
+]
+
+
+def upgrade():
+    # Built concurrently, outside of a transaction, so that writes are not blocked
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                postgresql_where=where and sa.text(where),
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,33 @@
+"""Add indexes for chat history
+
+Revision ID: 3e8b2f6a4c71
+Revises: 9d3c47a1e2b8
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3e8b2f6a4c71"
+down_revision = "9d3c47a1e2b8"
+branch_labels = None
+depends_on = None
+
+# name, table, columns
+INDEXES = [
+    ("ix_offers_chat_room_id_created_at", "offers", ["chat_room_id", "created_at"]),
+    ("ix_offer_responses_offer_id", "offer_responses", ["offer_id"]),
+]
+
+
+def upgrade():
+    # Built concurrently, outside of a transaction, so that writes are not blocked
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,43 @@
+"""Add unread_count to user_chat_room_association
+
+Revision ID: 7a5d9c0e3f12
+Revises: 3e8b2f6a4c71
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7a5d9c0e3f12"
+down_revision = "3e8b2f6a4c71"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "user_chat_room_association",
+        sa.Column("unread_count", sa.Integer(), server_default="0", nullable=False),
+    )
+    # Chats of the other party after the last read chat, or all of them
+    op.execute(
+        """
+        UPDATE user_chat_room_association AS a
+        SET unread_count = (
+            SELECT count(*)
+            FROM chats AS c
+            WHERE c.chat_room_id = a.chat_room_id
+            AND c.author_id != a.user_id
+            AND c.created_at > coalesce(
+                (SELECT created_at FROM chats WHERE id = a.last_read_id),
+                '-infinity'
+            )
+        )
+        """
+    )
+
+
+def downgrade():
+    op.drop_column("user_chat_room_association", "unread_count")
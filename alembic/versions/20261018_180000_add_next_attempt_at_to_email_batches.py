@@ -0,0 +1,32 @@
+"""Add next_attempt_at to email_batches
+
+Revision ID: b41e6d2a8f05
+Revises: 7a5d9c0e3f12
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b41e6d2a8f05"
+down_revision = "7a5d9c0e3f12"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "email_batches",
+        sa.Column(
+            "next_attempt_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+    )
+
+
+def downgrade():
+    op.drop_column("email_batches", "next_attempt_at")
@@ -0,0 +1,29 @@
+"""Add attempts and heartbeat_at to match_jobs
+
+Revision ID: c58f1e3a9d27
+Revises: b41e6d2a8f05
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c58f1e3a9d27"
+down_revision = "b41e6d2a8f05"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "match_jobs",
+        sa.Column("attempts", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.add_column("match_jobs", sa.Column("heartbeat_at", sa.DateTime(timezone=True)))
+
+
+def downgrade():
+    op.drop_column("match_jobs", "heartbeat_at")
+    op.drop_column("match_jobs", "attempts")
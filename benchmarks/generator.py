@@ -0,0 +1,68 @@
+import random
+
+from src.match import MatchOrder, double_sell_orders
+
+
+def generate_round(
+    number_of_orders,
+    seed=0,
+    number_of_securities=4,
+    users_per_order=0.5,
+    price_spread=0.1,
+    share_skew=1.5,
+    ban_density=0.001,
+):
+    """
+    Generates the matching params of a round, as MatchService._get_matching_params
+    would return them.
+
+    Params:
+    number_of_orders: number of orders before doubling, split evenly between buy and
+        sell orders.
+    seed: seed of the random number generator. The same params give the same round.
+    number_of_securities: number of securities, each with a random market price.
+    users_per_order: number of users, as a fraction of number_of_orders. Users both
+        buy and sell, and may place several orders.
+    price_spread: standard deviation of order prices, as a fraction of the market
+        price of their security.
+    share_skew: shape of the Pareto distribution of the number of shares. Lower is
+        more skewed.
+    ban_density: fraction of all (buyer, seller) user pairs that are banned.
+
+    Returns:
+    (buy_orders, sell_orders, banned_pairs), with the sell orders of sellers with a
+    single sell order doubled.
+    """
+    rng = random.Random(seed)
+
+    securities = [
+        (f"security{i}", round(rng.uniform(5, 50), 2))
+        for i in range(number_of_securities)
+    ]
+    users = [f"user{i}" for i in range(max(1, int(number_of_orders * users_per_order)))]
+
+    def generate_orders(id_prefix, count):
+        orders = []
+        for i in range(count):
+            security_id, market_price = rng.choice(securities)
+            price = rng.gauss(market_price, market_price * price_spread)
+            orders.append(
+                MatchOrder(
+                    id=f"{id_prefix}{i}",
+                    user_id=rng.choice(users),
+                    security_id=security_id,
+                    price=max(0.01, round(price, 2)),
+                    number_of_shares=int(min(rng.paretovariate(share_skew), 100) * 100),
+                )
+            )
+        return orders
+
+    buy_orders = generate_orders("b", number_of_orders // 2)
+    sell_orders = generate_orders("s", number_of_orders - number_of_orders // 2)
+
+    number_of_bans = round(ban_density * len(users) ** 2)
+    banned_pairs = {
+        (rng.choice(users), rng.choice(users)) for _ in range(number_of_bans)
+    }
+
+    return buy_orders, double_sell_orders(sell_orders), sorted(banned_pairs)
@@ -0,0 +1,211 @@
+"""
+Times the matching algorithm and each of its phases on generated rounds, in every
+mode MatchService matches rounds in, and prints a JSON report.
+
+Run with ./run_benchmarks.sh, e.g.
+./run_benchmarks.sh --sizes 100 1000 --modes exact nearest --output report.json
+"""
+import argparse
+import json
+import platform
+import sys
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from time import perf_counter
+from unittest.mock import patch
+
+import numpy as np
+import scipy
+
+from benchmarks.generator import generate_round
+from src import match
+from src.match import (
+    SOLVERS,
+    match_buyers_and_sellers,
+    match_buyers_and_sellers_within_budget,
+)
+
+SIZES = [10, 100, 1000, 10000]
+
+# Solvers that are too slow to run on large rounds, with the largest size they run on
+SOLVER_MAX_SIZES = {"networkx": 1000}
+
+# Keyword arguments of the entry point of each mode of MatchService._match_orders.
+# The budgeted mode, for rounds above ACQUITY_MATCHING_APPROXIMATE_MIN_PAIRS, does
+# not use a solver.
+MODES = {
+    "exact": {},
+    "nearest": {"candidates_per_sell_order": 32},
+    "budgeted": {"time_budget": 60},
+}
+
+# Functions of src.match timed as phases of the entry points
+PHASES = [
+    "partition_by_security",
+    "count_possible_matches",
+    "build_cost_graph",
+    "build_nearest_cost_graph",
+    "solve_within_budget",
+    "distribute_remaining_buyers",
+]
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.seconds = defaultdict(float)
+
+    @contextmanager
+    def __call__(self, phase):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[phase] += perf_counter() - start
+
+    def wrap(self, phase, function):
+        def timed(*args, **kwargs):
+            with self(phase):
+                return function(*args, **kwargs)
+
+        return timed
+
+
+def match_round(buy_orders, sell_orders, banned_pairs, solver, mode):
+    """
+    Matches a round with the entry point of the mode, in a single process.
+
+    Returns:
+    Set of matches.
+    """
+    kwargs = MODES[mode]
+    if "time_budget" in kwargs:
+        matches, _gap = match_buyers_and_sellers_within_budget(
+            buy_orders, sell_orders, banned_pairs, **kwargs
+        )
+        return matches
+
+    return match_buyers_and_sellers(
+        buy_orders, sell_orders, banned_pairs, solver=solver, **kwargs
+    )
+
+
+def time_phases(buy_orders, sell_orders, banned_pairs, solver, mode="exact"):
+    """
+    Matches a round with match_round, timing it as a whole ("total") and each of the
+    PHASES it goes through, plus the solver ("solve"). Phases that do not run in the
+    mode are left out.
+
+    Returns:
+    (set of matches, dict of phase name to seconds)
+    """
+    timer = PhaseTimer()
+    with ExitStack() as stack:
+        for phase in PHASES:
+            stack.enter_context(
+                patch.object(match, phase, timer.wrap(phase, getattr(match, phase)))
+            )
+        if solver is not None:
+            stack.enter_context(
+                patch.dict(SOLVERS, {solver: timer.wrap("solve", SOLVERS[solver])})
+            )
+
+        with timer("total"):
+            matches = match_round(buy_orders, sell_orders, banned_pairs, solver, mode)
+
+    return matches, dict(timer.seconds)
+
+
+def run_benchmarks(
+    sizes=SIZES, solvers=tuple(SOLVERS), modes=tuple(MODES), repeat=3, seed=0, **kwargs
+):
+    """
+    Benchmarks every mode with every solver on a generated round of every size, keeping
+    the fastest of repeat runs of each phase. kwargs are passed to generate_round.
+
+    Returns:
+    The report, as a JSON-serializable dict.
+    """
+    results = []
+    for size in sizes:
+        buy_orders, sell_orders, banned_pairs = generate_round(
+            size, seed=seed, **kwargs
+        )
+
+        for mode in modes:
+            mode_solvers = [None] if "time_budget" in MODES[mode] else solvers
+            for solver in mode_solvers:
+                result = {
+                    "number_of_orders": size,
+                    "number_of_buy_orders": len(buy_orders),
+                    "number_of_sell_orders": len(sell_orders),
+                    "number_of_banned_pairs": len(banned_pairs),
+                    "mode": mode,
+                    "solver": solver,
+                }
+                if size > SOLVER_MAX_SIZES.get(solver, size):
+                    results.append({**result, "skipped": True})
+                    continue
+
+                seconds = {}
+                for _ in range(repeat):
+                    matches, run_seconds = time_phases(
+                        buy_orders, sell_orders, banned_pairs, solver, mode
+                    )
+                    for phase, phase_seconds in run_seconds.items():
+                        seconds[phase] = min(
+                            seconds.get(phase, phase_seconds), phase_seconds
+                        )
+
+                results.append(
+                    {**result, "number_of_matches": len(matches), "seconds": seconds}
+                )
+
+    return {
+        "seed": seed,
+        "repeat": repeat,
+        "round_params": kwargs,
+        "modes": {mode: MODES[mode] for mode in modes},
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument(
+        "--solvers", nargs="+", choices=list(SOLVERS), default=list(SOLVERS)
+    )
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--securities", type=int, default=4)
+    parser.add_argument("--ban-density", type=float, default=0.001)
+    parser.add_argument("--output", help="file to write the report to")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(
+        sizes=args.sizes,
+        solvers=args.solvers,
+        modes=args.modes,
+        repeat=args.repeat,
+        seed=args.seed,
+        number_of_securities=args.securities,
+        ban_density=args.ban_density,
+    )
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+#!/usr/bin/env bash
+if [ "$NO_POETRY" = "1" ]; then
+  python src/worker.py
+else
+  env PYTHONPATH=. poetry run python src/worker.py
+fi
@@ -3,7 +3,9 @@ from functools import wraps
 from sanic import Blueprint
 from sanic.response import json
 
+from src.database import request_scope
 from src.exceptions import InvalidAuthorizationTokenException, ResourceNotOwnedException
+from src.executor import offload
 from src.utils import expects_json_object
 
 blueprint = Blueprint("root", version="v1")
@@ -17,14 +19,12 @@ def auth_required(f):
         if header is None or not header.startswith(PREFIX):
             raise InvalidAuthorizationTokenException("Invalid Authorization Bearer")
         token = header[len(PREFIX) :]
-        linkedin_user = request.app.linkedin_login.get_linkedin_user(token=token)
-        user = request.app.user_service.get_user_by_linkedin_id(
-            provider_user_id=linkedin_user.get("provider_user_id")
-        )
+        user = await request.app.linkedin_login.get_user_by_token_async(token=token)
         if user is None:
             raise ResourceNotOwnedException("User not found")
 
-        response = await f(request, user, *args, **kwargs)
+        async with request_scope():
+            response = await f(request, user, *args, **kwargs)
         return response
 
     return decorated_function
@@ -33,9 +33,6 @@ def auth_required(f):
 @blueprint.get("/auth/me")
 @auth_required
 async def user_info(request, user):
-    user = request.app.user_service.get_user_by_linkedin_id(
-        provider_user_id=user.get("provider_user_id")
-    )
     return json({"me": user})
 
 
@@ -48,7 +45,7 @@ async def root(request):
 @auth_required
 async def get_sell_orders_by_user_in_current_round(request, user):
     return json(
-        request.app.sell_order_service.get_orders_by_user_in_current_round(
+        await request.app.sell_order_service.get_orders_by_user_in_current_round_async(
             user_id=user["id"]
         )
     )
@@ -58,7 +55,9 @@ async def get_sell_orders_by_user_in_current_round(request, user):
 @auth_required
 async def get_sell_order_by_id(request, user, id):
     return json(
-        request.app.sell_order_service.get_order_by_id(id=id, user_id=user["id"])
+        await offload(
+            request.app.sell_order_service.get_order_by_id, id=id, user_id=user["id"]
+        )
     )
 
 
@@ -67,8 +66,11 @@ async def get_sell_order_by_id(request, user, id):
 @expects_json_object
 async def create_sell_order(request, user):
     return json(
-        request.app.sell_order_service.create_order(
-            **request.json, user_id=user["id"], scheduler=request.app.scheduler
+        await offload(
+            request.app.sell_order_service.create_order,
+            **request.json,
+            user_id=user["id"],
+            scheduler=request.app.scheduler
         )
     )
 
@@ -78,8 +80,11 @@ async def create_sell_order(request, user):
 @expects_json_object
 async def edit_sell_order(request, user, id):
     return json(
-        request.app.sell_order_service.edit_order(
-            **request.json, id=id, subject_id=user["id"]
+        await offload(
+            request.app.sell_order_service.edit_order,
+            **request.json,
+            id=id,
+            subject_id=user["id"]
         )
     )
 
@@ -88,7 +93,9 @@ async def edit_sell_order(request, user, id):
 @auth_required
 async def delete_sell_order(request, user, id):
     return json(
-        request.app.sell_order_service.delete_order(id=id, subject_id=user["id"])
+        await offload(
+            request.app.sell_order_service.delete_order, id=id, subject_id=user["id"]
+        )
     )
 
 
@@ -96,7 +103,7 @@ async def delete_sell_order(request, user, id):
 @auth_required
 async def get_buy_orders_by_user_in_current_round(request, user):
     return json(
-        request.app.buy_order_service.get_orders_by_user_in_current_round(
+        await request.app.buy_order_service.get_orders_by_user_in_current_round_async(
             user_id=user["id"]
         )
     )
@@ -106,7 +113,9 @@ async def get_buy_orders_by_user_in_current_round(request, user):
 @auth_required
 async def get_buy_order_by_id(request, user, id):
     return json(
-        request.app.buy_order_service.get_order_by_id(id=id, user_id=user["id"])
+        await offload(
+            request.app.buy_order_service.get_order_by_id, id=id, user_id=user["id"]
+        )
     )
 
 
@@ -115,7 +124,11 @@ async def get_buy_order_by_id(request, user, id):
 @expects_json_object
 async def create_buy_order(request, user):
     return json(
-        request.app.buy_order_service.create_order(**request.json, user_id=user["id"])
+        await offload(
+            request.app.buy_order_service.create_order,
+            **request.json,
+            user_id=user["id"]
+        )
     )
 
 @blueprint.patch("/buy_order/<id>")
@@ -123,8 +136,11 @@ async def create_buy_order(request, user):
 @expects_json_object
 async def edit_buy_order(request, user, id):
     return json(
-        request.app.buy_order_service.edit_order(
-            **request.json, id=id, subject_id=user["id"]
+        await offload(
+            request.app.buy_order_service.edit_order,
+            **request.json,
+            id=id,
+            subject_id=user["id"]
         )
     )
 
@@ -133,13 +149,15 @@ async def edit_buy_order(request, user, id):
 @auth_required
 async def delete_buy_order(request, user, id):
     return json(
-        request.app.buy_order_service.delete_order(id=id, subject_id=user["id"])
+        await offload(
+            request.app.buy_order_service.delete_order, id=id, subject_id=user["id"]
+        )
     )
 
 
 @blueprint.get("/security/")
 async def get_all_securities(request):
-    return json(request.app.security_service.get_all())
+    return json(await request.app.security_service.get_all_async())
 
 
 @blueprint.patch("/security/<id>")
@@ -147,59 +165,99 @@ async def get_all_securities(request):
 @auth_required
 async def edit_security_market_price(request, user, id):
     return json(
-        request.app.security_service.edit_market_price(
-            **request.json, id=id, subject_id=user["id"]
+        await offload(
+            request.app.security_service.edit_market_price,
+            **request.json,
+            id=id,
+            subject_id=user["id"]
+        )
+    )
+
+
+@blueprint.get("/executor/stats")
+@auth_required
+async def get_executor_stats(request, user):
+    return json(
+        await offload(
+            request.app.user_service.get_executor_stats, subject_id=user["id"]
         )
     )
 
 
 @blueprint.get("/round/")
 async def get_all_rounds(request):
-    return json(request.app.round_service.get_all())
+    return json(await request.app.round_service.get_all_async())
 
 
 @blueprint.get("/round/active")
 async def get_active_round(request):
-    return json(request.app.round_service.get_active())
+    return json(await request.app.round_service.get_active_async())
+
+
+@blueprint.get("/round/<round_id>/match_job")
+@auth_required
+async def get_round_match_job(request, user, round_id):
+    return json(
+        await offload(
+            request.app.match_service.get_job, round_id=round_id, subject_id=user["id"]
+        )
+    )
+
+
+@blueprint.get("/round/active/matches/preview")
+@auth_required
+async def preview_active_round_matches(request, user):
+    return json(
+        await offload(request.app.match_service.preview_matches, subject_id=user["id"])
+    )
 
 
 @blueprint.get("/round/previous/statistics/<security_id>")
 async def get_previous_round(request, security_id):
     return json(
-        request.app.round_service.get_previous_round_statistics(security_id=security_id)
+        await offload(
+            request.app.round_service.get_previous_round_statistics,
+            security_id=security_id,
+        )
     )
 
 @blueprint.get("/round/active/stats")
 async def get_active_round_stats(request):
-    return json(request.app.round_service.get_stats())
+    return json(await offload(request.app.round_service.get_stats))
 
 @blueprint.get("/user/stats")
 async def get_user_stats(request):
-    return json(request.app.user_service.get_stats())
+    return json(await offload(request.app.user_service.get_stats))
 
 @blueprint.get("/auth/linkedin")
 async def linkedin_auth(request):
-    return json(request.app.linkedin_login.get_auth_url(**request.args))
+    return json(await offload(request.app.linkedin_login.get_auth_url, **request.args))
 
 
 @blueprint.post("/auth/linkedin")
 @expects_json_object
 async def linkedin_auth_callback(request):
-    return json(request.app.linkedin_login.authenticate(**request.json))
+    return json(await offload(request.app.linkedin_login.authenticate, **request.json))
 
 
 @blueprint.get("/requests/")
 @auth_required
 async def get_requests(request, user):
-    return json(request.app.user_request_service.get_requests(subject_id=user["id"]))
+    return json(
+        await offload(
+            request.app.user_request_service.get_requests, subject_id=user["id"]
+        )
+    )
 
 
 @blueprint.post("/requests/<id>")
 @auth_required
 async def approve_request(request, user, id):
     return json(
-        request.app.user_request_service.approve_request(
-            request_id=id, subject_id=user["id"]
+        await offload(
+            request.app.user_request_service.approve_request,
+            request_id=id,
+            subject_id=user["id"],
         )
     )
 
@@ -208,8 +266,10 @@ async def approve_request(request, user, id):
 @auth_required
 async def reject_request(request, user, id):
     return json(
-        request.app.user_request_service.reject_request(
-            request_id=id, subject_id=user["id"]
+        await offload(
+            request.app.user_request_service.reject_request,
+            request_id=id,
+            subject_id=user["id"],
         )
     )
 
@@ -219,7 +279,41 @@ async def reject_request(request, user, id):
 async def get_chats(request, user):
     types = request.args.get("type") or []
     return json(
-        request.app.chat_service.get_chats_by_user_id(
-            user_id=user["id"], as_buyer="buyer" in types, as_seller="seller" in types
+        await offload(
+            request.app.chat_service.get_chats_by_user_id,
+            user_id=user["id"],
+            as_buyer="buyer" in types,
+            as_seller="seller" in types,
+        )
+    )
+
+
+@blueprint.get("/chats/sync")
+@auth_required
+async def sync_chats(request, user):
+    types = request.args.get("type") or []
+    return json(
+        await offload(
+            request.app.chat_service.get_chats_since,
+            user_id=user["id"],
+            as_buyer="buyer" in types,
+            as_seller="seller" in types,
+            since=request.args.get("since"),
+        )
+    )
+
+
+@blueprint.get("/chats/<chat_room_id>/history")
+@auth_required
+async def get_chat_history(request, user, chat_room_id):
+    limit = request.args.get("limit")
+    return json(
+        await offload(
+            request.app.chat_service.get_chat_history,
+            user_id=user["id"],
+            chat_room_id=chat_room_id,
+            before=request.args.get("before"),
+            after=request.args.get("after"),
+            limit=int(limit) if limit is not None and limit.isdigit() else limit,
         )
     )
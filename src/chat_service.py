@@ -1,8 +1,12 @@
 from functools import wraps
+from time import monotonic
+from urllib.parse import parse_qs
 
 import socketio
 
-from src.exceptions import AcquityException
+from src.database import request_scope
+from src.exceptions import AcquityException, InvalidAuthorizationTokenException
+from src.executor import offload
 from src.services import (
     ChatRoomService,
     ChatService,
@@ -28,19 +32,20 @@ def handle_acquity_exceptions(f):
 
 
 def auth_required(f):
+    """
+    Runs the handler in a request_scope. The handler returns the (event, data, room) to
+    emit, if any, which is emitted once the request_scope has committed, so that no one
+    sees changes that can still be rolled back.
+    """
+
     @wraps(f)
     async def decorated(self, sid, data):
-        token = data.get("token")
-        if token is None:
-            pass
-
-        linkedin_user = self.linkedin_login.get_linkedin_user(token=token)
-        user = self.user_service.get_user_by_linkedin_id(
-            provider_user_id=linkedin_user["provider_user_id"]
-        )
-
-        data.pop("token")
-        return await f(self, sid, data, user)
+        user = await self.authenticate(sid, token=data.pop("token", None))
+        async with request_scope():
+            response = await f(self, sid, data, user)
+        if response is not None:
+            event, event_data, room = response
+            await self.emit(event, event_data, room=room)
 
     return decorated
 
@@ -55,7 +60,37 @@ class ChatSocketService(socketio.AsyncNamespace):
         self.offer_service = OfferService(config)
         self.config = config
 
+    async def authenticate(self, sid, token=None):
+        """
+        Returns the user of the connection. The user is resolved from the token once,
+        then kept in the Socket.IO session. It is only resolved again after
+        ACQUITY_SOCKET_AUTH_REVALIDATE_INTERVAL seconds, or for a different token.
+        """
+        session = await self.get_session(sid)
+        if token is None or token == session.get("token"):
+            token = session.get("token")
+            if token is None:
+                raise InvalidAuthorizationTokenException("Missing token")
+            if (
+                monotonic() - session["authenticated_at"]
+                < self.config["ACQUITY_SOCKET_AUTH_REVALIDATE_INTERVAL"]
+            ):
+                return session["user"]
+
+        user = await self.linkedin_login.get_user_by_token_async(token=token)
+        await self.save_session(
+            sid, {"token": token, "user": user, "authenticated_at": monotonic()}
+        )
+        return user
+
     async def on_connect(self, sid, environ):
+        # Clients may authenticate when connecting, instead of on their first event
+        token = parse_qs(environ.get("QUERY_STRING", "")).get("token")
+        if token is not None:
+            try:
+                await self.authenticate(sid, token=token[0])
+            except AcquityException:
+                return False
         return {"data": "success"}
 
     async def on_disconnect(self, sid):
@@ -64,50 +99,77 @@ class ChatSocketService(socketio.AsyncNamespace):
     @handle_acquity_exceptions
     @auth_required
     async def on_req_subscribe(self, sid, data, user):
-        chat_rooms = self.chat_room_service.get_chat_rooms_by_user_id(
+        chat_rooms = await self.chat_room_service.get_chat_rooms_by_user_id_async(
             user_id=user["id"]
         )
         for chat_room in chat_rooms:
             self.enter_room(sid, chat_room["id"])
 
+    @handle_acquity_exceptions
+    @auth_required
+    async def on_req_sync(self, sid, data, user):
+        chats = await offload(
+            self.chat_service.get_chats_since, **data, user_id=user["id"]
+        )
+        return "res_sync", chats, sid
+
+    @handle_acquity_exceptions
+    @auth_required
+    async def on_req_chat_history(self, sid, data, user):
+        history = await offload(
+            self.chat_service.get_chat_history, **data, user_id=user["id"]
+        )
+        return "res_chat_history", history, sid
+
     @handle_acquity_exceptions
     @auth_required
     async def on_req_new_message(self, sid, data, user):
-        chat = self.chat_service.create_new_message(**data, author_id=user["id"])
-        await self.emit("res_new_event", chat, room=data["chat_room_id"])
+        chat = await offload(
+            self.chat_service.create_new_message, **data, author_id=user["id"]
+        )
+        return "res_new_event", chat, data["chat_room_id"]
 
     @handle_acquity_exceptions
     @auth_required
     async def on_req_new_offer(self, sid, data, user):
-        offer = self.offer_service.create_new_offer(**data, author_id=user["id"])
-        await self.emit("res_new_event", offer, room=data["chat_room_id"])
+        offer = await offload(
+            self.offer_service.create_new_offer, **data, author_id=user["id"]
+        )
+        return "res_new_event", offer, data["chat_room_id"]
 
     @handle_acquity_exceptions
     @auth_required
     async def on_req_edit_offer_status(self, sid, data, user):
-        resp = self.offer_service.edit_offer_status(**data, user_id=user["id"])
-        await self.emit("res_new_event", resp, room=data["chat_room_id"])
+        resp = await offload(
+            self.offer_service.edit_offer_status, **data, user_id=user["id"]
+        )
+        return "res_new_event", resp, data["chat_room_id"]
 
     @handle_acquity_exceptions
     @auth_required
     async def on_req_archive_chatroom(self, sid, data, user):
-        self.chat_room_service.archive_room(**data, user_id=user["id"])
+        await offload(self.chat_room_service.archive_room, **data, user_id=user["id"])
 
     @handle_acquity_exceptions
     @auth_required
     async def on_req_disband_chatroom(self, sid, data, user):
-        rsp = self.chat_room_service.disband_chatroom(**data, user_id=user["id"])
-        await self.emit("res_disband_chatroom", rsp, room=data["chat_room_id"])
+        rsp = await offload(
+            self.chat_room_service.disband_chatroom, **data, user_id=user["id"]
+        )
+        return "res_disband_chatroom", rsp, data["chat_room_id"]
 
     @handle_acquity_exceptions
     @auth_required
     async def on_req_update_last_read_id(self, sid, data, user):
-        self.chat_room_service.update_last_read_id(**data, user_id=user["id"])
+        await offload(
+            self.chat_room_service.update_last_read_id, **data, user_id=user["id"]
+        )
 
     @handle_acquity_exceptions
     @auth_required
     async def on_req_reveal_identity(self, sid, data, user):
-        rsp = self.chat_room_service.reveal_identity(**data, user_id=user["id"])
-
+        rsp = await offload(
+            self.chat_room_service.reveal_identity, **data, user_id=user["id"]
+        )
         if rsp is not None:
-            await self.emit("res_reveal_identity", rsp, room=data["chat_room_id"])
+            return "res_reveal_identity", rsp, data["chat_room_id"]
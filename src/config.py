@@ -1,5 +1,5 @@
 from datetime import timedelta
-from os import getenv
+from os import cpu_count, getenv
 
 from dotenv import load_dotenv
 
@@ -15,6 +15,16 @@ DATABASE_URL = getenv("DATABASE_URL", DEFAULT_DATABASE_URL)
 
 APP_CONFIG = {
     "DATABASE_URL": DATABASE_URL,
+    # connection pool of the database engine, see sqlalchemy.create_engine
+    "DATABASE_POOL_SIZE": int(getenv("DATABASE_POOL_SIZE", "5")),
+    "DATABASE_MAX_OVERFLOW": int(getenv("DATABASE_MAX_OVERFLOW", "15")),
+    "DATABASE_POOL_PRE_PING": getenv("DATABASE_POOL_PRE_PING", "true") == "true",
+    # seconds after which a connection is replaced, -1 never replaces them
+    "DATABASE_POOL_RECYCLE": int(getenv("DATABASE_POOL_RECYCLE", "3600")),
+    # seconds a request waits for a database connection before failing with a 503
+    "DATABASE_REQUEST_TIMEOUT": int(getenv("DATABASE_REQUEST_TIMEOUT", "5")),
+    # connections kept by the asynchronous database engine of the web server
+    "DATABASE_ASYNC_POOL_SIZE": int(getenv("DATABASE_ASYNC_POOL_SIZE", "10")),
     "HOST": getenv("HOST"),
     "PORT": getenv("PORT", 8000),
     "CLIENT_ID": getenv("CLIENT_ID"),
@@ -31,11 +41,64 @@ APP_CONFIG = {
     ),
     "ACQUITY_SELL_ORDER_PER_ROUND_LIMIT": 2,
     "ACQUITY_BUY_ORDER_PER_ROUND_LIMIT": 1,
+    # one of src.match.SOLVERS
+    "ACQUITY_MATCHING_SOLVER": getenv("ACQUITY_MATCHING_SOLVER", "bipartite"),
+    # securities are matched in parallel processes, default one per CPU
+    "ACQUITY_MATCHING_MAX_WORKERS": int(
+        getenv("ACQUITY_MATCHING_MAX_WORKERS", cpu_count() or 1)
+    ),
+    # number of nearest buy orders considered per sell order, 0 considers them all
+    "ACQUITY_MATCHING_CANDIDATES_PER_SELL_ORDER": int(
+        getenv("ACQUITY_MATCHING_CANDIDATES_PER_SELL_ORDER", "0")
+    )
+    or None,
+    # above this number of (buy order, sell order) pairs of the same security, rounds
+    # are matched approximately within a time budget, in seconds
+    "ACQUITY_MATCHING_APPROXIMATE_MIN_PAIRS": int(
+        getenv("ACQUITY_MATCHING_APPROXIMATE_MIN_PAIRS", "10000000")
+    ),
+    "ACQUITY_MATCHING_TIME_BUDGET": int(getenv("ACQUITY_MATCHING_TIME_BUDGET", "300")),
+    "ACQUITY_MATCH_PREVIEW_CACHE_SIZE": 16,
+    # seconds to spend on previews of rounds matched approximately, in the web server
+    "ACQUITY_MATCH_PREVIEW_TIME_BUDGET": int(
+        getenv("ACQUITY_MATCH_PREVIEW_TIME_BUDGET", "5")
+    ),
+    # users resolved from bearer tokens, cached for at most the given seconds
+    "ACQUITY_AUTH_CACHE_SIZE": 10000,
+    "ACQUITY_AUTH_CACHE_TTL": int(getenv("ACQUITY_AUTH_CACHE_TTL", "60")),
+    # seconds after which the user of a chat socket connection is resolved again
+    "ACQUITY_SOCKET_AUTH_REVALIDATE_INTERVAL": int(
+        getenv("ACQUITY_SOCKET_AUTH_REVALIDATE_INTERVAL", "300")
+    ),
+    # events per page of the chat history of a room
+    "ACQUITY_CHAT_HISTORY_PAGE_SIZE": 50,
+    "ACQUITY_CHAT_HISTORY_MAX_PAGE_SIZE": 200,
+    # seconds by which chat sync watermarks are moved back, to catch the changes of
+    # transactions that were still running when the watermark was taken
+    "ACQUITY_CHAT_SYNC_OVERLAP": int(getenv("ACQUITY_CHAT_SYNC_OVERLAP", "5")),
+    # threads that run blocking service calls for the web server
+    "ACQUITY_SERVICE_MAX_WORKERS": int(getenv("ACQUITY_SERVICE_MAX_WORKERS", "8")),
+    # seconds without a heartbeat after which a running match job is taken over by
+    # another worker, and the number of tries before the job is marked as failed
+    "ACQUITY_MATCHING_JOB_LEASE": int(getenv("ACQUITY_MATCHING_JOB_LEASE", "120")),
+    "ACQUITY_MATCHING_JOB_MAX_ATTEMPTS": 3,
+    # seconds between checks of the matching worker for rounds to match
+    "ACQUITY_MATCHING_WORKER_POLL_INTERVAL": int(
+        getenv("ACQUITY_MATCHING_WORKER_POLL_INTERVAL", "10")
+    ),
     "CORS_AUTOMATIC_OPTIONS": True,
     "CORS_SUPPORTS_CREDENTIALS": True,
     "MAILGUN_ENABLE": getenv("MAILGUN_ENABLE", ACQUITY_ENV == "PRODUCTION"),
     "MAILGUN_API_KEY": getenv("MAILGUN_API_KEY"),
     "MAILGUN_API_BASE_URL": getenv("MAILGUN_API_BASE_URL"),
+    # Mailgun accepts at most 1000 recipients per batch sending request
+    "MAILGUN_MAX_RECIPIENTS_PER_BATCH": 1000,
+    # number of batches sent at once
+    "MAILGUN_MAX_WORKERS": int(getenv("MAILGUN_MAX_WORKERS", "4")),
+    # number of tries before a batch is marked as failed
+    "MAILGUN_MAX_ATTEMPTS": 5,
+    # seconds before the second attempt at sending a batch, doubled for each attempt
+    "MAILGUN_RETRY_DELAY": 60,
     "SENTRY_ENABLE": getenv("SENTRY_ENABLE", ACQUITY_ENV == "PRODUCTION"),
     "apscheduler.jobstores.default": {"type": "sqlalchemy", "url": DATABASE_URL},
 }
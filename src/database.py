@@ -1,6 +1,9 @@
+import asyncio
 import uuid
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 
+import psycopg2
 from sqlalchemy import (
     Boolean,
     Column,
@@ -8,17 +11,21 @@ from sqlalchemy import (
     Enum,
     Float,
     ForeignKey,
+    Index,
+    Integer,
     String,
     Text,
     UniqueConstraint,
     create_engine,
     func,
 )
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import ARRAY, UUID
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 
 from src.config import APP_CONFIG
+from src.exceptions import ServiceUnavailableException
+from src.executor import offload
 from src.utils import generate_friendly_name
 
 _base = declarative_base()
@@ -68,6 +75,8 @@ class User(Base):
     provider_user_id = Column(String, nullable=False, unique=True)
     auth_token = Column(String)
 
+    __table_args__ = (Index("ix_users_auth_token", "auth_token"),)
+
     sell_orders = relationship("SellOrder", back_populates="user")
     buy_orders = relationship("BuyOrder", back_populates="user")
     bans_as_buyer = relationship(
@@ -128,6 +137,17 @@ class SellOrder(Base):
     security = relationship("Security", back_populates="sell_orders", lazy="joined")
     round = relationship("Round", back_populates="sell_orders")
 
+    __table_args__ = (
+        Index("ix_sell_orders_round_id", "round_id"),
+        Index("ix_sell_orders_user_id_round_id", "user_id", "round_id"),
+        # Orders waiting for the next round
+        Index(
+            "ix_sell_orders_unassigned_user_id",
+            "user_id",
+            postgresql_where=round_id == None,
+        ),
+    )
+
 
 class BuyOrder(Base):
     __tablename__ = "buy_orders"
@@ -149,6 +169,17 @@ class BuyOrder(Base):
     security = relationship("Security", back_populates="buy_orders", lazy="joined")
     round = relationship("Round", back_populates="buy_orders")
 
+    __table_args__ = (
+        Index("ix_buy_orders_round_id", "round_id"),
+        Index("ix_buy_orders_user_id_round_id", "user_id", "round_id"),
+        # Orders waiting for the next round
+        Index(
+            "ix_buy_orders_unassigned_user_id",
+            "user_id",
+            postgresql_where=round_id == None,
+        ),
+    )
+
 
 class Match(Base):
     __tablename__ = "matches"
@@ -175,6 +206,48 @@ class Round(Base):
     buy_orders = relationship("BuyOrder", back_populates="round")
     sell_orders = relationship("SellOrder", back_populates="round")
 
+    __table_args__ = (
+        Index("ix_rounds_active_end_time", "end_time", postgresql_where=~is_concluded),
+    )
+
+
+class MatchJob(Base):
+    __tablename__ = "match_jobs"
+
+    round_id = Column(
+        UUID, ForeignKey("rounds.id", ondelete="CASCADE"), nullable=False, unique=True
+    )
+    run_at = Column(DateTime(timezone=True), nullable=False)
+    status = Column(
+        Enum("PENDING", "RUNNING", "DONE", "FAILED", name="match_job_statuses"),
+        nullable=False,
+        server_default="PENDING",
+    )
+    stage = Column(String)
+    error = Column(Text)
+    attempts = Column(Integer, nullable=False, server_default="0")
+    # renewed while the job runs, so that the job is taken over if its worker dies
+    heartbeat_at = Column(DateTime(timezone=True))
+
+
+class EmailBatch(Base):
+    __tablename__ = "email_batches"
+
+    round_id = Column(UUID, ForeignKey("rounds.id", ondelete="CASCADE"), nullable=False)
+    template = Column(String, nullable=False)
+    recipients = Column(ARRAY(String), nullable=False)
+    status = Column(
+        Enum("PENDING", "SENT", "FAILED", name="email_batch_statuses"),
+        nullable=False,
+        server_default="PENDING",
+    )
+    attempts = Column(Integer, nullable=False, server_default="0")
+    # the batch is not sent before then, while it is being sent or after a failure
+    next_attempt_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
+    error = Column(Text)
+
 
 class BannedPair(Base):
     __tablename__ = "banned_pairs"
@@ -214,8 +287,14 @@ class UserChatRoomAssociation(Base):
     is_revealed = Column(Boolean, nullable=False, server_default="f")
     is_archived = Column(Boolean, nullable=False, server_default="f")
     last_read_id = Column(UUID, ForeignKey("chats.id", ondelete="CASCADE"))
+    # chats of the other party after last_read_id, kept up to date as chats are sent
+    # and read
+    unread_count = Column(Integer, nullable=False, server_default="0")
 
-    __table_args__ = (UniqueConstraint("user_id", "chat_room_id"),)
+    __table_args__ = (
+        UniqueConstraint("user_id", "chat_room_id"),
+        Index("ix_user_chat_room_association_chat_room_id", "chat_room_id"),
+    )
 
 
 class Chat(Base):
@@ -227,6 +306,10 @@ class Chat(Base):
     message = Column(Text, nullable=False)
     author_id = Column(UUID, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
 
+    __table_args__ = (
+        Index("ix_chats_chat_room_id_created_at", "chat_room_id", "created_at"),
+    )
+
 
 class Offer(Base):
     __tablename__ = "offers"
@@ -243,6 +326,11 @@ class Offer(Base):
         server_default="PENDING",
     )
 
+    __table_args__ = (
+        Index("ix_offers_chat_room_id_offer_status", "chat_room_id", "offer_status"),
+        Index("ix_offers_chat_room_id_created_at", "chat_room_id", "created_at"),
+    )
+
 
 class OfferResponse(Base):
     __tablename__ = "offer_responses"
@@ -250,6 +338,8 @@ class OfferResponse(Base):
     offer_id = Column(UUID, ForeignKey("offers.id", ondelete="CASCADE"), nullable=False)
     # TODO migrate Offer.offer_status to an "is_accepted" column here
 
+    __table_args__ = (Index("ix_offer_responses_offer_id", "offer_id"),)
+
 
 class UserRequest(Base):
     __tablename__ = "user_requests"
@@ -258,16 +348,137 @@ class UserRequest(Base):
     is_buy = Column(Boolean, nullable=False)
     closed_by_user_id = Column(UUID, ForeignKey("users.id", ondelete="CASCADE"))
 
+    __table_args__ = (
+        # Requests waiting for approval
+        Index(
+            "ix_user_requests_open_user_id",
+            "user_id",
+            postgresql_where=closed_by_user_id == None,
+        ),
+    )
+
 
-engine = create_engine(APP_CONFIG["DATABASE_URL"])
+engine = create_engine(
+    APP_CONFIG["DATABASE_URL"],
+    pool_size=APP_CONFIG["DATABASE_POOL_SIZE"],
+    max_overflow=APP_CONFIG["DATABASE_MAX_OVERFLOW"],
+    pool_pre_ping=APP_CONFIG["DATABASE_POOL_PRE_PING"],
+    pool_recycle=APP_CONFIG["DATABASE_POOL_RECYCLE"],
+)
 
 
 Session = sessionmaker(bind=engine)
 
 
+class AsyncEngine:
+    """
+    Runs SQLAlchemy Core statements on asynchronous psycopg2 connections. Queries are
+    waited on by the event loop rather than blocking it, so that a slow query does
+    not stall the other requests and sockets of the web server.
+
+    Each statement runs in its own transaction, so this is meant for reads.
+    """
+
+    def __init__(self, engine, pool_size):
+        self.engine = engine
+        self.pool_size = pool_size
+        self._connections = []
+        self._loop = None
+        self._semaphore = None
+
+    async def execute(self, statement):
+        """
+        Returns:
+        The rows of the result as dicts keyed by column name. UUIDs are returned as
+        strings, as in Base.asdict.
+        """
+        compiled = statement.compile(dialect=self.engine.dialect)
+        params = {
+            k: str(v) if isinstance(v, uuid.UUID) else v
+            for k, v in compiled.params.items()
+        }
+
+        async with self._connect() as connection:
+            cursor = connection.cursor()
+            cursor.execute(str(compiled), params)
+            await self._wait(connection)
+            if cursor.description is None:
+                return []
+            keys = [column.name for column in cursor.description]
+            return [dict(zip(keys, row)) for row in cursor.fetchall()]
+
+    async def execute_one_or_none(self, statement):
+        rows = await self.execute(statement)
+        if len(rows) > 1:
+            raise ValueError("Multiple rows were found for one_or_none()")
+        return rows[0] if rows else None
+
+    @asynccontextmanager
+    async def _connect(self):
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            # Connections cannot be shared with the previous event loop
+            self._close()
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.pool_size)
+
+        async with self._semaphore:
+            if self._connections:
+                connection = self._connections.pop()
+            else:
+                args, kwargs = self.engine.dialect.create_connect_args(self.engine.url)
+                connection = psycopg2.connect(*args, **kwargs, async_=True)
+                await self._wait(connection)
+
+            try:
+                yield connection
+            except BaseException:
+                # The connection may be left in the middle of a query
+                connection.close()
+                raise
+            self._connections.append(connection)
+
+    async def _wait(self, connection):
+        loop = asyncio.get_event_loop()
+        while True:
+            state = connection.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+
+            ready = loop.create_future()
+            if state == psycopg2.extensions.POLL_READ:
+                loop.add_reader(connection.fileno(), ready.set_result, None)
+                remove = loop.remove_reader
+            else:
+                loop.add_writer(connection.fileno(), ready.set_result, None)
+                remove = loop.remove_writer
+            try:
+                await ready
+            finally:
+                remove(connection.fileno())
+
+    def _close(self):
+        for connection in self._connections:
+            connection.close()
+        self._connections = []
+
+
+async_engine = AsyncEngine(engine, APP_CONFIG["DATABASE_ASYNC_POOL_SIZE"])
+
+
+# Session shared by every session_scope of the current request, see request_scope
+request_session = ContextVar("request_session", default=None)
+
+
 @contextmanager
 def session_scope():
     """Provide a transactional scope around a series of operations."""
+    session = request_session.get()
+    if session is not None:
+        # Committed or rolled back with the rest of the request
+        yield session
+        return
+
     session = Session()
     try:
         yield session
@@ -277,3 +488,72 @@ def session_scope():
         raise
     finally:
         session.close()
+
+
+class RequestConnectionLimiter:
+    """
+    Limits the connections held by request_scopes to what the pool has left after
+    one connection for each thread of the service executor. The threads then never
+    wait on the pool, which would deadlock with the requests holding connections
+    while they wait for a thread. Requests wait for a connection on the event loop
+    instead, and fail with a ServiceUnavailableException after timeout seconds.
+    """
+
+    def __init__(self, limit, timeout):
+        if limit < 1:
+            raise ValueError(
+                "The connection pool must be larger than the service executor"
+            )
+        self.limit = limit
+        self.timeout = timeout
+        self._loop = None
+        self._semaphore = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.limit)
+
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise ServiceUnavailableException("The server is busy, try again later")
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+request_connection_limiter = RequestConnectionLimiter(
+    limit=APP_CONFIG["DATABASE_POOL_SIZE"]
+    + APP_CONFIG["DATABASE_MAX_OVERFLOW"]
+    - APP_CONFIG["ACQUITY_SERVICE_MAX_WORKERS"],
+    timeout=APP_CONFIG["DATABASE_REQUEST_TIMEOUT"],
+)
+
+
+@asynccontextmanager
+async def request_scope():
+    """
+    Runs the session_scopes of a request in a single session, and so on a single
+    connection and transaction, which is committed at the end of the request. The
+    session is shared with the service calls run through offload, which must not run
+    concurrently.
+    """
+    async with request_connection_limiter.acquire():
+        # Bound to one connection, which is kept even when a service commits midway
+        connection = await offload(engine.connect)
+        session = Session(bind=connection)
+        token = request_session.set(session)
+        try:
+            yield session
+            await offload(session.commit)
+        except:
+            await offload(session.rollback)
+            raise
+        finally:
+            request_session.reset(token)
+            await offload(session.close)
+            await offload(connection.close)
@@ -1,4 +1,5 @@
 import json
+from functools import lru_cache
 
 import requests
 
@@ -86,6 +87,12 @@ EMAIL_TEMPLATE = {
 }
 
 
+@lru_cache(maxsize=None)
+def read_html(path):
+    with open(path) as f:
+        return f.read()
+
+
 class EmailService:
     def __init__(self, config):
         self.config = config
@@ -108,8 +115,7 @@ class EmailService:
                 for k, v in data["templates"].items():
                     send_data["text"] = send_data["text"].replace(k, kwargs[v])
         if "html" in data:
-            with open(data["html"]) as f:
-                send_data["html"] = f.read()
+            send_data["html"] = read_html(data["html"])
             if "templates" in data:
                 for k, v in data["templates"].items():
                     send_data["html"] = send_data["html"].replace(k, kwargs[v])
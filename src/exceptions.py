@@ -35,3 +35,7 @@ class InvalidAuthorizationTokenException(AcquityException):
 
 class UserProfileNotFoundException(AcquityException):
     status_code = 401
+
+
+class ServiceUnavailableException(AcquityException):
+    status_code = 503
@@ -0,0 +1,69 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from src.config import APP_CONFIG
+
+
+class ServiceExecutor:
+    """
+    Runs blocking service calls on a bounded pool of threads, so that they do not
+    stall the event loop of the web server. Calls beyond the size of the pool wait in
+    a queue, which is measured by get_stats.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="service")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._max_queued = 0
+        self._total_wait_time = 0.0
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Calls function on the pool and waits for its result. The call sees the context
+        variables of the caller.
+        """
+        context = contextvars.copy_context()
+        submit_time = monotonic()
+        with self._lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+
+        def call():
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._total_wait_time += monotonic() - submit_time
+            try:
+                return context.run(function, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+
+        return await asyncio.get_event_loop().run_in_executor(self._executor, call)
+
+    def get_stats(self):
+        with self._lock:
+            started = self._completed + self._running
+            return {
+                "max_workers": self.max_workers,
+                "running": self._running,
+                "queued": self._queued,
+                "max_queued": self._max_queued,
+                "completed": self._completed,
+                "average_wait_time": started and self._total_wait_time / started,
+            }
+
+
+service_executor = ServiceExecutor(APP_CONFIG["ACQUITY_SERVICE_MAX_WORKERS"])
+
+
+async def offload(function, *args, **kwargs):
+    return await service_executor.run(function, *args, **kwargs)
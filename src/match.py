@@ -1,22 +1,133 @@
-from copy import deepcopy
+from bisect import bisect_left
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from time import monotonic
 
 import networkx as nx
+import numpy as np
 from networkx.algorithms.matching import max_weight_matching
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
 
+# Nearest buy orders per sell order considered by the approximate matching, unless
+# given, as rounds large enough to be matched approximately have too many pairs
+APPROXIMATE_CANDIDATES_PER_SELL_ORDER = 32
 
-def match_buyers_and_sellers(buy_orders, sell_orders, banned_user_matches):
+
+class MatchOrder(
+    namedtuple(
+        "MatchOrder", ["id", "user_id", "security_id", "price", "number_of_shares"]
+    )
+):
+    """
+    The fields of a buy or sell order that matching reads.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_orders(cls, orders):
+        """
+        Converts order dicts, leaving MatchOrders as they are.
+        """
+        return [
+            order
+            if isinstance(order, cls)
+            else cls(
+                id=order["id"],
+                user_id=order["user_id"],
+                security_id=order.get("security_id"),
+                price=order["price"],
+                number_of_shares=order["number_of_shares"],
+            )
+            for order in orders
+        ]
+
+
+class BannedPairIndex:
+    """
+    Pairs of (buyer user ID, seller user ID) that cannot be matched together, hashed by
+    buyer for constant-time checks.
+    """
+
+    def __init__(self, pairs=()):
+        self.sellers_by_buyer = {}
+        for buyer_id, seller_id in pairs:
+            self.sellers_by_buyer.setdefault(buyer_id, set()).add(seller_id)
+
+    @classmethod
+    def of(cls, banned_user_matches):
+        """
+        Indexes an enumerable of pairs, leaving BannedPairIndexes as they are.
+        """
+        if isinstance(banned_user_matches, cls):
+            return banned_user_matches
+        return cls(banned_user_matches)
+
+    def __contains__(self, pair):
+        buyer_id, seller_id = pair
+        sellers = self.sellers_by_buyer.get(buyer_id)
+        return sellers is not None and seller_id in sellers
+
+    def __iter__(self):
+        for buyer_id, sellers in self.sellers_by_buyer.items():
+            for seller_id in sellers:
+                yield buyer_id, seller_id
+
+    def __len__(self):
+        return sum(len(sellers) for sellers in self.sellers_by_buyer.values())
+
+    def mask(self, buy_orders, sell_orders):
+        """
+        Returns a boolean matrix that is True where the user of buy_orders[i] is banned
+        from the user of sell_orders[j].
+        """
+        banned = np.zeros((len(buy_orders), len(sell_orders)), dtype=bool)
+        if len(self.sellers_by_buyer) == 0:
+            return banned
+
+        cols_by_user = _group_indices_by_user(sell_orders)
+        for buyer_id, rows in _group_indices_by_user(buy_orders).items():
+            cols = [
+                col
+                for seller_id in self.sellers_by_buyer.get(buyer_id, ())
+                for col in cols_by_user.get(seller_id, ())
+            ]
+            if len(cols) > 0:
+                banned[np.ix_(rows, cols)] = True
+        return banned
+
+
+def match_buyers_and_sellers(
+    buy_orders,
+    sell_orders,
+    banned_user_matches,
+    solver="bipartite",
+    max_workers=1,
+    candidates_per_sell_order=None,
+):
     """
     The matching algorithm.
 
-    Currently, this operates on the assumption that all securities passed in are the same.
+    Orders are only matched with orders of the same security. Each security is matched
+    independently, in separate processes if there are several securities and
+    max_workers > 1.
 
     Params:
-    buy_orders: e.g. [{'id': 'UUID', 'user_id': 'UUID', 'security_id': 'UUID',
-                       'number_of_shares': 20.0, 'price': 30.0}]
-    sell_orders: e.g. [{'id': 'UUID', 'user_id': 'UUID', 'security_id': 'UUID',
-                        'number_of_shares': 20.0, 'price': 30.0}]
-    banned_user_matches: users that cannot be matched together. Pass in enumerable of pairs.
+    buy_orders: MatchOrders, or dicts with the same keys.
+    e.g. [{'id': 'UUID', 'user_id': 'UUID', 'security_id': 'UUID',
+           'number_of_shares': 20.0, 'price': 30.0}]
+    sell_orders: MatchOrders, or dicts with the same keys.
+    e.g. [{'id': 'UUID', 'user_id': 'UUID', 'security_id': 'UUID',
+           'number_of_shares': 20.0, 'price': 30.0}]
+    banned_user_matches: users that cannot be matched together. Pass in a
+    BannedPairIndex or an enumerable of pairs.
     e.g. set(('buyer_uuid', 'seller_uuid'), ('buyer2_uuid', 'seller2_uuid'))
+    solver: name of the assignment solver in SOLVERS used for the first matching.
+    max_workers: maximum number of processes to match securities in.
+    candidates_per_sell_order: if given, the first matching only considers this many
+    nearest buy orders per sell order, see build_nearest_cost_graph.
 
     Returns:
     Set of pairs of order IDs as matches.
@@ -24,106 +135,1083 @@ def match_buyers_and_sellers(buy_orders, sell_orders, banned_user_matches):
              ('buy_order2_uuid', 'sell_order2_uuid'))
     """
 
-    max_number_of_shares = max(o["number_of_shares"] for o in buy_orders + sell_orders)
-    buy_orders_copy = deepcopy(buy_orders)
-    sell_orders_copy = deepcopy(sell_orders)
+    partitions = partition_by_security(
+        MatchOrder.from_orders(buy_orders), MatchOrder.from_orders(sell_orders)
+    )
+    if len(partitions) == 0:
+        return set()
+
+    # Indexed once, since every security goes through it
+    banned_user_matches = BannedPairIndex.of(banned_user_matches)
+    tasks = [
+        (
+            buy_partition,
+            sell_partition,
+            banned_user_matches,
+            solver,
+            candidates_per_sell_order,
+        )
+        for buy_partition, sell_partition in partitions
+    ]
+    results = _run_tasks(match_security, tasks, max_workers)
+
+    return set().union(*results)
+
+
+def match_buyers_and_sellers_within_budget(
+    buy_orders,
+    sell_orders,
+    banned_user_matches,
+    time_budget,
+    max_workers=1,
+    candidates_per_sell_order=None,
+):
+    """
+    Approximate version of match_buyers_and_sellers, for rounds too large to be matched
+    exactly in time. The first matching of each security is improved with
+    solve_within_budget until its share of the budget runs out.
+
+    Params:
+    Same as match_buyers_and_sellers, except:
+    time_budget: seconds to spend on matching, shared between securities in proportion
+    to their number of orders.
+    candidates_per_sell_order: the first matching only considers this many nearest
+    buy orders per sell order, APPROXIMATE_CANDIDATES_PER_SELL_ORDER by default.
+
+    Returns:
+    (matches, gap): the set of pairs of order IDs as matches, and a MatchingGap bounding
+    how far the first matchings are from those of match_buyers_and_sellers.
+    """
+
+    partitions = partition_by_security(
+        MatchOrder.from_orders(buy_orders), MatchOrder.from_orders(sell_orders)
+    )
+    if len(partitions) == 0:
+        return set(), MatchingGap.total([])
+
+    banned_user_matches = BannedPairIndex.of(banned_user_matches)
+    number_of_orders = sum(len(b) + len(s) for b, s in partitions)
+    tasks = [
+        (
+            buy_partition,
+            sell_partition,
+            banned_user_matches,
+            time_budget * (len(buy_partition) + len(sell_partition)) / number_of_orders,
+            candidates_per_sell_order or APPROXIMATE_CANDIDATES_PER_SELL_ORDER,
+        )
+        for buy_partition, sell_partition in partitions
+    ]
+    results = _run_tasks(match_security_within_budget, tasks, max_workers)
+
+    return (
+        set().union(*[matches for matches, _gap in results]),
+        MatchingGap.total([gap for _matches, gap in results]),
+    )
+
+
+def _run_tasks(function, tasks, max_workers):
+    if len(tasks) == 1 or max_workers <= 1:
+        return [function(*task) for task in tasks]
+
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+        return list(executor.map(function, *zip(*tasks)))
+
+
+def partition_by_security(buy_orders, sell_orders):
+    """
+    Returns a list of (buy_orders, sell_orders) pairs, one per security, skipping
+    securities without both buy and sell orders.
+    """
+    partitions = {}
+    for index, orders in enumerate([buy_orders, sell_orders]):
+        for order in orders:
+            security_partition = partitions.setdefault(order.security_id, ([], []))
+            security_partition[index].append(order)
+
+    return [p for p in partitions.values() if len(p[0]) > 0 and len(p[1]) > 0]
+
+
+def count_candidate_pairs(buy_orders, sell_orders):
+    """
+    Returns the number of (buy order, sell order) pairs of the same security, which
+    bounds the size of the cost graphs of match_buyers_and_sellers.
+    """
+    return sum(
+        len(buy_partition) * len(sell_partition)
+        for buy_partition, sell_partition in partition_by_security(
+            MatchOrder.from_orders(buy_orders), MatchOrder.from_orders(sell_orders)
+        )
+    )
+
+
+def double_sell_orders(sell_orders):
+    """
+    Repeats the sell order of every seller with a single sell order, so that it can be
+    matched with two buy orders.
+    """
+    seller_counts = defaultdict(lambda: 0)
+    for sell_order in sell_orders:
+        seller_counts[sell_order.user_id] += 1
+
+    new_sell_orders = []
+    for sell_order in sell_orders:
+        new_sell_orders.append(sell_order)
+        if seller_counts[sell_order.user_id] == 1:
+            new_sell_orders.append(sell_order)
+
+    return new_sell_orders
+
+
+def match_security(
+    buy_orders,
+    sell_orders,
+    banned_user_matches,
+    solver,
+    candidates_per_sell_order=None,
+):
+    """
+    Matches orders of a single security.
+    """
+    max_number_of_shares = max(o.number_of_shares for o in buy_orders + sell_orders)
 
     first_iteration = match_seller_with_nearest_buyer(
-        buy_orders_copy, sell_orders_copy, banned_user_matches, max_number_of_shares
+        buy_orders,
+        sell_orders,
+        banned_user_matches,
+        max_number_of_shares,
+        solver=solver,
+        candidates_per_sell_order=candidates_per_sell_order,
     )
 
+    return _add_subsequent_matches(
+        buy_orders, sell_orders, banned_user_matches, first_iteration
+    )
+
+
+def match_security_within_budget(
+    buy_orders, sell_orders, banned_user_matches, time_budget, candidates_per_sell_order
+):
+    """
+    Matches orders of a single security, with an approximate first matching.
+
+    Returns:
+    (matches, gap) like match_buyers_and_sellers_within_budget.
+    """
+    # Building the costs counts towards the budget too
+    deadline = monotonic() + time_budget
+    max_number_of_shares = max(o.number_of_shares for o in buy_orders + sell_orders)
+
+    if candidates_per_sell_order >= len(buy_orders):
+        cost_graph = build_cost_graph(
+            buy_orders, sell_orders, banned_user_matches, max_number_of_shares
+        )
+        max_number_of_matches = None
+    else:
+        cost_graph = build_nearest_cost_graph(
+            buy_orders,
+            sell_orders,
+            banned_user_matches,
+            max_number_of_shares,
+            candidates_per_sell_order,
+        )
+        max_number_of_matches = count_possible_matches(buy_orders, sell_orders)
+    pairs, gap = solve_within_budget(cost_graph, deadline, max_number_of_matches)
+    first_iteration = {
+        (cost_graph.buy_order_ids[row], cost_graph.sell_order_ids[col])
+        for row, col in pairs
+    }
+
+    return (
+        _add_subsequent_matches(
+            buy_orders, sell_orders, banned_user_matches, first_iteration
+        ),
+        gap,
+    )
+
+
+def _add_subsequent_matches(
+    buy_orders, sell_orders, banned_user_matches, first_iteration
+):
     matched_buy_order_ids = {
         buy_order_id for buy_order_id in [p[0] for p in first_iteration]
     }
     remaining_buy_orders = []
-    for buy_order in buy_orders_copy:
-        if buy_order["id"] not in matched_buy_order_ids:
+    for buy_order in buy_orders:
+        if buy_order.id not in matched_buy_order_ids:
             remaining_buy_orders.append(buy_order)
 
     subsequent = distribute_remaining_buyers(
-        remaining_buy_orders, sell_orders_copy, banned_user_matches
+        remaining_buy_orders, sell_orders, banned_user_matches
     )
 
     return first_iteration | subsequent
 
 
 def match_seller_with_nearest_buyer(
-    buy_orders, sell_orders, banned_user_matches, max_number_of_shares
+    buy_orders,
+    sell_orders,
+    banned_user_matches,
+    max_number_of_shares,
+    solver,
+    candidates_per_sell_order=None,
 ):
-    def get_cost(buy_order, sell_order):
-        if buy_order["price"] < sell_order["price"] or (
-            (buy_order["user_id"], sell_order["user_id"]) in banned_user_matches
+    """
+    Matches each buy order to at most one sell order and vice versa, maximizing the
+    number of matches first and then minimizing their total cost.
+
+    With candidates_per_sell_order, only the nearest buy orders of each sell order are
+    considered. Their number is doubled until no match is lost compared to considering
+    every buy order, so the number of matches stays the same, but not always the cost.
+    """
+    if candidates_per_sell_order is not None:
+        max_number_of_matches = count_possible_matches(buy_orders, sell_orders)
+        prices_by_id = {o.id: o.price for o in sell_orders}
+        sell_prices = np.array([prices_by_id[i] for i in prices_by_id], dtype=float)
+
+    while True:
+        if candidates_per_sell_order is None or candidates_per_sell_order >= len(
+            buy_orders
         ):
-            return None
-        return abs(
-            buy_order["price"] - sell_order["price"]
-        ) * max_number_of_shares * 2 + abs(
-            buy_order["number_of_shares"] - sell_order["number_of_shares"]
+            cost_graph = build_cost_graph(
+                buy_orders, sell_orders, banned_user_matches, max_number_of_shares
+            )
+            break
+
+        cost_graph = build_nearest_cost_graph(
+            buy_orders,
+            sell_orders,
+            banned_user_matches,
+            max_number_of_shares,
+            candidates_per_sell_order,
         )
+        # Bans can make the possible matches fewer than counted, so the matching is
+        # then checked against every feasible pair
+        row_to_col = _match_maximum_number(cost_graph, sell_prices)
+        if (row_to_col >= 0).sum() >= max_number_of_matches or not (
+            _has_augmenting_path(
+                buy_orders, sell_orders, banned_user_matches, cost_graph, row_to_col
+            )
+        ):
+            break
+        candidates_per_sell_order *= 2
+
+    return {
+        (cost_graph.buy_order_ids[row], cost_graph.sell_order_ids[col])
+        for row, col in SOLVERS[solver](cost_graph)
+    }
+
+
+def count_possible_matches(buy_orders, sell_orders):
+    """
+    Returns the maximum number of matches between buy orders and sell orders, ignoring
+    bans, which can only lower it. Sell orders sharing an ID count once.
+    """
+    sell_prices = sorted({o.id: o.price for o in sell_orders}.values(), reverse=True)
+    buy_prices = sorted((o.price for o in buy_orders), reverse=True)
+
+    # From the highest price down, every buy order that can afford a sell order can
+    # also afford the next ones
+    number_of_matches = 0
+    number_of_affordable_buy_orders = 0
+    for sell_price in sell_prices:
+        while (
+            number_of_affordable_buy_orders < len(buy_prices)
+            and buy_prices[number_of_affordable_buy_orders] >= sell_price
+        ):
+            number_of_affordable_buy_orders += 1
+        if number_of_affordable_buy_orders > number_of_matches:
+            number_of_matches += 1
 
+    return number_of_matches
+
+
+def solve_with_networkx(cost_graph):
+    """
+    Reference solver: general-graph maximum weight matching (blossom algorithm).
+    """
     graph = nx.Graph()
-    for sell_order in sell_orders:
-        for buy_order in buy_orders:
-            cost = get_cost(buy_order, sell_order)
-            if cost is not None:
-                # Invert the cost, since the algorithm computes the maximum total instead of the
-                # minimum
-                graph.add_edge(buy_order["id"], sell_order["id"], weight=-cost)
+    for row, col, cost in zip(
+        cost_graph.rows.tolist(), cost_graph.cols.tolist(), cost_graph.costs.tolist()
+    ):
+        # Invert the cost, since the algorithm computes the maximum total instead of the
+        # minimum
+        graph.add_edge(
+            cost_graph.buy_order_ids[row], cost_graph.sell_order_ids[col], weight=-cost
+        )
 
     matching = max_weight_matching(graph, maxcardinality=True)
 
-    buy_order_ids = {buy_order["id"] for buy_order in buy_orders}
+    buy_order_index = {
+        order_id: row for row, order_id in enumerate(cost_graph.buy_order_ids)
+    }
+    sell_order_index = {
+        order_id: col for col, order_id in enumerate(cost_graph.sell_order_ids)
+    }
 
     result = set()
     for pair in matching:
-        buy_order_id = pair[0] if pair[0] in buy_order_ids else pair[1]
-        sell_order_id = pair[1] if pair[0] in buy_order_ids else pair[0]
-        result.add((buy_order_id, sell_order_id))
+        buy_order_id = pair[0] if pair[0] in buy_order_index else pair[1]
+        sell_order_id = pair[1] if pair[0] in buy_order_index else pair[0]
+        result.add((buy_order_index[buy_order_id], sell_order_index[sell_order_id]))
 
     return result
 
 
-def distribute_remaining_buyers(buy_orders, sell_orders, banned_user_matches):
+# Below this fraction of feasible pairs, or above this number of pairs, the bipartite
+# solver works on the sparse graph instead of a matrix of every pair
+SPARSE_SOLVER_MAX_DENSITY = 0.1
+DENSE_SOLVER_MAX_PAIRS = 2 ** 24
+
+
+def solve_bipartite(cost_graph):
     """
-    NOTE: Mutates buy_orders by removing those that are matched.
+    Rectangular min-cost assignment (Jonker-Volgenant) with maximum cardinality first.
+
+    Infeasible pairs are priced so that leaving one more order unmatched always costs
+    more than any achievable saving on the matched ones.
+    """
+    num_rows = len(cost_graph.buy_order_ids)
+    num_cols = len(cost_graph.sell_order_ids)
+    if len(cost_graph.costs) == 0:
+        return set()
+
+    # Normalize into [0, 1] to keep the big penalty within float precision
+    max_cost = cost_graph.costs.max()
+    costs = cost_graph.costs / max_cost if max_cost > 0 else cost_graph.costs * 0.0
+
+    if (
+        len(costs) >= SPARSE_SOLVER_MAX_DENSITY * num_rows * num_cols
+        and num_rows * num_cols <= DENSE_SOLVER_MAX_PAIRS
+    ):
+        rows, cols = _solve_dense(cost_graph, costs, num_rows, num_cols)
+    else:
+        rows, cols = _solve_sparse(cost_graph, costs, num_rows, num_cols)
+
+    return set(zip(rows.tolist(), cols.tolist()))
+
+
+def _solve_dense(cost_graph, costs, num_rows, num_cols):
+    unmatched_cost = min(num_rows, num_cols) + 1
+    matrix = np.full((num_rows, num_cols), float(unmatched_cost))
+    matrix[cost_graph.rows, cost_graph.cols] = costs
+
+    rows, cols = linear_sum_assignment(matrix)
+    # Costs are normalized into [0, 1], below the cost of infeasible pairs
+    is_feasible = matrix[rows, cols] < unmatched_cost
+    return rows[is_feasible], cols[is_feasible]
+
+
+def _solve_sparse(cost_graph, costs, num_rows, num_cols):
+    """
+    Solves a full matching on a square graph where every buy order and sell order can
+    be left unmatched through its own dummy partner, at a prohibitive cost.
+
+    Rows are buy orders followed by sell order dummies, columns are sell orders followed
+    by buy order dummies. Every real edge (b, s) has a mirror edge between the dummies
+    of s and b, so the dummies of a matched pair can always pair up.
+
+    The sparse solver loops forever on inexact float arithmetic, so weights are
+    quantized to integers small enough that every sum stays exact. They are also
+    shifted by one unit since the solver does not accept zero weights, which does not
+    change the optimum as every full matching has the same number of edges.
+    """
+    size = num_rows + num_cols
+    unmatched_cost = 2 * size + 1
+    unit = 2.0 ** min(20, 52 - int(np.ceil(np.log2(size * unmatched_cost))))
+    num_edges = len(costs)
+
+    buy_dummies = num_cols + np.arange(num_rows)
+    sell_dummies = num_rows + np.arange(num_cols)
+    matrix_rows = np.concatenate(
+        [
+            cost_graph.rows,
+            sell_dummies[cost_graph.cols],
+            np.arange(num_rows),
+            sell_dummies,
+        ]
+    )
+    matrix_cols = np.concatenate(
+        [
+            cost_graph.cols,
+            buy_dummies[cost_graph.rows],
+            buy_dummies,
+            np.arange(num_cols),
+        ]
+    )
+    weights = np.concatenate(
+        [
+            np.round(costs * unit) + unit,
+            np.full(num_edges, unit),
+            np.full(size, unmatched_cost * unit),
+        ]
+    )
+
+    matrix = coo_matrix((weights, (matrix_rows, matrix_cols)), shape=(size, size))
+    rows, cols = min_weight_full_bipartite_matching(matrix.tocsr())
+    is_real = (rows < num_rows) & (cols < num_cols)
+    return rows[is_real], cols[is_real]
+
+
+SOLVERS = {"bipartite": solve_bipartite, "networkx": solve_with_networkx}
+
+
+class MatchingGap(
+    namedtuple(
+        "MatchingGap",
+        ["number_of_matches", "max_number_of_matches", "cost", "min_cost"],
+    )
+):
+    """
+    Bounds how far an approximate first matching is from the exact one: the exact one
+    has at most max_number_of_matches matches, and costs at least min_cost.
     """
 
-    def cmp(sell_order, buy_order):
+    @classmethod
+    def total(cls, gaps):
+        """
+        Adds up the gaps of the first matchings of several securities.
+        """
+        return cls(*[sum(values) for values in zip(*gaps)] or [0, 0, 0.0, 0.0])
+
+    @property
+    def is_exact(self):
         return (
-            -buy_order["price"],  # most desperate: greatest price
-            abs(sell_order["number_of_shares"] - buy_order["number_of_shares"]),
+            self.number_of_matches == self.max_number_of_matches
+            and self.cost <= self.min_cost
+        )
+
+
+def solve_within_budget(cost_graph, deadline, max_number_of_matches=None):
+    """
+    Anytime solver with the same objective as SOLVERS, that returns its best matching
+    so far when monotonic() reaches deadline.
+
+    Starts from a greedy matching of the cheapest pairs, i.e. the nearest prices, then
+    adds matches along augmenting paths, then lowers the cost by swapping partners
+    between pairs.
+
+    If cost_graph only has the nearest pairs of each sell order, as built by
+    build_nearest_cost_graph, max_number_of_matches must bound the number of matches
+    with every feasible pair, for the gap to bound the exact matching.
+
+    Returns:
+    (set of (row, col) pairs, MatchingGap)
+    """
+    num_rows = len(cost_graph.buy_order_ids)
+    num_cols = len(cost_graph.sell_order_ids)
+    if len(cost_graph.costs) == 0:
+        return set(), MatchingGap.total([])
+
+    row_to_col = np.full(num_rows, -1)
+    col_to_row = np.full(num_cols, -1)
+    _match_greedily(cost_graph, row_to_col, col_to_row)
+    is_maximum = _augment_until(cost_graph, row_to_col, col_to_row, deadline)
+    if is_maximum:
+        _swap_until(cost_graph, row_to_col, col_to_row, deadline)
+
+    rows = np.flatnonzero(row_to_col >= 0)
+    pairs = set(zip(rows.tolist(), row_to_col[rows].tolist()))
+    return (
+        pairs,
+        _get_matching_gap(cost_graph, row_to_col, is_maximum, max_number_of_matches),
+    )
+
+
+def _match_greedily(cost_graph, row_to_col, col_to_row, edge_order=None):
+    """
+    Matches the edges in edge_order, by default from the cheapest, whenever both of
+    their orders are still unmatched.
+    """
+    if edge_order is None:
+        edge_order = np.argsort(cost_graph.costs, kind="stable")
+    row_cols = row_to_col.tolist()
+    col_rows = col_to_row.tolist()
+
+    for row, col in zip(
+        cost_graph.rows[edge_order].tolist(), cost_graph.cols[edge_order].tolist()
+    ):
+        if row_cols[row] < 0 and col_rows[col] < 0:
+            row_cols[row] = col
+            col_rows[col] = row
+
+    row_to_col[:] = row_cols
+    col_to_row[:] = col_rows
+
+
+def _augment_until(cost_graph, row_to_col, col_to_row, deadline):
+    """
+    Adds matches along shortest augmenting paths, found with a breadth-first search
+    from every unmatched row. Every search augments along as many paths as it found
+    that do not share a row, as in the Hopcroft-Karp algorithm.
+
+    Returns:
+    Whether the matching has the maximum number of matches.
+    """
+    order = np.argsort(cost_graph.rows, kind="stable")
+    starts = np.searchsorted(
+        cost_graph.rows[order], np.arange(len(row_to_col) + 1)
+    ).tolist()
+    cols_by_row = cost_graph.cols[order].tolist()
+    # Lists are much faster than arrays to index one item at a time
+    row_cols = row_to_col.tolist()
+    col_rows = col_to_row.tolist()
+
+    is_maximum = False
+    while monotonic() < deadline:
+        frontier = [row for row, col in enumerate(row_cols) if col < 0]
+        col_predecessors = {}
+        path_ends = []
+
+        while len(frontier) > 0 and len(path_ends) == 0:
+            next_frontier = []
+            for row in frontier:
+                for col in cols_by_row[starts[row] : starts[row + 1]]:
+                    if col in col_predecessors:
+                        continue
+                    col_predecessors[col] = row
+                    if col_rows[col] < 0:
+                        path_ends.append(col)
+                    else:
+                        next_frontier.append(col_rows[col])
+            frontier = next_frontier
+
+        if len(path_ends) == 0:
+            is_maximum = True
+            break
+
+        augmented_rows = set()
+        for path_end in path_ends:
+            path = []
+            col = path_end
+            while col >= 0:
+                row = col_predecessors[col]
+                if row in augmented_rows:
+                    break
+                path.append((row, col))
+                col = row_cols[row]
+            if col >= 0:
+                continue
+
+            for row, col in path:
+                augmented_rows.add(row)
+                row_cols[row] = col
+                col_rows[col] = row
+
+    row_to_col[:] = row_cols
+    col_to_row[:] = col_rows
+    return is_maximum
+
+
+def _swap_until(cost_graph, row_to_col, col_to_row, deadline):
+    """
+    Repeatedly applies the best non-overlapping moves that lower the cost without
+    losing a match: giving a row an unmatched column, giving a column an unmatched row,
+    or swapping the columns of two rows.
+    """
+    rows = cost_graph.rows
+    cols = cost_graph.cols
+    costs = cost_graph.costs
+    num_rows = len(row_to_col)
+    # Edges are ordered by column, then by row
+    edge_keys = cols * num_rows + rows
+    tolerance = 1e-9 * (1 + costs.max())
+
+    def find_costs(edge_rows, edge_cols):
+        keys = edge_cols * num_rows + edge_rows
+        positions = np.minimum(np.searchsorted(edge_keys, keys), len(edge_keys) - 1)
+        found = (edge_rows >= 0) & (edge_cols >= 0) & (edge_keys[positions] == keys)
+        return np.where(found, costs[positions], np.inf)
+
+    while monotonic() < deadline:
+        # Each edge (row, col) is a move that matches row with col, whose current
+        # partners other_col and other_row are then matched together if they both exist
+        other_cols = row_to_col[rows]
+        other_rows = col_to_row[cols]
+        current_costs = np.where(other_cols >= 0, find_costs(rows, other_cols), 0)
+        current_costs += np.where(other_rows >= 0, find_costs(other_rows, cols), 0)
+        new_costs = costs.copy()
+        is_swap = (other_cols >= 0) & (other_rows >= 0)
+        new_costs[is_swap] += find_costs(other_rows[is_swap], other_cols[is_swap])
+        # Matching an unmatched row with an unmatched column would add a match, which
+        # only augmenting paths do
+        is_move = (other_cols >= 0) | (other_rows >= 0)
+        gains = np.where(is_move & (other_rows != rows), current_costs - new_costs, 0)
+
+        candidates = np.flatnonzero(gains > tolerance)
+        if len(candidates) == 0:
+            return
+
+        touched_rows = set()
+        touched_cols = set()
+        for edge in candidates[np.argsort(-gains[candidates], kind="stable")].tolist():
+            row, col = rows[edge], cols[edge]
+            other_row, other_col = col_to_row[col], row_to_col[row]
+            move_rows = {row, other_row} - {-1}
+            move_cols = {col, other_col} - {-1}
+            if move_rows & touched_rows or move_cols & touched_cols:
+                continue
+            touched_rows |= move_rows
+            touched_cols |= move_cols
+
+            row_to_col[row] = col
+            col_to_row[col] = row
+            if other_row >= 0:
+                row_to_col[other_row] = other_col
+            if other_col >= 0:
+                col_to_row[other_col] = other_row
+
+
+def _get_matching_gap(cost_graph, row_to_col, is_maximum, max_number_of_matches):
+    rows = np.flatnonzero(row_to_col >= 0)
+    number_of_matches = len(rows)
+    cost = float(cost_graph.costs[row_to_col[cost_graph.rows] == cost_graph.cols].sum())
+    # Without every feasible pair, only the sell orders still have their cheapest pair
+    is_complete = max_number_of_matches is None
+
+    if not is_complete:
+        max_number_of_matches = max(max_number_of_matches, number_of_matches)
+    elif is_maximum:
+        max_number_of_matches = number_of_matches
+    else:
+        max_number_of_matches = min(
+            len(np.unique(cost_graph.rows)), len(np.unique(cost_graph.cols))
+        )
+
+    # The exact matching has at least as many matches, each costing at least the
+    # cheapest pair of its row, and of its column
+    col_minimums = np.full(len(cost_graph.sell_order_ids), np.inf)
+    np.minimum.at(col_minimums, cost_graph.cols, cost_graph.costs)
+    min_cost = np.sort(col_minimums)[:number_of_matches].sum()
+    if is_complete:
+        row_minimums = np.full(len(row_to_col), np.inf)
+        np.minimum.at(row_minimums, cost_graph.rows, cost_graph.costs)
+        min_cost = max(min_cost, np.sort(row_minimums)[:number_of_matches].sum())
+
+    return MatchingGap(
+        number_of_matches=number_of_matches,
+        max_number_of_matches=max_number_of_matches,
+        cost=cost,
+        min_cost=float(min_cost),
+    )
+
+
+class CostGraph:
+    """
+    Feasible edges between buy orders and sell orders, as parallel arrays.
+
+    `rows` index into `buy_order_ids`, `cols` index into `sell_order_ids`. Edges are
+    ordered by sell order first, then by buy order.
+    """
+
+    def __init__(self, buy_order_ids, sell_order_ids, rows, cols, costs):
+        self.buy_order_ids = buy_order_ids
+        self.sell_order_ids = sell_order_ids
+        self.rows = rows
+        self.cols = cols
+        self.costs = costs
+
+
+# Largest number of (buy order, sell order) pairs build_cost_graph computes the costs
+# of at once, which bounds its temporary arrays
+COST_GRAPH_BLOCK_PAIRS = 2 ** 22
+
+
+def build_cost_graph(
+    buy_orders, sell_orders, banned_user_matches, max_number_of_shares
+):
+    """
+    Computes the cost of every feasible (buy order, sell order) pair.
+
+    A pair is feasible if the buyer pays at least the seller's price and the users are
+    not banned from each other. The cost is the price gap, weighted so that it always
+    dominates, plus the difference in number of shares.
+
+    Pairs are computed for blocks of sell orders at a time, keeping only the feasible
+    ones, so that no array of every pair is built. Sell orders sharing an ID are
+    collapsed into one, keeping the last feasible edge to each buy order.
+    """
+
+    banned_user_matches = BannedPairIndex.of(banned_user_matches)
+    buy_prices = np.fromiter((o.price for o in buy_orders), float, len(buy_orders))
+    buy_shares = np.fromiter(
+        (o.number_of_shares for o in buy_orders), float, len(buy_orders)
+    )
+
+    sell_order_ids = list(dict.fromkeys(o.id for o in sell_orders))
+    cols_by_id = {order_id: col for col, order_id in enumerate(sell_order_ids)}
+    block_size = max(1, COST_GRAPH_BLOCK_PAIRS // max(1, len(buy_orders)))
+    rows = [np.array([], dtype=int)]
+    cols = [np.array([], dtype=int)]
+    costs = [np.array([])]
+    for start in range(0, len(sell_orders), block_size):
+        block = sell_orders[start : start + block_size]
+        sell_prices = np.fromiter((o.price for o in block), float, len(block))
+        sell_shares = np.fromiter(
+            (o.number_of_shares for o in block), float, len(block)
+        )
+
+        price_gaps = buy_prices[:, np.newaxis] - sell_prices[np.newaxis, :]
+        feasible = price_gaps >= 0
+        feasible &= ~banned_user_matches.mask(buy_orders, block)
+        block_rows, block_cols = np.nonzero(feasible)
+
+        rows.append(block_rows)
+        cols.append(np.array([cols_by_id[o.id] for o in block], dtype=int)[block_cols])
+        costs.append(
+            price_gaps[block_rows, block_cols] * max_number_of_shares * 2
+            + np.abs(buy_shares[block_rows] - sell_shares[block_cols])
         )
 
+    return _build_cost_graph_from_edges(
+        buy_orders,
+        sell_order_ids,
+        np.concatenate(rows),
+        np.concatenate(cols),
+        np.concatenate(costs),
+    )
+
+
+def _build_cost_graph_from_edges(buy_orders, sell_order_ids, rows, cols, costs):
+    # Orders edges by sell order, then buy order. Sell orders sharing an ID keep the
+    # last feasible edge to each buy order
+    keys = (cols * len(buy_orders) + rows)[::-1]
+    _keys, last_edges = np.unique(keys, return_index=True)
+    last_edges = len(keys) - 1 - last_edges
+
+    return CostGraph(
+        buy_order_ids=[o.id for o in buy_orders],
+        sell_order_ids=sell_order_ids,
+        rows=rows[last_edges],
+        cols=cols[last_edges],
+        costs=costs[last_edges],
+    )
+
+
+def _match_maximum_number(cost_graph, sell_prices):
+    """
+    Returns row_to_col of a maximum matching of the cost graph, regardless of costs.
+
+    Starts from the sell orders with the highest prices, each matched with its nearest
+    buy order, which leaves few augmenting paths to search for.
+    """
+    row_to_col = np.full(len(cost_graph.buy_order_ids), -1)
+    col_to_row = np.full(len(cost_graph.sell_order_ids), -1)
+    _match_greedily(
+        cost_graph,
+        row_to_col,
+        col_to_row,
+        edge_order=np.lexsort((cost_graph.costs, -sell_prices[cost_graph.cols])),
+    )
+    _augment_until(cost_graph, row_to_col, col_to_row, deadline=float("inf"))
+    return row_to_col
+
+
+def _has_augmenting_path(
+    buy_orders, sell_orders, banned_user_matches, cost_graph, row_to_col
+):
+    """
+    Returns whether a matching of the cost graph, built from some of the feasible
+    pairs of the orders, can be augmented with any feasible pair. A maximum matching
+    of the cost graph for which it cannot is a maximum matching of every feasible pair.
+
+    The feasible pairs are not built. From each sell order reached, the buy orders not
+    reached yet are taken by decreasing price, so that each is reached once, except
+    for those banned from it, which are set aside for the next sell orders.
+    """
+    banned_user_matches = BannedPairIndex.of(banned_user_matches)
+    sell_orders_by_id = {o.id: o for o in sell_orders}
+    sell_orders = [sell_orders_by_id[i] for i in cost_graph.sell_order_ids]
+    row_to_col = row_to_col.tolist()
+    rows_by_price = sorted(
+        range(len(buy_orders)), key=lambda row: buy_orders[row].price, reverse=True
+    )
+    next_position = 0
+    set_aside_rows = []
+
+    matched_cols = {col for col in row_to_col if col >= 0}
+    cols = deque(col for col in range(len(sell_orders)) if col not in matched_cols)
+    reached_cols = set(cols)
+    while len(cols) > 0:
+        sell_order = sell_orders[cols.popleft()]
+        candidate_rows = set_aside_rows
+        while (
+            next_position < len(rows_by_price)
+            and buy_orders[rows_by_price[next_position]].price >= sell_order.price
+        ):
+            candidate_rows.append(rows_by_price[next_position])
+            next_position += 1
+
+        set_aside_rows = []
+        for row in candidate_rows:
+            buy_order = buy_orders[row]
+            if (
+                buy_order.price < sell_order.price
+                or (buy_order.user_id, sell_order.user_id) in banned_user_matches
+            ):
+                set_aside_rows.append(row)
+                continue
+
+            col = row_to_col[row]
+            if col < 0:
+                return True
+            if col not in reached_cols:
+                reached_cols.add(col)
+                cols.append(col)
+
+    return False
+
+
+def build_nearest_cost_graph(
+    buy_orders,
+    sell_orders,
+    banned_user_matches,
+    max_number_of_shares,
+    candidates_per_sell_order,
+):
+    """
+    Same as build_cost_graph, but only keeps the candidates_per_sell_order cheapest
+    feasible pairs of each sell order, which have the nearest prices, then the nearest
+    numbers of shares. Buy orders are sorted by price once, so that the feasible ones
+    of each sell order are found by bisection and scanned from the nearest price up.
+
+    This keeps O(n * candidates_per_sell_order) pairs instead of O(n^2).
+    """
+
+    book = _BuyOrdersByPrice(buy_orders, banned_user_matches)
+
+    sell_order_ids = list(dict.fromkeys(o.id for o in sell_orders))
+    cols_by_id = {order_id: col for col, order_id in enumerate(sell_order_ids)}
+    rows = [np.array([], dtype=int)]
+    cols = [np.array([], dtype=int)]
+    costs = [np.array([])]
+    for sell_order in sell_orders:
+        sell_order_rows, sell_order_costs = book.find_nearest(
+            sell_order, max_number_of_shares, candidates_per_sell_order
+        )
+        rows.append(sell_order_rows)
+        cols.append(np.full(len(sell_order_rows), cols_by_id[sell_order.id]))
+        costs.append(sell_order_costs)
+
+    return _build_cost_graph_from_edges(
+        buy_orders,
+        sell_order_ids,
+        np.concatenate(rows),
+        np.concatenate(cols),
+        np.concatenate(costs),
+    )
+
+
+class _BuyOrdersByPrice:
+    """
+    Buy orders sorted by increasing price, to find the nearest ones of sell orders.
+    """
+
+    def __init__(self, buy_orders, banned_user_matches):
+        self.rows = np.array(
+            sorted(range(len(buy_orders)), key=lambda row: buy_orders[row].price),
+            dtype=int,
+        )
+        self.price_list = [buy_orders[row].price for row in self.rows.tolist()]
+        self.prices = np.array(self.price_list, dtype=float)
+        self.shares = np.fromiter(
+            (buy_orders[row].number_of_shares for row in self.rows.tolist()),
+            float,
+            len(buy_orders),
+        )
+        self.user_ids = [buy_orders[row].user_id for row in self.rows.tolist()]
+
+        self.banned_buyer_ids_by_seller = {}
+        for buyer_id, seller_id in BannedPairIndex.of(banned_user_matches):
+            self.banned_buyer_ids_by_seller.setdefault(seller_id, set()).add(buyer_id)
+
+    def find_nearest(self, sell_order, max_number_of_shares, number_of_candidates):
+        """
+        Returns (rows, costs) of the number_of_candidates cheapest buy orders that can
+        be matched with sell_order.
+
+        Buy orders are scanned from the lowest feasible price up, in windows doubling
+        in size, until the next price gap alone costs more than every candidate.
+        """
+        banned_buyer_ids = self.banned_buyer_ids_by_seller.get(sell_order.user_id, ())
+        start = bisect_left(self.price_list, sell_order.price)
+        positions = np.array([], dtype=int)
+        costs = np.array([])
+
+        window = number_of_candidates
+        while start < len(self.price_list):
+            end = min(start + window, len(self.price_list))
+            window_positions = np.arange(start, end)
+            if len(banned_buyer_ids) > 0:
+                window_positions = window_positions[
+                    np.fromiter(
+                        (u not in banned_buyer_ids for u in self.user_ids[start:end]),
+                        bool,
+                        end - start,
+                    )
+                ]
+            window_costs = (
+                self.prices[window_positions] - sell_order.price
+            ) * max_number_of_shares * 2 + np.abs(
+                self.shares[window_positions] - sell_order.number_of_shares
+            )
+
+            positions = np.concatenate([positions, window_positions])
+            costs = np.concatenate([costs, window_costs])
+            if len(costs) > number_of_candidates:
+                nearest = np.argpartition(costs, number_of_candidates - 1)[
+                    :number_of_candidates
+                ]
+                positions = positions[nearest]
+                costs = costs[nearest]
+
+            start = end
+            window *= 2
+            if (
+                len(costs) == number_of_candidates
+                and start < len(self.price_list)
+                and (self.price_list[start] - sell_order.price)
+                * max_number_of_shares
+                * 2
+                >= costs.max()
+            ):
+                break
+
+        return self.rows[positions], costs
+
+
+def _group_indices_by_user(orders):
+    indices = {}
+    for index, order in enumerate(orders):
+        indices.setdefault(order.user_id, []).append(index)
+    return indices
+
+
+def distribute_remaining_buyers(buy_orders, sell_orders, banned_user_matches):
+    """
+    Repeatedly gives every sell order, from the most to the least desperate, the most
+    desperate buy order it can be matched with: the one with the greatest price, then
+    the nearest number of shares.
+
+    NOTE: Mutates buy_orders by removing those that are matched.
+    """
+
+    banned_user_matches = BannedPairIndex.of(banned_user_matches)
+    book = _BuyOrderBook(buy_orders)
     result = set()
 
     # Sort by most --> least desperate: increasing price, then decreasing number of shares
     sorted_sell_orders = sorted(
-        sell_orders, key=lambda o: (o["price"], -o["number_of_shares"])
+        sell_orders, key=lambda o: (o.price, -o.number_of_shares)
     )
 
     while len(sorted_sell_orders) > 0:
-        unmatched_sell_orders = []
-
-        for sell_order in sorted_sell_orders:
-            eligible_buy_orders = [
-                buy_order
-                for buy_order in buy_orders
-                if (buy_order["price"] >= sell_order["price"])
-                and (
-                    (buy_order["user_id"], sell_order["user_id"])
-                    not in banned_user_matches
-                )
-            ]
+        unmatched_sell_order_indices = set()
 
-            if len(eligible_buy_orders) == 0:
-                unmatched_sell_orders.append(sell_order)
+        for index, sell_order in enumerate(sorted_sell_orders):
+            buy_order = book.pop_most_desperate(
+                sell_order,
+                is_allowed=lambda buy_order: (
+                    (buy_order.user_id, sell_order.user_id) not in banned_user_matches
+                ),
+            )
+
+            if buy_order is None:
+                unmatched_sell_order_indices.add(index)
                 continue
 
-            buy_order = min(eligible_buy_orders, key=lambda o: cmp(sell_order, o))
-            result.add((buy_order["id"], sell_order["id"]))
-            buy_orders.remove(buy_order)
+            result.add((buy_order.id, sell_order.id))
+
+        # A sell order without eligible buy orders will never have any, since buy orders
+        # are only ever removed
+        sorted_sell_orders = [
+            sell_order
+            for index, sell_order in enumerate(sorted_sell_orders)
+            if index not in unmatched_sell_order_indices
+        ]
 
-        for sell_order in unmatched_sell_orders:
-            sorted_sell_orders.remove(sell_order)
+    remaining_indices = book.remaining_indices()
+    buy_orders[:] = [buy_orders[index] for index in remaining_indices]
 
     return result
+
+
+class _BuyOrderBook:
+    """
+    Buy orders grouped into price levels, each sorted by number of shares.
+
+    The levels a sell order can be matched with are a suffix of the sorted prices, and
+    the nearest number of shares within a level is found by bisection. Ties are broken
+    by position in the original list of buy orders.
+    """
+
+    def __init__(self, buy_orders):
+        self.buy_orders = buy_orders
+        self.levels = {}
+        for index, buy_order in enumerate(buy_orders):
+            self.levels.setdefault(buy_order.price, []).append(
+                (buy_order.number_of_shares, index)
+            )
+        for level in self.levels.values():
+            level.sort()
+        self.prices = sorted(self.levels)
+
+    def pop_most_desperate(self, sell_order, is_allowed):
+        first_eligible = bisect_left(self.prices, sell_order.price)
+        for price_index in range(len(self.prices) - 1, first_eligible - 1, -1):
+            price = self.prices[price_index]
+            level = self.levels[price]
+
+            position = self._find_nearest(
+                level, sell_order.number_of_shares, is_allowed
+            )
+            if position is None:
+                continue
+
+            _number_of_shares, index = level.pop(position)
+            if len(level) == 0:
+                del self.levels[price]
+                del self.prices[price_index]
+            return self.buy_orders[index]
+
+        return None
+
+    def remaining_indices(self):
+        return sorted(index for level in self.levels.values() for _, index in level)
+
+    def _find_nearest(self, level, number_of_shares, is_allowed):
+        """
+        Returns the position in level of the allowed buy order with the nearest number
+        of shares, or None.
+        """
+        right = bisect_left(level, (number_of_shares, -1))
+        left = right - 1
+
+        while left >= 0 or right < len(level):
+            left_distance = (
+                number_of_shares - level[left][0] if left >= 0 else float("inf")
+            )
+            right_distance = (
+                level[right][0] - number_of_shares
+                if right < len(level)
+                else float("inf")
+            )
+            distance = min(left_distance, right_distance)
+
+            # Every buy order at this distance, on either side
+            candidates = []
+            while left >= 0 and number_of_shares - level[left][0] == distance:
+                candidates.append(left)
+                left -= 1
+            while right < len(level) and level[right][0] - number_of_shares == distance:
+                candidates.append(right)
+                right += 1
+
+            allowed = [
+                position
+                for position in candidates
+                if is_allowed(self.buy_orders[level[position][1]])
+            ]
+            if len(allowed) > 0:
+                return min(allowed, key=lambda position: level[position][1])
+
+        return None
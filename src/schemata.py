@@ -70,6 +70,14 @@ GET_CHATS_BY_USER_ID_SCHEMA = {
     "as_buyer": {"type": "boolean"},
     "as_seller": {"type": "boolean"},
 }
+GET_CHATS_SINCE_SCHEMA = {**GET_CHATS_BY_USER_ID_SCHEMA, "since": {"type": "string"}}
+GET_CHAT_HISTORY_SCHEMA = {
+    "user_id": UUID_RULE,
+    "chat_room_id": UUID_RULE,
+    "before": {"type": "string", "required": False, "nullable": True},
+    "after": {"type": "string", "required": False, "nullable": True},
+    "limit": {"type": "integer", "min": 1, "required": False, "nullable": True},
+}
 CREATE_NEW_MESSAGE_SCHEMA = {
     "chat_room_id": UUID_RULE,
     "author_id": UUID_RULE,
@@ -1,15 +1,27 @@
+import base64
+import hashlib
+import logging
+import threading
+import uuid
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
 import requests
+from sqlalchemy import String, and_, cast, event, exists, or_, select, tuple_
+from sqlalchemy.orm import aliased
 from sqlalchemy.sql import func
 
+from src.cache import LRUCache
+from src.config import APP_CONFIG
 from src.database import (
     BannedPair,
     BuyOrder,
     Chat,
     ChatRoom,
+    EmailBatch,
     Match,
+    MatchJob,
     Offer,
     OfferResponse,
     Round,
@@ -18,6 +30,7 @@ from src.database import (
     User,
     UserChatRoomAssociation,
     UserRequest,
+    async_engine,
     session_scope,
 )
 from src.email_service import EmailService
@@ -29,7 +42,15 @@ from src.exceptions import (
     UnauthorizedException,
     UserProfileNotFoundException,
 )
-from src.match import match_buyers_and_sellers
+from src.executor import offload, service_executor
+from src.match import (
+    BannedPairIndex,
+    MatchOrder,
+    count_candidate_pairs,
+    double_sell_orders,
+    match_buyers_and_sellers,
+    match_buyers_and_sellers_within_budget,
+)
 from src.schemata import (
     AUTHENTICATE_SCHEMA,
     CREATE_BUY_ORDER_SCHEMA,
@@ -41,11 +62,37 @@ from src.schemata import (
     EDIT_OFFER_STATUS_SCHEMA,
     EDIT_ORDER_SCHEMA,
     GET_AUTH_URL_SHCMEA,
+    GET_CHAT_HISTORY_SCHEMA,
     GET_CHATS_BY_USER_ID_SCHEMA,
+    GET_CHATS_SINCE_SCHEMA,
     UUID_RULE,
     validate_input,
 )
-from src.utils import EMAIL_STRFTIME_FORMAT
+from src.utils import EMAIL_STRFTIME_FORMAT, generate_friendly_name
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of rows inserted by a single statement
+BULK_INSERT_CHUNK_SIZE = 5000
+
+# Users resolved from bearer tokens. Shared by every service, so that a change to a
+# user is seen by all of them.
+auth_cache = LRUCache(
+    APP_CONFIG["ACQUITY_AUTH_CACHE_SIZE"], ttl=APP_CONFIG["ACQUITY_AUTH_CACHE_TTL"]
+)
+
+
+def invalidate_cached_user(session, user_id):
+    """
+    Evicts the user from auth_cache once session commits. Evicting it before then
+    would let a concurrent request cache the user as it was before the change.
+    """
+    event.listen(
+        session,
+        "after_commit",
+        lambda session: auth_cache.evict(lambda user: user["id"] == user_id),
+        once=True,
+    )
 
 
 class UserService:
@@ -101,6 +148,7 @@ class UserService:
                 user.display_image_url = display_image_url
                 user.auth_token = auth_token
 
+            invalidate_cached_user(session, str(user.id))
             session.commit()
             return user.asdict()
 
@@ -116,6 +164,45 @@ class UserService:
             user_dict = user.asdict()
         return user_dict
 
+    async def get_user_by_linkedin_id_async(self, provider_user_id):
+        """
+        Same as get_user_by_linkedin_id, but waits for the database on the event loop.
+        """
+
+        def has_open_request(is_buy):
+            return exists().where(
+                and_(
+                    UserRequest.user_id == User.id,
+                    UserRequest.closed_by_user_id == None,
+                    UserRequest.is_buy == is_buy,
+                )
+            )
+
+        user = await async_engine.execute_one_or_none(
+            select(
+                [
+                    User.__table__,
+                    has_open_request(True).label("has_buy_request"),
+                    has_open_request(False).label("has_sell_request"),
+                ]
+            ).where(User.provider_user_id == provider_user_id)
+        )
+        if user is None:
+            raise ResourceNotFoundException()
+
+        for col, has_request in [
+            ("can_buy", user.pop("has_buy_request")),
+            ("can_sell", user.pop("has_sell_request")),
+        ]:
+            if user[col]:
+                user[col] = "YES"
+            elif has_request:
+                user[col] = "UNAPPROVED"
+            else:
+                user[col] = "NO"
+        user["auth_token"] = None
+        return user
+
     def send_email_to_approved_users(self, template, to_buyers, to_sellers, **kwargs):
         with session_scope() as session:
             if to_sellers:
@@ -141,6 +228,12 @@ class UserService:
                 'buyers': session.query(User).filter_by(can_buy=True).count()
             }
 
+    def get_executor_stats(self, subject_id):
+        with session_scope() as session:
+            if not session.query(User).get(subject_id).is_committee:
+                raise InvisibleUnauthorizedException("Not committee")
+        return service_executor.get_stats()
+
 
 class SellOrderService:
     def __init__(self, config):
@@ -202,6 +295,25 @@ class SellOrderService:
             )
             return [sell_order.asdict() for sell_order in sell_orders]
 
+    @validate_input({"user_id": UUID_RULE})
+    async def get_orders_by_user_in_current_round_async(self, user_id):
+        """
+        Same as get_orders_by_user_in_current_round, but waits for the database on the
+        event loop.
+        """
+        current_round = await RoundService(self.config).get_active_async()
+        return await async_engine.execute(
+            select([SellOrder.__table__, Security.name.label("security_name")])
+            .select_from(SellOrder.__table__.join(Security.__table__))
+            .where(
+                and_(
+                    SellOrder.user_id == user_id,
+                    (SellOrder.round_id == (current_round and current_round["id"]))
+                    | (SellOrder.round_id == None),
+                )
+            )
+        )
+
     @validate_input({"id": UUID_RULE, "user_id": UUID_RULE})
     def get_order_by_id(self, id, user_id):
         with session_scope() as session:
@@ -302,6 +414,25 @@ class BuyOrderService:
             )
             return [buy_order.asdict() for buy_order in buy_orders]
 
+    @validate_input({"user_id": UUID_RULE})
+    async def get_orders_by_user_in_current_round_async(self, user_id):
+        """
+        Same as get_orders_by_user_in_current_round, but waits for the database on the
+        event loop.
+        """
+        current_round = await RoundService(self.config).get_active_async()
+        return await async_engine.execute(
+            select([BuyOrder.__table__, Security.name.label("security_name")])
+            .select_from(BuyOrder.__table__.join(Security.__table__))
+            .where(
+                and_(
+                    BuyOrder.user_id == user_id,
+                    (BuyOrder.round_id == (current_round and current_round["id"]))
+                    | (BuyOrder.round_id == None),
+                )
+            )
+        )
+
     @validate_input({"id": UUID_RULE, "user_id": UUID_RULE})
     def get_order_by_id(self, id, user_id):
         with session_scope() as session:
@@ -356,6 +487,9 @@ class SecurityService:
         with session_scope() as session:
             return [sec.asdict() for sec in session.query(Security).all()]
 
+    async def get_all_async(self):
+        return await async_engine.execute(select([Security.__table__]))
+
     @validate_input(EDIT_MARKET_PRICE_SCHEMA)
     def edit_market_price(self, id, subject_id, market_price):
         with session_scope() as session:
@@ -383,6 +517,9 @@ class RoundService:
         with session_scope() as session:
             return [r.asdict() for r in session.query(Round).all()]
 
+    async def get_all_async(self):
+        return await async_engine.execute(select([Round.__table__]))
+
     def get_active(self):
         with session_scope() as session:
             active_round = (
@@ -392,6 +529,13 @@ class RoundService:
             )
             return active_round and active_round.asdict()
 
+    async def get_active_async(self):
+        return await async_engine.execute_one_or_none(
+            select([Round.__table__]).where(
+                and_(Round.end_time >= datetime.now(), Round.is_concluded == False)
+            )
+        )
+
     def get_stats(self):
         with session_scope() as session:
             sell_orders = session.query(SellOrder.number_of_shares, SellOrder.price).join(Round).filter(Round.end_time >= datetime.now(), Round.is_concluded == False).all()
@@ -461,6 +605,9 @@ class RoundService:
             session.add(new_round)
             session.flush()
 
+            # Picked up by the matching worker when the round ends
+            session.add(MatchJob(round_id=str(new_round.id), run_at=end_time))
+
             for sell_order in session.query(SellOrder).filter_by(round_id=None):
                 sell_order.round_id = str(new_round.id)
             for buy_order in session.query(BuyOrder).filter_by(round_id=None):
@@ -498,9 +645,6 @@ class RoundService:
                 run_date=end_time
                 - self.config["ACQUITY_ROUND_CLOSING_REMINDER_BEFORE_END_TIME"],
             )
-            scheduler.add_job(
-                MatchService(self.config).run_matches, "date", run_date=end_time
-            )
 
     def send_round_closing_soon_emails(self):
         singapore_timezone = timezone(timedelta(hours=8))
@@ -533,62 +677,305 @@ class MatchService:
     def __init__(self, config):
         self.config = config
         self.email_service = EmailService(config)
+        self.preview_cache = LRUCache(
+            maxsize=config["ACQUITY_MATCH_PREVIEW_CACHE_SIZE"]
+        )
+
+    def run_matches(self, round_id=None, report_progress=lambda stage: None):
+        """
+        Matches the orders of a round, defaulting to the latest round, and concludes it.
+        Does nothing if the round is already concluded. Rounds with too many orders to
+        be matched exactly in time are matched approximately.
 
-    def run_matches(self):
+        report_progress is called with the name of each stage as it starts.
+        """
         with session_scope() as session:
-            round_id = str(
-                session.query(Round).order_by(Round.created_at.desc()).first().id
-            )
+            if round_id is None:
+                round = session.query(Round).order_by(Round.created_at.desc()).first()
+            else:
+                round = session.query(Round).get(round_id)
+            if round.is_concluded:
+                return
+            round_id = str(round.id)
+
+        report_progress("LOADING_ORDERS")
         buy_orders, sell_orders, banned_pairs = self._get_matching_params(round_id)
 
-        match_results = match_buyers_and_sellers(buy_orders, sell_orders, banned_pairs)
+        report_progress("MATCHING")
+        match_results = self._match_orders(
+            round_id, buy_orders, sell_orders, banned_pairs
+        )
 
-        buy_order_to_buyer_dict = {
-            order["id"]: order["user_id"] for order in buy_orders
-        }
-        sell_order_to_seller_dict = {
-            order["id"]: order["user_id"] for order in sell_orders
-        }
+        buy_order_to_buyer_dict = {order.id: order.user_id for order in buy_orders}
+        sell_order_to_seller_dict = {order.id: order.user_id for order in sell_orders}
 
-        self._add_db_objects(
+        report_progress("SAVING_MATCHES")
+        if not self._add_db_objects(
             round_id, match_results, sell_order_to_seller_dict, buy_order_to_buyer_dict
+        ):
+            return
+
+        report_progress("SENDING_EMAILS")
+        self._send_emails(round_id)
+
+    def _match_orders(
+        self, round_id, buy_orders, sell_orders, banned_pairs, is_preview=False
+    ):
+        # Previews run in the web server, in a single process and within their own
+        # shorter time budget
+        max_workers = 1 if is_preview else self.config["ACQUITY_MATCHING_MAX_WORKERS"]
+        if (
+            count_candidate_pairs(buy_orders, sell_orders)
+            > self.config["ACQUITY_MATCHING_APPROXIMATE_MIN_PAIRS"]
+        ):
+            match_results, gap = match_buyers_and_sellers_within_budget(
+                buy_orders,
+                sell_orders,
+                banned_pairs,
+                time_budget=self.config[
+                    "ACQUITY_MATCH_PREVIEW_TIME_BUDGET"
+                    if is_preview
+                    else "ACQUITY_MATCHING_TIME_BUDGET"
+                ],
+                max_workers=max_workers,
+                candidates_per_sell_order=self.config[
+                    "ACQUITY_MATCHING_CANDIDATES_PER_SELL_ORDER"
+                ],
+            )
+            if not is_preview:
+                logger.warning("Round %s was matched approximately: %s", round_id, gap)
+            return match_results
+
+        return match_buyers_and_sellers(
+            buy_orders,
+            sell_orders,
+            banned_pairs,
+            solver=self.config["ACQUITY_MATCHING_SOLVER"],
+            max_workers=max_workers,
+            candidates_per_sell_order=self.config[
+                "ACQUITY_MATCHING_CANDIDATES_PER_SELL_ORDER"
+            ],
         )
-        self._send_emails(buy_orders, sell_orders, match_results)
 
-    def _get_matching_params(self, round_id):
+    @validate_input({"subject_id": UUID_RULE})
+    def preview_matches(self, subject_id):
+        """
+        Matches the orders of the active round like run_matches, without saving or
+        sending anything. The preview is then the matching that run_matches would
+        write for the current orders, except for rounds matched approximately, whose
+        matching depends on how far the time budget goes. Those are previewed within
+        ACQUITY_MATCH_PREVIEW_TIME_BUDGET instead, and every preview is matched in a
+        single process, since it runs in the web server.
+
+        The preview is cached until the orders of the round, the bans between its
+        users or the matching settings change.
+        """
         with session_scope() as session:
-            buy_orders = [
-                b.asdict()
-                for b in session.query(BuyOrder)
-                .join(User, User.id == BuyOrder.user_id)
-                .filter(BuyOrder.round_id == round_id, User.can_buy)
-                .all()
-            ]
-            sell_orders = [
-                s.asdict()
-                for s in session.query(SellOrder)
-                .join(User, User.id == SellOrder.user_id)
-                .filter(SellOrder.round_id == round_id, User.can_sell)
-                .all()
-            ]
-            banned_pairs = [
-                (bp.buyer_id, bp.seller_id) for bp in session.query(BannedPair).all()
-            ]
+            if not session.query(User).get(subject_id).is_committee:
+                raise InvisibleUnauthorizedException("Not committee")
+
+        active_round = RoundService(self.config).get_active()
+        if active_round is None:
+            raise ResourceNotFoundException("There is no active round")
+        round_id = active_round["id"]
+
+        buy_orders, sell_orders, banned_pairs = self._get_matching_params(round_id)
+        fingerprint = self._get_fingerprint(
+            round_id, buy_orders, sell_orders, banned_pairs
+        )
 
-        return buy_orders, self._double_sell_orders(sell_orders), banned_pairs
+        preview = self.preview_cache.get(fingerprint)
+        if preview is None:
+            match_results = self._match_orders(
+                round_id, buy_orders, sell_orders, banned_pairs, is_preview=True
+            )
+            matched_buy_order_ids = {m[0] for m in match_results}
+            matched_sell_order_ids = {m[1] for m in match_results}
+
+            preview = {
+                "round_id": round_id,
+                "matches": [
+                    {"buy_order_id": buy_order_id, "sell_order_id": sell_order_id}
+                    for buy_order_id, sell_order_id in sorted(match_results)
+                ],
+                "unmatched_buy_order_ids": sorted(
+                    {o.id for o in buy_orders} - matched_buy_order_ids
+                ),
+                "unmatched_sell_order_ids": sorted(
+                    {o.id for o in sell_orders} - matched_sell_order_ids
+                ),
+            }
+            self.preview_cache.set(fingerprint, preview)
+
+        return preview
+
+    def _get_fingerprint(self, round_id, buy_orders, sell_orders, banned_pairs):
+        fingerprint = hashlib.sha256()
+        for part in [
+            round_id,
+            self.config["ACQUITY_MATCHING_SOLVER"],
+            self.config["ACQUITY_MATCHING_CANDIDATES_PER_SELL_ORDER"],
+            self.config["ACQUITY_MATCHING_APPROXIMATE_MIN_PAIRS"],
+            self.config["ACQUITY_MATCH_PREVIEW_TIME_BUDGET"],
+            sorted(buy_orders),
+            sorted(sell_orders),
+            sorted(banned_pairs),
+        ]:
+            fingerprint.update(repr(part).encode())
+        return fingerprint.hexdigest()
+
+    def run_next_job(self):
+        """
+        Runs the earliest due match job, if any. Jobs are claimed with SKIP LOCKED, so
+        that several workers never run the same job, and their heartbeat is renewed
+        while they run. A running job whose heartbeat stops, e.g. because its worker
+        died, is taken over once ACQUITY_MATCHING_JOB_LEASE has passed, until it has
+        been tried ACQUITY_MATCHING_JOB_MAX_ATTEMPTS times.
+
+        Returns:
+        Whether a job was claimed.
+        """
+        lease = timedelta(seconds=self.config["ACQUITY_MATCHING_JOB_LEASE"])
+        with session_scope() as session:
+            job = (
+                session.query(MatchJob)
+                .filter(
+                    MatchJob.run_at <= func.now(),
+                    or_(
+                        MatchJob.status == "PENDING",
+                        and_(
+                            MatchJob.status == "RUNNING",
+                            or_(
+                                MatchJob.heartbeat_at.is_(None),
+                                MatchJob.heartbeat_at <= func.now() - lease,
+                            ),
+                        ),
+                    ),
+                )
+                .order_by(MatchJob.run_at)
+                .with_for_update(skip_locked=True)
+                .first()
+            )
+            if job is None:
+                return False
+            if job.attempts >= self.config["ACQUITY_MATCHING_JOB_MAX_ATTEMPTS"]:
+                job.status = "FAILED"
+                job.error = f"Stopped after {job.attempts} attempts"
+                return True
 
-    def _double_sell_orders(self, sell_orders):
-        seller_counts = defaultdict(lambda: 0)
-        for sell_order in sell_orders:
-            seller_counts[sell_order["user_id"]] += 1
+            job.status = "RUNNING"
+            job.attempts += 1
+            job.heartbeat_at = func.now()
+            job_id = str(job.id)
+            round_id = job.round_id
+
+        def report_progress(stage):
+            with session_scope() as session:
+                session.query(MatchJob).get(job_id).stage = stage
+
+        stop_heartbeat = threading.Event()
+
+        def beat():
+            while not stop_heartbeat.wait(lease.total_seconds() / 3):
+                try:
+                    with session_scope() as session:
+                        session.query(MatchJob).get(job_id).heartbeat_at = func.now()
+                except Exception:
+                    logger.exception(
+                        "Could not renew the lease of match job %s", job_id
+                    )
+
+        heartbeat = threading.Thread(target=beat, daemon=True)
+        heartbeat.start()
+        try:
+            self.run_matches(round_id=round_id, report_progress=report_progress)
+        except Exception as e:
+            with session_scope() as session:
+                job = session.query(MatchJob).get(job_id)
+                job.status = "FAILED"
+                job.error = repr(e)
+            raise
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
 
-        new_sell_orders = []
-        for sell_order in sell_orders:
-            new_sell_orders.append(sell_order)
-            if seller_counts[sell_order["user_id"]] == 1:
-                new_sell_orders.append(sell_order)
+        with session_scope() as session:
+            job = session.query(MatchJob).get(job_id)
+            job.status = "DONE"
+            job.stage = None
+        return True
+
+    @validate_input({"round_id": UUID_RULE, "subject_id": UUID_RULE})
+    def get_job(self, round_id, subject_id):
+        """
+        Returns the status and stage of the match job of a round. The error of a
+        failed job is left out, as it can contain details of the orders.
+        """
+        with session_scope() as session:
+            if not session.query(User).get(subject_id).is_committee:
+                raise InvisibleUnauthorizedException("Not committee")
 
-        return new_sell_orders
+            job = session.query(MatchJob).filter_by(round_id=round_id).one_or_none()
+            if job is None:
+                raise ResourceNotFoundException()
+            return {k: v for k, v in job.asdict().items() if k != "error"}
+
+    def _get_matching_params(self, round_id):
+        with session_scope() as session:
+            buy_orders = self._get_match_orders(
+                session, BuyOrder, round_id, User.can_buy
+            )
+            sell_orders = self._get_match_orders(
+                session, SellOrder, round_id, User.can_sell
+            )
+            banned_pairs = self._get_banned_pairs(session, round_id)
+
+        return buy_orders, double_sell_orders(sell_orders), banned_pairs
+
+    @staticmethod
+    def _get_match_orders(session, order_model, round_id, can_trade):
+        # Core SQL streamed from a server-side cursor skips building ORM rows. Order IDs
+        # are cast to text by the database rather than converted from UUIDs here.
+        query = (
+            select(
+                [
+                    cast(order_model.id, String),
+                    order_model.user_id,
+                    order_model.security_id,
+                    order_model.price,
+                    order_model.number_of_shares,
+                ]
+            )
+            .select_from(
+                order_model.__table__.join(
+                    User.__table__, User.id == order_model.user_id
+                )
+            )
+            .where(and_(order_model.round_id == round_id, can_trade))
+            # Optimal matchings tie often, and solvers break ties by the order of
+            # their input, so it is kept the same for previews and runs
+            .order_by(order_model.id)
+            .execution_options(stream_results=True)
+        )
+        return [MatchOrder._make(row) for row in session.execute(query)]
+
+    @staticmethod
+    def _get_banned_pairs(session, round_id):
+        # Only bans between a buyer and a seller of this round can affect its matching
+        return BannedPairIndex(
+            session.query(BannedPair.buyer_id, BannedPair.seller_id).filter(
+                BannedPair.buyer_id.in_(
+                    session.query(BuyOrder.user_id).filter(
+                        BuyOrder.round_id == round_id
+                    )
+                ),
+                BannedPair.seller_id.in_(
+                    session.query(SellOrder.user_id).filter(
+                        SellOrder.round_id == round_id
+                    )
+                ),
+            )
+        )
 
     def _add_db_objects(
         self,
@@ -597,80 +984,201 @@ class MatchService:
         sell_order_to_seller_dict,
         buy_order_to_buyer_dict,
     ):
+        # IDs are generated here so that every row can be inserted in bulk
+        matches = []
+        chat_rooms = []
+        user_chat_room_associations = []
+        for buy_order_id, sell_order_id in match_results:
+            match_id = uuid.uuid4()
+            chat_room_id = uuid.uuid4()
+
+            matches.append(
+                {
+                    "id": match_id,
+                    "buy_order_id": buy_order_id,
+                    "sell_order_id": sell_order_id,
+                }
+            )
+            chat_rooms.append(
+                {
+                    "id": chat_room_id,
+                    "match_id": str(match_id),
+                    "friendly_name": generate_friendly_name(),
+                }
+            )
+            user_chat_room_associations += [
+                {
+                    "id": uuid.uuid4(),
+                    "user_id": buy_order_to_buyer_dict[buy_order_id],
+                    "chat_room_id": str(chat_room_id),
+                    "role": "BUYER",
+                },
+                {
+                    "id": uuid.uuid4(),
+                    "user_id": sell_order_to_seller_dict[sell_order_id],
+                    "chat_room_id": str(chat_room_id),
+                    "role": "SELLER",
+                },
+            ]
+
         with session_scope() as session:
-            for buy_order_id, sell_order_id in match_results:
-                match = Match(buy_order_id=buy_order_id, sell_order_id=sell_order_id)
-                session.add(match)
-                session.flush()
+            # Locked so that a concurrent run of the same round waits, then skips it
+            round = (
+                session.query(Round)
+                .filter(Round.id == round_id)
+                .with_for_update()
+                .one()
+            )
+            if round.is_concluded:
+                return False
 
-                chat_room = ChatRoom(match_id=str(match.id))
-                session.add(chat_room)
-                session.flush()
+            self._insert_rows(session, Match, matches)
+            self._insert_rows(session, ChatRoom, chat_rooms)
+            self._insert_rows(
+                session, UserChatRoomAssociation, user_chat_room_associations
+            )
 
-                buyer_assoc = UserChatRoomAssociation(
-                    user_id=buy_order_to_buyer_dict[buy_order_id],
-                    chat_room_id=str(chat_room.id),
-                    role="BUYER",
-                )
-                seller_assoc = UserChatRoomAssociation(
-                    user_id=sell_order_to_seller_dict[sell_order_id],
-                    chat_room_id=str(chat_room.id),
-                    role="SELLER",
+            self._queue_emails(
+                session,
+                round_id,
+                match_results,
+                sell_order_to_seller_dict,
+                buy_order_to_buyer_dict,
+            )
+
+            round.is_concluded = True
+        return True
+
+    @staticmethod
+    def _insert_rows(session, model, rows):
+        # Multi-row INSERTs, split to bound the size of each statement
+        for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+            session.execute(
+                model.__table__.insert().values(
+                    rows[start : start + BULK_INSERT_CHUNK_SIZE]
                 )
-                session.add_all([buyer_assoc, seller_assoc])
-
-            session.query(Round).get(round_id).is_concluded = True
-
-    def _send_emails(self, buy_orders, sell_orders, match_results):
-        matched_uuids = set()
-        for buy_order_uuid, sell_order_uuid in match_results:
-            matched_uuids.add(buy_order_uuid)
-            matched_uuids.add(sell_order_uuid)
-
-        all_user_ids = set()
-        matched_buyer_user_ids = set()
-        matched_seller_user_ids = set()
-        for buy_order in buy_orders:
-            all_user_ids.add(buy_order["user_id"])
-            if buy_order["id"] in matched_uuids:
-                matched_buyer_user_ids.add(buy_order["user_id"])
-        for sell_order in sell_orders:
-            all_user_ids.add(sell_order["user_id"])
-            if sell_order["id"] in matched_uuids:
-                matched_seller_user_ids.add(sell_order["user_id"])
+            )
 
+    def _queue_emails(
+        self,
+        session,
+        round_id,
+        match_results,
+        sell_order_to_seller_dict,
+        buy_order_to_buyer_dict,
+    ):
+        matched_buyer_user_ids = {
+            buy_order_to_buyer_dict[buy_order_id] for buy_order_id, _ in match_results
+        }
+        matched_seller_user_ids = {
+            sell_order_to_seller_dict[sell_order_id]
+            for _, sell_order_id in match_results
+        }
+        all_user_ids = set(buy_order_to_buyer_dict.values()) | set(
+            sell_order_to_seller_dict.values()
+        )
+
+        recipients = {
+            "match_done_has_match_buyer": [],
+            "match_done_has_match_seller": [],
+            "match_done_no_match": [],
+        }
+        for user_id, email in (
+            session.query(User.id, User.email)
+            .filter(User.id.in_(all_user_ids))
+            .order_by(User.email)
+        ):
+            user_id = str(user_id)
+            if user_id in matched_buyer_user_ids:
+                recipients["match_done_has_match_buyer"].append(email)
+            if user_id in matched_seller_user_ids:
+                recipients["match_done_has_match_seller"].append(email)
+            if (
+                user_id not in matched_buyer_user_ids
+                and user_id not in matched_seller_user_ids
+            ):
+                recipients["match_done_no_match"].append(email)
+
+        batch_size = self.config["MAILGUN_MAX_RECIPIENTS_PER_BATCH"]
+        email_batches = [
+            {
+                "id": uuid.uuid4(),
+                "round_id": round_id,
+                "template": template,
+                "recipients": emails[start : start + batch_size],
+            }
+            for template, emails in recipients.items()
+            for start in range(0, len(emails), batch_size)
+        ]
+        self._insert_rows(session, EmailBatch, email_batches)
+
+    def _send_emails(self, round_id=None):
+        """
+        Sends the due email batches, of the given round or of every round, through a
+        bounded pool of threads. Each batch is marked as sent as soon as it is, so
+        that sending can resume from where it stopped.
+        """
         with session_scope() as session:
-            matched_buyer_emails = [
-                user.email
-                for user in session.query(User)
-                .filter(User.id.in_(matched_buyer_user_ids))
-                .all()
-            ]
-            self.email_service.send_email(
-                matched_buyer_emails, template="match_done_has_match_buyer"
-            )
-            matched_seller_emails = [
-                user.email
-                for user in session.query(User)
-                .filter(User.id.in_(matched_seller_user_ids))
-                .all()
-            ]
-            self.email_service.send_email(
-                matched_seller_emails, template="match_done_has_match_seller"
+            query = session.query(EmailBatch.id).filter(
+                EmailBatch.status == "PENDING", EmailBatch.next_attempt_at <= func.now()
             )
-            unmatched_emails = [
-                user.email
-                for user in session.query(User)
+            if round_id is not None:
+                query = query.filter(EmailBatch.round_id == round_id)
+            batch_ids = [str(batch_id) for batch_id, in query]
+
+        with ThreadPoolExecutor(self.config["MAILGUN_MAX_WORKERS"]) as executor:
+            list(executor.map(self._send_email_batch, batch_ids))
+
+    def _send_email_batch(self, batch_id):
+        # The batch is claimed and committed before it is sent, so that it is not
+        # locked during the call to Mailgun. The claim expires at next_attempt_at,
+        # after which a failed (or interrupted) attempt is retried with a backoff.
+        with session_scope() as session:
+            batch = (
+                session.query(EmailBatch)
                 .filter(
-                    User.id.in_(
-                        all_user_ids - matched_buyer_user_ids - matched_seller_user_ids
-                    )
+                    EmailBatch.id == batch_id,
+                    EmailBatch.status == "PENDING",
+                    EmailBatch.next_attempt_at <= func.now(),
                 )
-                .all()
-            ]
-            self.email_service.send_email(
-                unmatched_emails, template="match_done_no_match"
+                .with_for_update(skip_locked=True)
+                .one_or_none()
+            )
+            if batch is None:
+                return
+            if batch.attempts >= self.config["MAILGUN_MAX_ATTEMPTS"]:
+                batch.status = "FAILED"
+                return
+
+            batch.attempts += 1
+            batch.next_attempt_at = func.now() + timedelta(
+                seconds=self.config["MAILGUN_RETRY_DELAY"] * 2 ** (batch.attempts - 1)
             )
+            recipients, template = batch.recipients, batch.template
+
+        error = None
+        try:
+            response = self.email_service.send_email(recipients, template=template)
+            if response is not None:
+                response.raise_for_status()
+        except Exception as e:
+            error = e
+
+        with session_scope() as session:
+            batch = session.query(EmailBatch).get(batch_id)
+            if error is None:
+                batch.status = "SENT"
+                batch.error = None
+            else:
+                batch.error = repr(error)
+                if batch.attempts >= self.config["MAILGUN_MAX_ATTEMPTS"]:
+                    batch.status = "FAILED"
+
+    def send_pending_emails(self):
+        """
+        Sends the email batches left pending, e.g. by a worker that stopped midway.
+        """
+        self._send_emails()
 
 
 class BannedPairService:
@@ -744,7 +1252,6 @@ class OfferService:
                 )
 
             chat_room = session.query(ChatRoom).get(chat_room_id)
-            chat_room.updated_at = offer.created_at
             chat_room.is_deal_closed = offer_status == "ACCEPTED"
             offer.offer_status = offer_status
             session.add(offer)
@@ -753,6 +1260,7 @@ class OfferService:
             offer_response = OfferResponse(offer_id=str(offer.id))
             session.add(offer_response)
             session.flush()
+            chat_room.updated_at = offer_response.created_at
 
             return OfferService._serialize_chat_offer(
                 offer=offer.asdict(),
@@ -800,126 +1308,321 @@ class ChatService:
 
     @validate_input(GET_CHATS_BY_USER_ID_SCHEMA)
     def get_chats_by_user_id(self, user_id, as_buyer, as_seller):
+        with session_scope() as session:
+            watermark = session.query(func.now()).scalar()
+            res = ChatService._get_chat_rooms(
+                session=session,
+                user_id=user_id,
+                as_buyer=as_buyer,
+                as_seller=as_seller,
+            )
+        return {**res, "watermark": watermark.isoformat()}
+
+    @staticmethod
+    def _get_chat_rooms(session, user_id, as_buyer, as_seller, changed_since=None):
         roles = []
         if as_buyer:
             roles.append("BUYER")
         if as_seller:
             roles.append("SELLER")
 
-        with session_scope() as session:
-            user = session.query(User).get(user_id)
-            if (as_buyer and (not user.can_buy)) or (as_seller and (not user.can_sell)):
-                raise UnauthorizedException("Too much permissions requested.")
-
-            chat_room_queries = (
-                session.query(
-                    ChatRoom, UserChatRoomAssociation, Match, BuyOrder, SellOrder
-                )
-                .join(Match, ChatRoom.match_id == Match.id)
-                .join(
-                    UserChatRoomAssociation,
-                    UserChatRoomAssociation.chat_room_id == ChatRoom.id,
-                )
-                .join(BuyOrder, Match.buy_order_id == BuyOrder.id)
-                .join(SellOrder, Match.sell_order_id == SellOrder.id)
-                .filter(UserChatRoomAssociation.user_id == user_id)
-                .filter(UserChatRoomAssociation.role.in_(roles))
-                .all()
+        user = session.query(User).get(user_id)
+        if (as_buyer and (not user.can_buy)) or (as_seller and (not user.can_sell)):
+            raise UnauthorizedException("Too much permissions requested.")
+
+        # A fixed number of queries, each scoped to the chat rooms of the user
+        chat_room_queries = (
+            session.query(ChatRoom, UserChatRoomAssociation, Match, BuyOrder, SellOrder)
+            .join(Match, ChatRoom.match_id == Match.id)
+            .join(
+                UserChatRoomAssociation,
+                UserChatRoomAssociation.chat_room_id == ChatRoom.id,
             )
-            chats = session.query(Chat).all()
-            offers = session.query(Offer).all()
-            offer_responses = session.query(OfferResponse).all()
-
-            whitelist_chat_rooms = None
-            if not as_seller:
-                whitelist_chat_rooms = set(
-                    str(r[0].id)
-                    for r in session.query(ChatRoom, Chat)
-                    .join(Chat, ChatRoom.id == Chat.chat_room_id)
-                    .all()
-                ) | set(
-                    str(r[0].id)
-                    for r in session.query(ChatRoom, Offer)
-                    .join(Offer, ChatRoom.id == Offer.chat_room_id)
-                    .all()
+            .join(BuyOrder, Match.buy_order_id == BuyOrder.id)
+            .join(SellOrder, Match.sell_order_id == SellOrder.id)
+            .filter(UserChatRoomAssociation.user_id == user_id)
+            .filter(UserChatRoomAssociation.role.in_(roles))
+        )
+        if changed_since is not None:
+            other_assoc = aliased(UserChatRoomAssociation)
+            chat_room_queries = chat_room_queries.filter(
+                (ChatRoom.updated_at > changed_since)
+                | exists().where(
+                    (other_assoc.chat_room_id == ChatRoom.id)
+                    & (other_assoc.updated_at > changed_since)
                 )
+            )
+        chat_room_queries = chat_room_queries.all()
+        chat_room_ids = {str(r[0].id) for r in chat_room_queries}
+        if not chat_room_ids:
+            return {"archived": {}, "unarchived": {}}
+
+        participants = (
+            session.query(UserChatRoomAssociation, User)
+            .join(User, UserChatRoomAssociation.user_id == User.id)
+            .filter(UserChatRoomAssociation.chat_room_id.in_(chat_room_ids))
+            .all()
+        )
+        # The latest chat and offer of each room; the history itself is loaded
+        # page by page with get_chat_history
+        latest_chats = (
+            session.query(Chat)
+            .filter(Chat.chat_room_id.in_(chat_room_ids))
+            .distinct(Chat.chat_room_id)
+            .order_by(Chat.chat_room_id, Chat.created_at.desc(), Chat.id.desc())
+            .all()
+        )
+        latest_offers = (
+            session.query(Offer)
+            .filter(Offer.chat_room_id.in_(chat_room_ids))
+            .filter(Offer.offer_status != "REJECTED")
+            .distinct(Offer.chat_room_id)
+            .order_by(Offer.chat_room_id, Offer.created_at.desc(), Offer.id.desc())
+            .all()
+        )
+        chat_room_ids_with_offers = {
+            r[0]
+            for r in session.query(Offer.chat_room_id)
+            .filter(Offer.chat_room_id.in_(chat_room_ids))
+            .distinct()
+        }
 
-            res = {}
+        participants_by_room_id = defaultdict(list)
+        for assoc, participant in participants:
+            participants_by_room_id[assoc.chat_room_id].append((assoc, participant))
+        latest_chat_by_room_id = {chat.chat_room_id: chat for chat in latest_chats}
+        latest_offer_by_room_id = {offer.chat_room_id: offer for offer in latest_offers}
+
+        res = {}
+        archived_room_ids = set()
+        for chat_room, assoc, match, buy_order, sell_order in chat_room_queries:
+            chat_room_id = str(chat_room.id)
+            if chat_room_id in res:
+                continue
+            # Buyers only see the chat rooms that sellers have started
+            if (
+                not as_seller
+                and chat_room_id not in latest_chat_by_room_id
+                and chat_room_id not in chat_room_ids_with_offers
+            ):
+                continue
 
-            for chat_room, assoc, match, buy_order, sell_order in chat_room_queries:
-                chat_room_id = str(chat_room.id)
-                if (chat_room_id in res) or (
-                    (whitelist_chat_rooms is not None)
-                    and (chat_room_id not in whitelist_chat_rooms)
-                ):
-                    continue
+            room = ChatRoomService._chat_room_dict_with_disband_info(chat_room)
+            everyone = participants_by_room_id[chat_room_id]
+            room["other_party_id"] = next(
+                a.user_id for a, _ in everyone if a.user_id != user_id
+            )
+            room["is_revealed"] = assoc.is_revealed
+            room["identities"] = None
+            if all(a.is_revealed for a, _ in everyone):
+                room["identities"] = {
+                    str(u.id): {"email": u.email, "full_name": u.full_name}
+                    for _, u in everyone
+                }
+            room["last_read_id"] = assoc.last_read_id
+            room["unread_count"] = assoc.unread_count
 
-                chat_room_repr = ChatRoomService(self.config)._serialize_chat_room(
-                    chat_room, user_id
-                )
-                res[chat_room_id] = chat_room_repr
-                res[chat_room_id]["buy_order"] = buy_order.asdict()
-                res[chat_room_id]["sell_order"] = (
-                    sell_order.asdict() if as_seller else None
-                )
+            room["buy_order"] = buy_order.asdict()
+            room["sell_order"] = sell_order.asdict() if as_seller else None
+            latest_chat = latest_chat_by_room_id.get(chat_room_id)
+            room["latest_chat"] = latest_chat and latest_chat.asdict()
+            latest_offer = latest_offer_by_room_id.get(chat_room_id)
+            room["latest_offer"] = latest_offer and latest_offer.asdict()
 
-                res[chat_room_id]["chats"] = []
-                res[chat_room_id]["latest_offer"] = None
+            res[chat_room_id] = room
+            if assoc.is_archived:
+                archived_room_ids.add(chat_room_id)
 
-            for chat in chats:
-                if chat.chat_room_id in res:
-                    res[chat.chat_room_id]["chats"].append(
-                        {"type": "chat", **chat.asdict()}
-                    )
+        unarchived_res = {}
+        archived_res = {}
+        for chat_room_id, room in res.items():
+            if chat_room_id in archived_room_ids:
+                archived_res[chat_room_id] = room
+            else:
+                unarchived_res[chat_room_id] = room
 
-            offer_d = {}
-            for offer in offers:
-                if offer.chat_room_id in res:
-                    offer_d[str(offer.id)] = offer
+        return {"archived": archived_res, "unarchived": unarchived_res}
 
-                    res[offer.chat_room_id]["chats"].append(
-                        {"type": "offer", **offer.asdict()}
-                    )
+    @validate_input(GET_CHAT_HISTORY_SCHEMA)
+    def get_chat_history(
+        self, user_id, chat_room_id, before=None, after=None, limit=None
+    ):
+        """
+        Returns a page of the chats, offers and offer responses of a chat room, in the
+        order of (created_at, id). Without a cursor, this is the latest page. With
+        a before (or after) cursor, the page ends right before (or starts right after)
+        the event of the cursor. has_more tells whether there are more events in that
+        direction, and the before and after cursors of the page continue from it.
+        """
+        if before is not None and after is not None:
+            raise InvalidRequestException("Only one of before and after can be given")
+        limit = min(
+            limit or self.config["ACQUITY_CHAT_HISTORY_PAGE_SIZE"],
+            self.config["ACQUITY_CHAT_HISTORY_MAX_PAGE_SIZE"],
+        )
+        cursor = ChatService._decode_cursor(after if after is not None else before)
 
-                    if offer.offer_status != "REJECTED":
-                        res[offer.chat_room_id]["latest_offer"] = offer.asdict()
+        def get_page(query, model):
+            key = tuple_(model.created_at, model.id)
+            if after is not None:
+                query = query.filter(key > cursor).order_by(model.created_at, model.id)
+            else:
+                if before is not None:
+                    query = query.filter(key < cursor)
+                query = query.order_by(model.created_at.desc(), model.id.desc())
+            return query.limit(limit + 1).all()
 
-            for offer_resp in offer_responses:
-                offer = offer_d.get(offer_resp.offer_id)
-                if offer is None:
-                    continue
+        with session_scope() as session:
+            chat_room = session.query(ChatRoom).get(chat_room_id)
+            if chat_room is None:
+                raise ResourceNotFoundException("Chat room not found")
+            participant_ids = [
+                a.user_id
+                for a in session.query(UserChatRoomAssociation).filter_by(
+                    chat_room_id=chat_room_id
+                )
+            ]
+            if user_id not in participant_ids:
+                raise ResourceNotOwnedException("User is not in this chat room")
 
-                if offer.offer_status == "CANCELED":
-                    author_id = offer.author_id
-                else:
-                    author_id = ChatRoomService._get_other_party_id(
-                        chat_room_id=offer.chat_room_id, user_id=offer.author_id
-                    )
-                res[offer.chat_room_id]["chats"].append(
-                    OfferService._serialize_chat_offer(
-                        offer=offer.asdict(),
+            events = []
+            for chat in get_page(
+                session.query(Chat).filter_by(chat_room_id=chat_room_id), Chat
+            ):
+                events.append({"type": "chat", **chat.asdict()})
+            for offer in get_page(
+                session.query(Offer).filter_by(chat_room_id=chat_room_id), Offer
+            ):
+                events.append({"type": "offer", **offer.asdict()})
+            for offer_resp, offer in get_page(
+                session.query(OfferResponse, Offer)
+                .join(Offer, OfferResponse.offer_id == Offer.id)
+                .filter(Offer.chat_room_id == chat_room_id),
+                OfferResponse,
+            ):
+                events.append(
+                    ChatService._serialize_offer_response(
+                        offer_resp=offer_resp,
+                        offer=offer,
+                        participant_ids=participant_ids,
                         is_deal_closed=chat_room.is_deal_closed,
-                        offer_response=offer_resp.asdict(),
-                        author_id=author_id,
                     )
                 )
 
-            for v in res.values():
-                v["chats"].sort(key=lambda x: x["created_at"])
+        # Each query returns up to limit + 1 events, so the merged page is exact
+        events.sort(key=lambda e: (e["created_at"], e["id"]), reverse=after is None)
+        has_more = len(events) > limit
+        events = events[:limit]
+        if after is None:
+            events.reverse()
+
+        return {
+            "chat_room_id": chat_room_id,
+            "events": events,
+            "has_more": has_more,
+            "before": ChatService._encode_cursor(events[0]) if events else before,
+            "after": ChatService._encode_cursor(events[-1]) if events else after,
+        }
 
-            archived_room_ids = set(
-                q[1].chat_room_id for q in chat_room_queries if q[1].is_archived
+    @validate_input(GET_CHATS_SINCE_SCHEMA)
+    def get_chats_since(self, user_id, as_buyer, as_seller, since):
+        """
+        Returns the chat rooms of the user that changed after the watermark since,
+        which is returned by get_chats_by_user_id and by this function. Each room
+        carries, in events, its chats, offers and offer responses created after the
+        watermark; older events are loaded with get_chat_history.
+
+        Changes are only visible once their transactions commit, so the watermark is
+        moved back by ACQUITY_CHAT_SYNC_OVERLAP seconds. Clients may then receive an
+        event twice, and should deduplicate events by id.
+        """
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            raise InvalidRequestException("Invalid watermark")
+        changed_since = since - timedelta(
+            seconds=self.config["ACQUITY_CHAT_SYNC_OVERLAP"]
+        )
+
+        with session_scope() as session:
+            watermark = session.query(func.now()).scalar()
+            res = ChatService._get_chat_rooms(
+                session=session,
+                user_id=user_id,
+                as_buyer=as_buyer,
+                as_seller=as_seller,
+                changed_since=changed_since,
             )
+            rooms = {**res["archived"], **res["unarchived"]}
+            for room in rooms.values():
+                room["events"] = []
+
+            if rooms:
+                for chat in (
+                    session.query(Chat)
+                    .filter(Chat.chat_room_id.in_(rooms))
+                    .filter(Chat.created_at > changed_since)
+                ):
+                    rooms[chat.chat_room_id]["events"].append(
+                        {"type": "chat", **chat.asdict()}
+                    )
+                for offer in (
+                    session.query(Offer)
+                    .filter(Offer.chat_room_id.in_(rooms))
+                    .filter(Offer.created_at > changed_since)
+                ):
+                    rooms[offer.chat_room_id]["events"].append(
+                        {"type": "offer", **offer.asdict()}
+                    )
+                for offer_resp, offer in (
+                    session.query(OfferResponse, Offer)
+                    .join(Offer, OfferResponse.offer_id == Offer.id)
+                    .filter(Offer.chat_room_id.in_(rooms))
+                    .filter(OfferResponse.created_at > changed_since)
+                ):
+                    room = rooms[offer.chat_room_id]
+                    room["events"].append(
+                        ChatService._serialize_offer_response(
+                            offer_resp=offer_resp,
+                            offer=offer,
+                            participant_ids=[user_id, room["other_party_id"]],
+                            is_deal_closed=room["is_deal_closed"],
+                        )
+                    )
 
-        unarchived_res = {}
-        archived_res = {}
-        for chat_room_id, room in res.items():
-            if chat_room_id in archived_room_ids:
-                archived_res[chat_room_id] = room
-            else:
-                unarchived_res[chat_room_id] = room
+        for room in rooms.values():
+            room["events"].sort(key=lambda e: (e["created_at"], e["id"]))
+        return {**res, "watermark": watermark.isoformat()}
 
-        return {"archived": archived_res, "unarchived": unarchived_res}
+    @staticmethod
+    def _serialize_offer_response(offer_resp, offer, participant_ids, is_deal_closed):
+        # Offers are canceled by their authors, and accepted or rejected by the others
+        if offer.offer_status == "CANCELED":
+            author_id = offer.author_id
+        else:
+            author_id = next(p for p in participant_ids if p != offer.author_id)
+        return OfferService._serialize_chat_offer(
+            offer=offer.asdict(),
+            is_deal_closed=is_deal_closed,
+            offer_response=offer_resp.asdict(),
+            author_id=author_id,
+        )
+
+    @staticmethod
+    def _encode_cursor(event):
+        # Datetimes are serialized in seconds, so cursors keep the full timestamp
+        key = f"{event['created_at'].isoformat()}|{event['id']}"
+        return base64.urlsafe_b64encode(key.encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        if cursor is None:
+            return None
+        try:
+            created_at, id = base64.urlsafe_b64decode(cursor).decode().split("|")
+            return datetime.fromisoformat(created_at), uuid.UUID(id)
+        except ValueError:
+            raise InvalidRequestException("Invalid cursor")
 
     @validate_input(CREATE_NEW_MESSAGE_SCHEMA)
     def create_new_message(self, chat_room_id, message, author_id):
@@ -950,14 +1653,28 @@ class ChatService:
             session.add(message)
             session.flush()
             chat_room.updated_at = message.created_at
+            # The other party has one more chat to read
+            session.query(UserChatRoomAssociation).filter(
+                (UserChatRoomAssociation.chat_room_id == chat_room_id)
+                & (UserChatRoomAssociation.user_id != author_id)
+            ).update(
+                {"unread_count": UserChatRoomAssociation.unread_count + 1},
+                synchronize_session=False,
+            )
 
             if first_chat:
                 other_party_id = ChatRoomService._get_other_party_id(
                     chat_room_id=str(chat_room.id), user_id=author_id
                 )
                 other_party_email = session.query(User).get(other_party_id).email
-                self.email_service.send_email(
-                    emails=[other_party_email], template="new_chat_message"
+                # Only once the chat is committed, and without holding its transaction
+                event.listen(
+                    session,
+                    "after_commit",
+                    lambda session: self.email_service.send_email(
+                        emails=[other_party_email], template="new_chat_message"
+                    ),
+                    once=True,
                 )
 
             return {"type": "chat", **message.asdict()}
@@ -1010,6 +1727,19 @@ class ChatRoomService:
             )
             return [chat_room[1].asdict() for chat_room in chat_rooms]
 
+    @validate_input({"user_id": UUID_RULE})
+    async def get_chat_rooms_by_user_id_async(self, user_id):
+        return await async_engine.execute(
+            select([ChatRoom.__table__])
+            .select_from(
+                UserChatRoomAssociation.__table__.join(
+                    ChatRoom.__table__,
+                    UserChatRoomAssociation.chat_room_id == ChatRoom.id,
+                )
+            )
+            .where(UserChatRoomAssociation.user_id == user_id)
+        )
+
     @validate_input({"user_id": UUID_RULE, "chat_room_id": UUID_RULE})
     def reveal_identity(self, chat_room_id, user_id):
         with session_scope() as session:
@@ -1043,9 +1773,30 @@ class ChatRoomService:
     )
     def update_last_read_id(self, user_id, chat_room_id, last_read_id):
         with session_scope() as session:
-            session.query(UserChatRoomAssociation).filter_by(
-                user_id=user_id, chat_room_id=chat_room_id
-            ).one().last_read_id = last_read_id
+            # Locked so that no chat is counted while it is being sent
+            assoc = (
+                session.query(UserChatRoomAssociation)
+                .filter_by(user_id=user_id, chat_room_id=chat_room_id)
+                .with_for_update()
+                .one()
+            )
+            last_read_chat = (
+                session.query(Chat)
+                .filter_by(id=last_read_id, chat_room_id=chat_room_id)
+                .one_or_none()
+            )
+            if last_read_chat is None:
+                raise ResourceNotFoundException("Chat not found")
+
+            assoc.last_read_id = last_read_id
+            # Usually the latest chat, in which case this is 0
+            assoc.unread_count = (
+                session.query(Chat)
+                .filter_by(chat_room_id=chat_room_id)
+                .filter(Chat.author_id != user_id)
+                .filter(Chat.created_at > last_read_chat.created_at)
+                .count()
+            )
 
     @staticmethod
     def is_disbanded(chat_room):
@@ -1095,19 +1846,8 @@ class ChatRoomService:
                     for a in everyone
                 }
 
-            last_read_id = assoc.last_read_id
-            res["last_read_id"] = last_read_id
-
-            unread_count_query = (
-                session.query(Chat)
-                .filter_by(chat_room_id=str(chat_room.id))
-                .filter(Chat.author_id != user_id)
-            )
-            if last_read_id is not None:
-                unread_count_query = unread_count_query.filter(
-                    Chat.created_at > session.query(Chat).get(last_read_id).created_at
-                )
-            res["unread_count"] = unread_count_query.count()
+            res["last_read_id"] = assoc.last_read_id
+            res["unread_count"] = assoc.unread_count
 
         return res
 
@@ -1145,6 +1885,20 @@ class LinkedInLogin:
         self.get_linkedin_user(token["access_token"], is_buy=is_buy)
         return token
 
+    async def get_user_by_token_async(self, token):
+        """
+        Returns the user with the given LinkedIn access token, cached for up to
+        ACQUITY_AUTH_CACHE_TTL seconds, or until the user changes.
+        """
+        user = auth_cache.get(token)
+        if user is None:
+            linkedin_user = await offload(self.get_linkedin_user, token=token)
+            user = await UserService(self.config).get_user_by_linkedin_id_async(
+                provider_user_id=linkedin_user["provider_user_id"]
+            )
+            auth_cache.set(token, user)
+        return user
+
     def get_linkedin_user(self, token, is_buy=None):
         with session_scope() as session:
             users = [
@@ -1279,6 +2033,7 @@ class UserRequestService:
             request.closed_by_user_id = subject_id
 
             user = session.query(User).get(request.user_id)
+            invalidate_cached_user(session, request.user_id)
             if request.is_buy:
                 user.can_buy = True
                 self.email_service.send_email(
@@ -1300,5 +2055,6 @@ class UserRequestService:
             request.closed_by_user_id = subject_id
 
             user = session.query(User).get(request.user_id)
+            invalidate_cached_user(session, request.user_id)
             email_template = "rejected_buyer" if request.is_buy else "rejected_seller"
             self.email_service.send_email(emails=[user.email], template=email_template)
@@ -0,0 +1,49 @@
+import time
+import traceback
+
+import sentry_sdk
+from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
+
+from src.config import APP_CONFIG
+from src.exceptions import AcquityException
+from src.services import MatchService
+
+if APP_CONFIG["SENTRY_ENABLE"]:
+
+    def sentry_before_send(event, hint):
+        if "exc_info" in hint:
+            _exc_type, exc_value, _tb = hint["exc_info"]
+            if isinstance(exc_value, AcquityException):
+                return None
+        return event
+
+    sentry_sdk.init(
+        dsn="https://1d45f7681dca45e8b8a83842dd6303b8@sentry.io/1800796",
+        integrations=[SqlalchemyIntegration()],
+        before_send=sentry_before_send,
+    )
+
+
+def run_worker(config):
+    match_service = MatchService(config)
+    while True:
+        try:
+            has_run_job = match_service.run_next_job()
+        except Exception:
+            traceback.print_exc()
+            sentry_sdk.capture_exception()
+            has_run_job = False
+
+        # Separately, so that emails that cannot be sent never hold up matching
+        try:
+            match_service.send_pending_emails()
+        except Exception:
+            traceback.print_exc()
+            sentry_sdk.capture_exception()
+
+        if not has_run_job:
+            time.sleep(config["ACQUITY_MATCHING_WORKER_POLL_INTERVAL"])
+
+
+if __name__ == "__main__":
+    run_worker(APP_CONFIG)
@@ -5,7 +5,9 @@ from src.database import (
     BuyOrder,
     Chat,
     ChatRoom,
+    EmailBatch,
     Match,
+    MatchJob,
     Offer,
     OfferResponse,
     Round,
@@ -154,6 +156,22 @@ def create_round(id=0, **kwargs):
         return round.asdict()
 
 
+def create_match_job(id=0, **kwargs):
+    with session_scope() as session:
+        match_job = MatchJob(
+            **combine_dicts(
+                kwargs,
+                {
+                    "round_id": lambda: create_round(id)["id"],
+                    "run_at": lambda: datetime.now() - timedelta(minutes=1),
+                },
+            )
+        )
+        session.add(match_job)
+        session.commit()
+        return match_job.asdict()
+
+
 def create_banned_pair(id=0, **kwargs):
     with session_scope() as session:
         banned_pair = BannedPair(
@@ -257,3 +275,20 @@ def create_user_request(id=0, **kwargs):
         session.add(user_request)
         session.commit()
         return user_request.asdict()
+
+
+def create_email_batch(id=0, **kwargs):
+    with session_scope() as session:
+        email_batch = EmailBatch(
+            **combine_dicts(
+                kwargs,
+                {
+                    "round_id": lambda: create_round(id)["id"],
+                    "template": lambda: "match_done_no_match",
+                    "recipients": lambda: [f"a{id}@a"],
+                },
+            )
+        )
+        session.add(email_batch)
+        session.commit()
+        return email_batch.asdict()
@@ -1,3 +1,4 @@
+import asyncio
 from unittest.mock import patch
 
 import pytest
@@ -44,6 +45,26 @@ def test_get_orders_by_user_in_current_round():
     )
 
 
+def test_get_orders_by_user_in_current_round_async():
+    user_id = create_user()["id"]
+    current_round = create_round()
+    create_buy_order("1", user_id=user_id, round_id=None)
+    create_buy_order("2", user_id=user_id, round_id=current_round["id"])
+    create_buy_order(
+        "3", user_id=user_id, round_id=create_round("3", is_concluded=True)["id"]
+    )
+
+    orders = asyncio.run(
+        buy_order_service.get_orders_by_user_in_current_round_async(user_id=user_id)
+    )
+    expected_orders = buy_order_service.get_orders_by_user_in_current_round(
+        user_id=user_id
+    )
+    assert sorted(orders, key=lambda o: o["id"]) == sorted(
+        expected_orders, key=lambda o: o["id"]
+    )
+
+
 def test_get_order_by_id():
     buy_order = create_buy_order()
 
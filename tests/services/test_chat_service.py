@@ -1,10 +1,20 @@
+import asyncio
 from datetime import datetime, timedelta
+from unittest.mock import patch
 
 import pytest
+from sqlalchemy import event
 
 from src.config import APP_CONFIG
-from src.exceptions import UnauthorizedException
-from src.services import ChatService
+from src.database import engine, request_scope
+from src.exceptions import (
+    InvalidRequestException,
+    ResourceNotFoundException,
+    ResourceNotOwnedException,
+    UnauthorizedException,
+)
+from src.executor import offload
+from src.services import ChatRoomService, ChatService, OfferService
 from tests.fixtures import (
     create_buy_order,
     create_chat,
@@ -21,7 +31,7 @@ from tests.utils import assert_dict_in
 chat_service = ChatService(config=APP_CONFIG)
 
 
-def test_get_chats_by_user_id__chats():
+def test_get_chats_by_user_id__latest_chat():
     user = create_user("00")
     other_party = create_user("10")
     chat_room = create_chat_room("01")
@@ -31,37 +41,13 @@ def test_get_chats_by_user_id__chats():
     create_user_chat_room_association(
         "12", user_id=other_party["id"], chat_room_id=chat_room["id"]
     )
-    chat = create_chat("03", chat_room_id=chat_room["id"], author_id=user["id"])
-    other_chat = create_chat(
-        "13", chat_room_id=chat_room["id"], author_id=other_party["id"]
-    )
-
-    res = chat_service.get_chats_by_user_id(
-        user_id=user["id"], as_buyer=True, as_seller=True
-    )
-
-    res_room = res["unarchived"][chat_room["id"]]
-    chat_room.pop("disband_by_user_id")
-    chat_room.pop("disband_time")
-    assert_dict_in(chat_room, res_room)
-
-    res_chats = res_room["chats"]
-    assert {**chat, "type": "chat"} in res_chats
-    assert {**other_chat, "type": "chat"} in res_chats
-
-
-def test_get_chats_by_user_id__offers():
-    user = create_user("00")
-    other_party = create_user("10")
-    chat_room = create_chat_room("01")
-    create_user_chat_room_association(
-        "02", user_id=user["id"], chat_room_id=chat_room["id"], is_archived=False
-    )
-    create_user_chat_room_association(
-        "12", user_id=other_party["id"], chat_room_id=chat_room["id"]
+    create_chat(
+        "03",
+        chat_room_id=chat_room["id"],
+        author_id=user["id"],
+        created_at=datetime.now() - timedelta(hours=1),
     )
-    offer = create_offer("03", chat_room_id=chat_room["id"], author_id=user["id"])
-    other_offer = create_offer(
+    other_chat = create_chat(
         "13", chat_room_id=chat_room["id"], author_id=other_party["id"]
     )
 
@@ -73,46 +59,11 @@ def test_get_chats_by_user_id__offers():
     chat_room.pop("disband_by_user_id")
     chat_room.pop("disband_time")
     assert_dict_in(chat_room, res_room)
+    assert res_room["latest_chat"] == other_chat
+    assert "chats" not in res_room
 
-    res_chats = res_room["chats"]
-    assert {**offer, "type": "offer"} in res_chats
-    assert {**other_offer, "type": "offer"} in res_chats
-
-
-def test_get_chats_by_user_id__offer_responses():
-    user = create_user("00")
-    other_party = create_user("10")
-    chat_room = create_chat_room("01")
-    create_user_chat_room_association(
-        "02", user_id=user["id"], chat_room_id=chat_room["id"], is_archived=False
-    )
-    create_user_chat_room_association(
-        "12", user_id=other_party["id"], chat_room_id=chat_room["id"]
-    )
-    offer = create_offer("03", chat_room_id=chat_room["id"], author_id=user["id"])
-    resp = create_offer_response("04", offer_id=offer["id"])
-
-    res = chat_service.get_chats_by_user_id(
-        user_id=user["id"], as_buyer=True, as_seller=True
-    )
-
-    res_room = res["unarchived"][chat_room["id"]]
-    chat_room.pop("disband_by_user_id")
-    chat_room.pop("disband_time")
-    assert_dict_in(chat_room, res_room)
-
-    res_chats = res_room["chats"]
-    assert {**offer, "type": "offer"} in res_chats
-    assert {
-        **offer,
-        **resp,
-        "author_id": other_party["id"],
-        "is_deal_closed": False,
-        "type": "offer_response",
-    } in res_chats
 
-
-def test_get_chats_by_user_id__offer_responses_not_in_room():
+def test_get_chats_by_user_id__no_latest_chat():
     user = create_user("00")
     other_party = create_user("10")
     chat_room = create_chat_room("01")
@@ -122,21 +73,12 @@ def test_get_chats_by_user_id__offer_responses_not_in_room():
     create_user_chat_room_association(
         "12", user_id=other_party["id"], chat_room_id=chat_room["id"]
     )
-    offer = create_offer("03", chat_room_id=chat_room["id"], author_id=user["id"])
-    create_offer_response("04")
 
-    res = chat_service.get_chats_by_user_id(
+    res_room = chat_service.get_chats_by_user_id(
         user_id=user["id"], as_buyer=True, as_seller=True
-    )
-
-    res_room = res["unarchived"][chat_room["id"]]
-    chat_room.pop("disband_by_user_id")
-    chat_room.pop("disband_time")
-    assert_dict_in(chat_room, res_room)
-
-    res_chats = res_room["chats"]
-    assert {**offer, "type": "offer"} in res_chats
-    assert "offer_resp" not in [c["type"] for c in res_chats]
+    )["unarchived"][chat_room["id"]]
+    assert res_room["latest_chat"] is None
+    assert res_room["latest_offer"] is None
 
 
 def test_get_chats_by_user_id__archived():
@@ -290,40 +232,6 @@ def test_get_chats_by_user_id__other_party_id():
     )
 
 
-def test_get_chats_by_user_id__created_at_sort():
-    user = create_user("00")
-    other_party = create_user("10")
-
-    chat_room = create_chat_room("01")
-    create_user_chat_room_association(
-        "02", user_id=user["id"], chat_room_id=chat_room["id"], is_archived=False
-    )
-    create_user_chat_room_association(
-        "12", user_id=other_party["id"], chat_room_id=chat_room["id"]
-    )
-
-    chat = create_chat(
-        "03",
-        chat_room_id=chat_room["id"],
-        author_id=user["id"],
-        created_at=datetime.now(),
-    )
-    offer = create_offer(
-        "04",
-        chat_room_id=chat_room["id"],
-        author_id=user["id"],
-        created_at=datetime.now() - timedelta(hours=1),
-    )
-    resp = create_offer_response(
-        "05", offer_id=offer["id"], created_at=datetime.now() + timedelta(hours=1)
-    )
-
-    res_chats = chat_service.get_chats_by_user_id(
-        user_id=user["id"], as_buyer=True, as_seller=True
-    )["unarchived"][chat_room["id"]]["chats"]
-    assert [r["id"] for r in res_chats] == [offer["id"], chat["id"], resp["id"]]
-
-
 def test_get_chats_by_user_id__latest_offer():
     user = create_user("00")
     other_party = create_user("10")
@@ -374,7 +282,9 @@ def test_get_chats_by_user_id__last_read_id_none():
         last_read_id=None,
     )
 
-    create_chat("03", chat_room_id=chat_room["id"], author_id=other_party["id"])
+    chat_service.create_new_message(
+        chat_room_id=chat_room["id"], message="hello", author_id=other_party["id"]
+    )
 
     res = chat_service.get_chats_by_user_id(
         user_id=user["id"], as_buyer=True, as_seller=True
@@ -520,3 +430,420 @@ def test_get_chats_by_user_id__hidden_buy_order():
         user_id=user["id"], as_buyer=True, as_seller=False
     )
     assert res["unarchived"][chat_room["id"]]["sell_order"] is None
+
+
+def test_get_chats_by_user_id__number_of_queries():
+    user = create_user("00")
+
+    def create_room(i):
+        other_party = create_user(f"{i}0")
+        chat_room = create_chat_room(f"{i}1")
+        create_user_chat_room_association(
+            f"{i}2", user_id=user["id"], chat_room_id=chat_room["id"]
+        )
+        create_user_chat_room_association(
+            f"{i}3", user_id=other_party["id"], chat_room_id=chat_room["id"]
+        )
+        create_chat(f"{i}4", chat_room_id=chat_room["id"], author_id=other_party["id"])
+        offer = create_offer(
+            f"{i}5", chat_room_id=chat_room["id"], author_id=user["id"]
+        )
+        create_offer_response(f"{i}6", offer_id=offer["id"])
+
+    def count_queries():
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            res = chat_service.get_chats_by_user_id(
+                user_id=user["id"], as_buyer=True, as_seller=True
+            )
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        return len(res["unarchived"]), len(statements)
+
+    create_room(1)
+    number_of_rooms, number_of_queries = count_queries()
+    assert number_of_rooms == 1
+
+    create_room(2)
+    create_room(3)
+    assert count_queries() == (3, number_of_queries)
+
+
+def create_history_chat_room():
+    user = create_user("00")
+    other_party = create_user("10")
+    chat_room = create_chat_room("01")
+    create_user_chat_room_association(
+        "02", user_id=user["id"], chat_room_id=chat_room["id"]
+    )
+    create_user_chat_room_association(
+        "12", user_id=other_party["id"], chat_room_id=chat_room["id"]
+    )
+    return user, other_party, chat_room
+
+
+def test_get_chat_history__events():
+    user, other_party, chat_room = create_history_chat_room()
+    chat = create_chat(
+        "03",
+        chat_room_id=chat_room["id"],
+        author_id=user["id"],
+        created_at=datetime.now(),
+    )
+    offer = create_offer(
+        "04",
+        chat_room_id=chat_room["id"],
+        author_id=user["id"],
+        created_at=datetime.now() - timedelta(hours=1),
+    )
+    resp = create_offer_response(
+        "05", offer_id=offer["id"], created_at=datetime.now() + timedelta(hours=1)
+    )
+    create_offer_response("06")
+
+    res = chat_service.get_chat_history(
+        user_id=user["id"], chat_room_id=chat_room["id"]
+    )
+
+    assert res["events"] == [
+        {**offer, "type": "offer"},
+        {**chat, "type": "chat"},
+        {
+            **offer,
+            **resp,
+            "author_id": other_party["id"],
+            "is_deal_closed": False,
+            "type": "offer_response",
+        },
+    ]
+    assert not res["has_more"]
+
+
+def test_get_chat_history__before():
+    user, other_party, chat_room = create_history_chat_room()
+    now = datetime.now()
+    chats = [
+        create_chat(
+            i,
+            chat_room_id=chat_room["id"],
+            author_id=other_party["id"],
+            created_at=now + timedelta(minutes=i),
+        )
+        for i in range(5)
+    ]
+
+    res = chat_service.get_chat_history(
+        user_id=user["id"], chat_room_id=chat_room["id"], limit=2
+    )
+    assert [e["id"] for e in res["events"]] == [c["id"] for c in chats[3:]]
+    assert res["has_more"]
+
+    res = chat_service.get_chat_history(
+        user_id=user["id"], chat_room_id=chat_room["id"], before=res["before"], limit=2
+    )
+    assert [e["id"] for e in res["events"]] == [c["id"] for c in chats[1:3]]
+    assert res["has_more"]
+
+    res = chat_service.get_chat_history(
+        user_id=user["id"], chat_room_id=chat_room["id"], before=res["before"], limit=2
+    )
+    assert [e["id"] for e in res["events"]] == [chats[0]["id"]]
+    assert not res["has_more"]
+
+
+def test_get_chat_history__after():
+    user, other_party, chat_room = create_history_chat_room()
+    now = datetime.now()
+    chats = [
+        create_chat(
+            i,
+            chat_room_id=chat_room["id"],
+            author_id=other_party["id"],
+            created_at=now + timedelta(minutes=i),
+        )
+        for i in range(3)
+    ]
+    offer = create_offer(
+        "04",
+        chat_room_id=chat_room["id"],
+        author_id=user["id"],
+        created_at=now + timedelta(minutes=3),
+    )
+
+    res = chat_service.get_chat_history(
+        user_id=user["id"], chat_room_id=chat_room["id"], limit=1
+    )
+    assert [e["id"] for e in res["events"]] == [offer["id"]]
+    res = chat_service.get_chat_history(
+        user_id=user["id"], chat_room_id=chat_room["id"], before=res["before"], limit=1
+    )
+    assert [e["id"] for e in res["events"]] == [chats[2]["id"]]
+
+    res = chat_service.get_chat_history(
+        user_id=user["id"], chat_room_id=chat_room["id"], after=res["after"], limit=2
+    )
+    assert [e["id"] for e in res["events"]] == [offer["id"]]
+    assert not res["has_more"]
+
+    new_chat = create_chat(
+        "05",
+        chat_room_id=chat_room["id"],
+        author_id=other_party["id"],
+        created_at=now + timedelta(minutes=4),
+    )
+    res = chat_service.get_chat_history(
+        user_id=user["id"], chat_room_id=chat_room["id"], after=res["after"]
+    )
+    assert [e["id"] for e in res["events"]] == [new_chat["id"]]
+
+    res = chat_service.get_chat_history(
+        user_id=user["id"], chat_room_id=chat_room["id"], after=res["after"]
+    )
+    assert res["events"] == []
+    assert res["after"] is not None
+
+
+def test_get_chat_history__same_created_at():
+    user, other_party, chat_room = create_history_chat_room()
+    now = datetime.now()
+    chats = [
+        create_chat(
+            i, chat_room_id=chat_room["id"], author_id=other_party["id"], created_at=now
+        )
+        for i in range(3)
+    ]
+
+    res = chat_service.get_chat_history(
+        user_id=user["id"], chat_room_id=chat_room["id"], limit=2
+    )
+    res_before = chat_service.get_chat_history(
+        user_id=user["id"], chat_room_id=chat_room["id"], before=res["before"], limit=2
+    )
+
+    ids = [e["id"] for e in res_before["events"] + res["events"]]
+    assert sorted(ids) == ids
+    assert sorted(ids) == sorted(c["id"] for c in chats)
+
+
+def test_get_chat_history__not_in_room():
+    user = create_user("00")
+    chat_room = create_chat_room("01")
+
+    with pytest.raises(ResourceNotOwnedException):
+        chat_service.get_chat_history(user_id=user["id"], chat_room_id=chat_room["id"])
+
+
+def test_get_chat_history__invalid_cursor():
+    user, _, chat_room = create_history_chat_room()
+
+    with pytest.raises(InvalidRequestException):
+        chat_service.get_chat_history(
+            user_id=user["id"], chat_room_id=chat_room["id"], before="invalid"
+        )
+
+
+def create_sync_chat_room(id, user, other_party):
+    an_hour_ago = datetime.now() - timedelta(hours=1)
+    chat_room = create_chat_room(id, created_at=an_hour_ago, updated_at=an_hour_ago)
+    # The user has not read the chat of the other party
+    for assoc_id, assoc_user, unread_count in [
+        (f"{id}1", user, 1),
+        (f"{id}2", other_party, 0),
+    ]:
+        create_user_chat_room_association(
+            assoc_id,
+            user_id=assoc_user["id"],
+            chat_room_id=chat_room["id"],
+            unread_count=unread_count,
+            created_at=an_hour_ago,
+            updated_at=an_hour_ago,
+        )
+    create_chat(
+        f"{id}3",
+        chat_room_id=chat_room["id"],
+        author_id=other_party["id"],
+        created_at=an_hour_ago,
+    )
+    return chat_room
+
+
+def test_get_chats_since__new_chats():
+    user = create_user("00")
+    other_party = create_user("10")
+    chat_room = create_sync_chat_room("1", user, other_party)
+    create_sync_chat_room("2", user, other_party)
+
+    watermark = chat_service.get_chats_by_user_id(
+        user_id=user["id"], as_buyer=True, as_seller=True
+    )["watermark"]
+    chat = chat_service.create_new_message(
+        chat_room_id=chat_room["id"], message="hello", author_id=other_party["id"]
+    )
+
+    res = chat_service.get_chats_since(
+        user_id=user["id"], as_buyer=True, as_seller=True, since=watermark
+    )
+
+    assert list(res["unarchived"]) == [chat_room["id"]]
+    assert res["archived"] == {}
+    res_room = res["unarchived"][chat_room["id"]]
+    assert res_room["events"] == [chat]
+    assert res_room["latest_chat"] == {k: v for k, v in chat.items() if k != "type"}
+    assert res_room["unread_count"] == 2
+    assert res["watermark"] > watermark
+
+
+def test_get_chats_since__offer_responses():
+    user = create_user("00")
+    other_party = create_user("10")
+    chat_room = create_sync_chat_room("1", user, other_party)
+    offer = create_offer(
+        "04",
+        chat_room_id=chat_room["id"],
+        author_id=user["id"],
+        created_at=datetime.now() - timedelta(hours=1),
+    )
+
+    watermark = chat_service.get_chats_by_user_id(
+        user_id=user["id"], as_buyer=True, as_seller=True
+    )["watermark"]
+    resp = OfferService(config=APP_CONFIG).edit_offer_status(
+        chat_room_id=chat_room["id"],
+        offer_id=offer["id"],
+        user_id=other_party["id"],
+        offer_status="REJECTED",
+    )
+
+    res = chat_service.get_chats_since(
+        user_id=user["id"], as_buyer=True, as_seller=True, since=watermark
+    )
+
+    assert res["unarchived"][chat_room["id"]]["events"] == [resp]
+
+
+def test_get_chats_since__archived_and_disbanded():
+    user = create_user("00")
+    other_party = create_user("10")
+    chat_room = create_sync_chat_room("1", user, other_party)
+    other_chat_room = create_sync_chat_room("2", user, other_party)
+    create_sync_chat_room("3", user, other_party)
+
+    watermark = chat_service.get_chats_by_user_id(
+        user_id=user["id"], as_buyer=True, as_seller=True
+    )["watermark"]
+    chat_room_service = ChatRoomService(config=APP_CONFIG)
+    chat_room_service.archive_room(user_id=user["id"], chat_room_id=chat_room["id"])
+    chat_room_service.disband_chatroom(
+        user_id=other_party["id"], chat_room_id=other_chat_room["id"]
+    )
+
+    res = chat_service.get_chats_since(
+        user_id=user["id"], as_buyer=True, as_seller=True, since=watermark
+    )
+
+    assert list(res["archived"]) == [chat_room["id"]]
+    assert res["archived"][chat_room["id"]]["events"] == []
+    assert list(res["unarchived"]) == [other_chat_room["id"]]
+    assert (
+        res["unarchived"][other_chat_room["id"]]["disband_info"]["disband_by_user_id"]
+        == other_party["id"]
+    )
+
+
+def test_get_chats_since__invalid_watermark():
+    user = create_user("00")
+
+    with pytest.raises(InvalidRequestException):
+        chat_service.get_chats_since(
+            user_id=user["id"], as_buyer=True, as_seller=True, since="yesterday"
+        )
+
+
+def test_create_new_message__unread_count():
+    user, other_party, chat_room = create_history_chat_room()
+
+    for _ in range(2):
+        chat_service.create_new_message(
+            chat_room_id=chat_room["id"], message="hello", author_id=other_party["id"]
+        )
+
+    res = chat_service.get_chats_by_user_id(
+        user_id=user["id"], as_buyer=True, as_seller=True
+    )
+    assert res["unarchived"][chat_room["id"]]["unread_count"] == 2
+    res_other = chat_service.get_chats_by_user_id(
+        user_id=other_party["id"], as_buyer=True, as_seller=True
+    )
+    assert res_other["unarchived"][chat_room["id"]]["unread_count"] == 0
+
+
+def test_create_new_message__emails_after_commit():
+    user, other_party, chat_room = create_history_chat_room()
+
+    async def create_first_message():
+        async with request_scope():
+            await offload(
+                chat_service.create_new_message,
+                chat_room_id=chat_room["id"],
+                message="hello",
+                author_id=other_party["id"],
+            )
+            mock_send_email.assert_not_called()
+
+    with patch("src.services.EmailService.send_email") as mock_send_email:
+        asyncio.run(create_first_message())
+
+    mock_send_email.assert_called_once_with(
+        emails=[user["email"]], template="new_chat_message"
+    )
+
+
+def test_update_last_read_id__unread_count():
+    user, other_party, chat_room = create_history_chat_room()
+    chats = [
+        chat_service.create_new_message(
+            chat_room_id=chat_room["id"], message="hello", author_id=other_party["id"]
+        )
+        for _ in range(3)
+    ]
+    chat_room_service = ChatRoomService(config=APP_CONFIG)
+
+    def get_unread_count():
+        return chat_service.get_chats_by_user_id(
+            user_id=user["id"], as_buyer=True, as_seller=True
+        )["unarchived"][chat_room["id"]]["unread_count"]
+
+    chat_room_service.update_last_read_id(
+        user_id=user["id"], chat_room_id=chat_room["id"], last_read_id=chats[0]["id"]
+    )
+    assert get_unread_count() == 2
+
+    chat_room_service.update_last_read_id(
+        user_id=user["id"], chat_room_id=chat_room["id"], last_read_id=chats[-1]["id"]
+    )
+    assert get_unread_count() == 0
+
+
+def test_update_last_read_id__other_chat_room():
+    user, other_party, chat_room = create_history_chat_room()
+    chat_service.create_new_message(
+        chat_room_id=chat_room["id"], message="hello", author_id=other_party["id"]
+    )
+    other_chat = create_chat("03", created_at=datetime.now() + timedelta(days=1))
+    chat_room_service = ChatRoomService(config=APP_CONFIG)
+
+    with pytest.raises(ResourceNotFoundException):
+        chat_room_service.update_last_read_id(
+            user_id=user["id"],
+            chat_room_id=chat_room["id"],
+            last_read_id=other_chat["id"],
+        )
+
+    assert (
+        chat_service.get_chats_by_user_id(
+            user_id=user["id"], as_buyer=True, as_seller=True
+        )["unarchived"][chat_room["id"]]["unread_count"]
+        == 1
+    )
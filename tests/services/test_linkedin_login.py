@@ -1,7 +1,11 @@
+import asyncio
 from unittest.mock import patch
 
 from src.config import APP_CONFIG
-from src.services import LinkedInLogin
+from src.database import request_scope
+from src.executor import offload
+from src.services import LinkedInLogin, UserRequestService, auth_cache
+from tests.fixtures import create_user, create_user_request
 
 linkedin_login = LinkedInLogin(
     config={
@@ -45,3 +49,54 @@ def test_authenticate():
         create_kwargs = user_mock.call_args[1]
         assert create_kwargs["is_buy"]
         assert create_kwargs["auth_token"] == "some_access_token"
+
+
+def test_get_user_by_token_async():
+    auth_cache.clear()
+    user = create_user(auth_token="some_token", can_buy=False, can_sell=False)
+    buy_request = create_user_request(user_id=user["id"], is_buy=True)
+    committee = create_user("1", is_committee=True)
+
+    get_linkedin_user = linkedin_login.get_linkedin_user
+    with patch.object(
+        linkedin_login, "get_linkedin_user", side_effect=get_linkedin_user
+    ) as get_linkedin_user_mock:
+        cached_user = asyncio.run(linkedin_login.get_user_by_token_async("some_token"))
+        assert cached_user["can_buy"] == "UNAPPROVED"
+        assert (
+            asyncio.run(linkedin_login.get_user_by_token_async("some_token"))
+            == cached_user
+        )
+        assert get_linkedin_user_mock.call_count == 1
+
+        with patch("src.services.EmailService.send_email"):
+            UserRequestService(APP_CONFIG).approve_request(
+                request_id=buy_request["id"], subject_id=committee["id"]
+            )
+        approved_user = asyncio.run(
+            linkedin_login.get_user_by_token_async("some_token")
+        )
+        assert approved_user["can_buy"] == "YES"
+        assert get_linkedin_user_mock.call_count == 2
+
+
+def test_approve_request__invalidates_cache_after_commit():
+    auth_cache.clear()
+    user = create_user(auth_token="some_token", can_buy=False, can_sell=False)
+    buy_request = create_user_request(user_id=user["id"], is_buy=True)
+    committee = create_user("1", is_committee=True)
+
+    async def approve():
+        async with request_scope():
+            with patch("src.services.EmailService.send_email"):
+                await offload(
+                    UserRequestService(APP_CONFIG).approve_request,
+                    request_id=buy_request["id"],
+                    subject_id=committee["id"],
+                )
+            # A concurrent request caching the user before the approval is committed
+            auth_cache.set("some_token", user)
+            assert auth_cache.get("some_token") == user
+
+    asyncio.run(approve())
+    assert auth_cache.get("some_token") is None
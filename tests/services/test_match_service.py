@@ -1,12 +1,33 @@
+import time
+from datetime import datetime, timedelta, timezone
+from random import Random
 from unittest.mock import call, patch
 
+import pytest
+import requests
+from sqlalchemy import func
+
 from src.config import APP_CONFIG
-from src.database import Match, Round, UserChatRoomAssociation, session_scope
+from src.database import (
+    ChatRoom,
+    EmailBatch,
+    Match,
+    MatchJob,
+    Round,
+    SellOrder,
+    UserChatRoomAssociation,
+    session_scope,
+)
+from src.exceptions import InvisibleUnauthorizedException, ResourceNotFoundException
+from src.match import MatchingGap
 from src.services import MatchService
 from tests.fixtures import (
     create_banned_pair,
     create_buy_order,
+    create_email_batch,
+    create_match_job,
     create_round,
+    create_security,
     create_sell_order,
     create_user,
 )
@@ -46,16 +67,17 @@ def test_run_matches():
                     [buy_user2["email"], sell_user2["email"]],
                     template="match_done_no_match",
                 ),
-            ]
+            ],
+            any_order=True,
         )
 
-        assert set(u["user_id"] for u in mock_match.call_args[0][0]) == set(
+        assert set(u.user_id for u in mock_match.call_args[0][0]) == set(
             [buy_user["id"], buy_user2["id"]]
         )
-        assert set(u["user_id"] for u in mock_match.call_args[0][1]) == set(
+        assert set(u.user_id for u in mock_match.call_args[0][1]) == set(
             [sell_user["id"], sell_user2["id"]]
         )
-        assert mock_match.call_args[0][2] == []
+        assert set(mock_match.call_args[0][2]) == set()
 
     with session_scope() as session:
         match = session.query(Match).one()
@@ -76,6 +98,49 @@ def test_run_matches():
         assert session.query(Round).get(round["id"]).is_concluded
 
 
+def test_run_matches__inserts_in_chunks():
+    round = create_round()
+
+    match_results = []
+    for i in range(3):
+        buy_order = create_buy_order(
+            str(i), round_id=round["id"], user_id=create_user(str(i))["id"]
+        )
+        sell_order = create_sell_order(
+            str(i + 3), round_id=round["id"], user_id=create_user(str(i + 3))["id"]
+        )
+        match_results.append((buy_order["id"], sell_order["id"]))
+
+    with patch(
+        "src.services.match_buyers_and_sellers", return_value=match_results
+    ), patch("src.services.RoundService.get_active", return_value=round), patch(
+        "src.services.EmailService.send_email"
+    ), patch(
+        "src.services.BULK_INSERT_CHUNK_SIZE", 2
+    ):
+        match_service.run_matches()
+
+    with session_scope() as session:
+        matches = session.query(Match).all()
+        assert set((m.buy_order_id, m.sell_order_id) for m in matches) == set(
+            match_results
+        )
+
+        chat_rooms = session.query(ChatRoom).all()
+        assert set(c.match_id for c in chat_rooms) == set(str(m.id) for m in matches)
+        assert all(c.friendly_name for c in chat_rooms)
+
+        for chat_room in chat_rooms:
+            assert set(
+                a.role
+                for a in session.query(UserChatRoomAssociation).filter_by(
+                    chat_room_id=str(chat_room.id)
+                )
+            ) == {"BUYER", "SELLER"}
+
+        assert session.query(Round).get(round["id"]).is_concluded
+
+
 def test_run_matches__cannot_buy_or_sell():
     round = create_round()
 
@@ -94,13 +159,13 @@ def test_run_matches__cannot_buy_or_sell():
     ), patch("src.services.EmailService.send_email"):
         match_service.run_matches()
 
-        assert set(u["user_id"] for u in mock_match.call_args[0][0]) == set(
+        assert set(u.user_id for u in mock_match.call_args[0][0]) == set(
             [buy_user["id"]]
         )
-        assert set(u["user_id"] for u in mock_match.call_args[0][1]) == set(
+        assert set(u.user_id for u in mock_match.call_args[0][1]) == set(
             [sell_user["id"]]
         )
-        assert mock_match.call_args[0][2] == []
+        assert set(mock_match.call_args[0][2]) == set()
 
 
 def test_run_matches__banned_pairs():
@@ -126,13 +191,37 @@ def test_run_matches__banned_pairs():
     ), patch("src.services.EmailService.send_email"):
         match_service.run_matches()
 
-        assert set(u["user_id"] for u in mock_match.call_args[0][0]) == set(
+        assert set(u.user_id for u in mock_match.call_args[0][0]) == set(
             [buy_user_id, buy_user2["id"]]
         )
-        assert set(u["user_id"] for u in mock_match.call_args[0][1]) == set(
+        assert set(u.user_id for u in mock_match.call_args[0][1]) == set(
             [sell_user_id, sell_user2["id"]]
         )
-        assert mock_match.call_args[0][2] == [(buy_user_id, sell_user_id)]
+        assert set(mock_match.call_args[0][2]) == {(buy_user_id, sell_user_id)}
+
+
+def test_run_matches__banned_pairs_outside_round():
+    other_round = create_round("2")
+    round = create_round()
+
+    buy_user = create_user("1")
+    sell_user = create_user("2")
+    other_user = create_user("3")
+
+    create_buy_order("1", round_id=round["id"], user_id=buy_user["id"])
+    create_sell_order("2", round_id=round["id"], user_id=sell_user["id"])
+    create_sell_order("3", round_id=other_round["id"], user_id=other_user["id"])
+
+    create_banned_pair(buyer_id=buy_user["id"], seller_id=sell_user["id"])
+    create_banned_pair(buyer_id=buy_user["id"], seller_id=other_user["id"])
+    create_banned_pair(buyer_id=sell_user["id"], seller_id=buy_user["id"])
+
+    with patch("src.services.match_buyers_and_sellers") as mock_match, patch(
+        "src.services.RoundService.get_active", return_value=round
+    ), patch("src.services.EmailService.send_email"):
+        match_service.run_matches()
+
+        assert set(mock_match.call_args[0][2]) == {(buy_user["id"], sell_user["id"])}
 
 
 def test_run_matches__double_sell_orders():
@@ -155,18 +244,443 @@ def test_run_matches__double_sell_orders():
         match_service.run_matches()
 
         assert (
-            len([o for o in mock_match.call_args[0][1] if o["id"] == sell_order1["id"]])
+            len([o for o in mock_match.call_args[0][1] if o.id == sell_order1["id"]])
             == 2
         )
         assert (
-            len(
-                [o for o in mock_match.call_args[0][1] if o["id"] == sell_order21["id"]]
-            )
+            len([o for o in mock_match.call_args[0][1] if o.id == sell_order21["id"]])
             == 1
         )
         assert (
-            len(
-                [o for o in mock_match.call_args[0][1] if o["id"] == sell_order22["id"]]
-            )
+            len([o for o in mock_match.call_args[0][1] if o.id == sell_order22["id"]])
             == 1
         )
+
+
+def test_run_matches__concluded_round():
+    round = create_round(is_concluded=True)
+
+    with patch("src.services.match_buyers_and_sellers") as mock_match:
+        match_service.run_matches(round_id=round["id"])
+
+    mock_match.assert_not_called()
+
+
+def test_run_matches__approximate():
+    round = create_round()
+    security = create_security()
+    buy_order = create_buy_order("1", round_id=round["id"], security_id=security["id"])
+    sell_order = create_sell_order(
+        "2", round_id=round["id"], security_id=security["id"]
+    )
+
+    approximate_match_service = MatchService(
+        config={**APP_CONFIG, "ACQUITY_MATCHING_APPROXIMATE_MIN_PAIRS": 0}
+    )
+    with patch("src.services.match_buyers_and_sellers") as mock_match, patch(
+        "src.services.match_buyers_and_sellers_within_budget",
+        return_value=({(buy_order["id"], sell_order["id"])}, MatchingGap(1, 1, 0, 0)),
+    ) as mock_match_within_budget, patch("src.services.EmailService.send_email"):
+        approximate_match_service.run_matches(round_id=round["id"])
+
+    mock_match.assert_not_called()
+    assert (
+        mock_match_within_budget.call_args[1]["time_budget"]
+        == APP_CONFIG["ACQUITY_MATCHING_TIME_BUDGET"]
+    )
+    with session_scope() as session:
+        assert session.query(Match).one().buy_order_id == buy_order["id"]
+
+
+def test_run_matches__twice():
+    round = create_round()
+    buy_order = create_buy_order("1", round_id=round["id"])
+    sell_order = create_sell_order("2", round_id=round["id"])
+
+    with patch(
+        "src.services.match_buyers_and_sellers",
+        return_value=[(buy_order["id"], sell_order["id"])],
+    ), patch("src.services.EmailService.send_email") as mock_email:
+        match_service.run_matches(round_id=round["id"])
+        email_count = mock_email.call_count
+        match_service.run_matches(round_id=round["id"])
+
+    assert mock_email.call_count == email_count
+    with session_scope() as session:
+        assert session.query(Match).count() == 1
+
+
+def test_run_matches__concluded_while_matching():
+    round = create_round()
+    buy_order = create_buy_order("1", round_id=round["id"])
+    sell_order = create_sell_order("2", round_id=round["id"])
+
+    get_matching_params = match_service._get_matching_params
+
+    def conclude_and_get_matching_params(round_id):
+        with session_scope() as session:
+            session.query(Round).get(round_id).is_concluded = True
+        return get_matching_params(round_id)
+
+    with patch.object(
+        match_service,
+        "_get_matching_params",
+        side_effect=conclude_and_get_matching_params,
+    ), patch(
+        "src.services.match_buyers_and_sellers",
+        return_value=[(buy_order["id"], sell_order["id"])],
+    ), patch(
+        "src.services.EmailService.send_email"
+    ) as mock_email:
+        match_service.run_matches(round_id=round["id"])
+
+    mock_email.assert_not_called()
+    with session_scope() as session:
+        assert session.query(Match).count() == 0
+
+
+def test_run_matches__email_batches():
+    round = create_round()
+    users = [create_user(str(i)) for i in range(5)]
+    for i, user in enumerate(users):
+        create_buy_order(i, round_id=round["id"], user_id=user["id"])
+
+    match_service = MatchService(
+        config={**APP_CONFIG, "MAILGUN_MAX_RECIPIENTS_PER_BATCH": 2}
+    )
+    with patch("src.services.match_buyers_and_sellers", return_value=[]), patch(
+        "src.services.EmailService.send_email"
+    ) as mock_email:
+        match_service.run_matches(round_id=round["id"])
+
+    assert sorted(len(c[0][0]) for c in mock_email.call_args_list) == [1, 2, 2]
+    assert sorted(
+        email for c in mock_email.call_args_list for email in c[0][0]
+    ) == sorted(user["email"] for user in users)
+    with session_scope() as session:
+        assert {b.status for b in session.query(EmailBatch)} == {"SENT"}
+
+
+def test_send_pending_emails():
+    round = create_round()
+    create_email_batch(round_id=round["id"], recipients=["a@a"], status="SENT")
+    create_email_batch(round_id=round["id"], recipients=["b@b"])
+
+    with patch("src.services.EmailService.send_email") as mock_email:
+        match_service.send_pending_emails()
+        match_service.send_pending_emails()
+
+    mock_email.assert_called_once_with(["b@b"], template="match_done_no_match")
+
+
+def retry_email_batch_now(batch_id):
+    with session_scope() as session:
+        session.query(EmailBatch).get(batch_id).next_attempt_at = func.now()
+
+
+def test_send_pending_emails__failed():
+    batch = create_email_batch(attempts=APP_CONFIG["MAILGUN_MAX_ATTEMPTS"] - 2)
+
+    with patch(
+        "src.services.EmailService.send_email",
+        side_effect=requests.ConnectionError("oops"),
+    ) as mock_email:
+        match_service.send_pending_emails()
+        with session_scope() as session:
+            assert session.query(EmailBatch).get(batch["id"]).status == "PENDING"
+
+        # Not retried before its backoff has passed
+        match_service.send_pending_emails()
+        assert mock_email.call_count == 1
+
+        retry_email_batch_now(batch["id"])
+        match_service.send_pending_emails()
+        retry_email_batch_now(batch["id"])
+        match_service.send_pending_emails()
+
+    assert mock_email.call_count == 2
+    with session_scope() as session:
+        failed_batch = session.query(EmailBatch).get(batch["id"])
+        assert failed_batch.status == "FAILED"
+        assert "oops" in failed_batch.error
+
+
+def test_send_pending_emails__unexpected_error():
+    batch = create_email_batch()
+
+    with patch("src.services.EmailService.send_email", side_effect=KeyError("oops")):
+        match_service.send_pending_emails()
+
+    with session_scope() as session:
+        failed_batch = session.query(EmailBatch).get(batch["id"])
+        assert failed_batch.status == "PENDING"
+        assert failed_batch.attempts == 1
+        assert "oops" in failed_batch.error
+        assert failed_batch.next_attempt_at > datetime.now(timezone.utc)
+
+
+def test_run_next_job():
+    job = create_match_job()
+    committee_user = create_user("0", is_committee=True)
+    stages = []
+
+    with patch("src.services.match_buyers_and_sellers", return_value=[]), patch.object(
+        match_service,
+        "_send_emails",
+        side_effect=lambda *args: stages.append(
+            match_service.get_job(
+                round_id=job["round_id"], subject_id=committee_user["id"]
+            )["stage"]
+        ),
+    ):
+        assert match_service.run_next_job()
+        assert not match_service.run_next_job()
+
+    assert stages == ["SENDING_EMAILS"]
+    done_job = match_service.get_job(
+        round_id=job["round_id"], subject_id=committee_user["id"]
+    )
+    assert done_job["status"] == "DONE"
+    assert done_job["attempts"] == 1
+    with session_scope() as session:
+        assert session.query(Round).get(job["round_id"]).is_concluded
+
+
+def test_run_next_job__not_due():
+    job = create_match_job(run_at=datetime.now() + timedelta(days=1))
+
+    with patch("src.services.match_buyers_and_sellers") as mock_match:
+        assert not match_service.run_next_job()
+
+    mock_match.assert_not_called()
+    with session_scope() as session:
+        assert session.query(MatchJob).get(job["id"]).status == "PENDING"
+
+
+def test_run_next_job__failed():
+    job = create_match_job()
+
+    with patch(
+        "src.services.match_buyers_and_sellers", side_effect=ValueError("oops")
+    ), pytest.raises(ValueError):
+        match_service.run_next_job()
+
+    with session_scope() as session:
+        failed_job = session.query(MatchJob).get(job["id"])
+        assert failed_job.status == "FAILED"
+        assert failed_job.stage == "MATCHING"
+        assert "oops" in failed_job.error
+    assert not match_service.run_next_job()
+
+
+def test_run_next_job__running():
+    job = create_match_job(status="RUNNING", attempts=1, heartbeat_at=datetime.now())
+
+    with patch("src.services.match_buyers_and_sellers") as mock_match:
+        assert not match_service.run_next_job()
+
+    mock_match.assert_not_called()
+    with session_scope() as session:
+        assert session.query(MatchJob).get(job["id"]).attempts == 1
+
+
+def test_run_next_job__lease_expired():
+    job = create_match_job(
+        status="RUNNING",
+        stage="MATCHING",
+        attempts=1,
+        heartbeat_at=datetime.now() - timedelta(days=1),
+    )
+
+    with patch("src.services.match_buyers_and_sellers", return_value=[]):
+        assert match_service.run_next_job()
+
+    with session_scope() as session:
+        done_job = session.query(MatchJob).get(job["id"])
+        assert done_job.status == "DONE"
+        assert done_job.attempts == 2
+        assert session.query(Round).get(job["round_id"]).is_concluded
+
+
+def test_run_next_job__no_heartbeat():
+    job = create_match_job(status="RUNNING", attempts=1, heartbeat_at=None)
+
+    with patch("src.services.match_buyers_and_sellers", return_value=[]):
+        assert match_service.run_next_job()
+
+    with session_scope() as session:
+        done_job = session.query(MatchJob).get(job["id"])
+        assert done_job.status == "DONE"
+        assert done_job.attempts == 2
+
+
+def test_run_next_job__lease_expired_too_often():
+    job = create_match_job(
+        status="RUNNING",
+        attempts=APP_CONFIG["ACQUITY_MATCHING_JOB_MAX_ATTEMPTS"],
+        heartbeat_at=datetime.now() - timedelta(days=1),
+    )
+
+    with patch("src.services.match_buyers_and_sellers") as mock_match:
+        assert match_service.run_next_job()
+        assert not match_service.run_next_job()
+
+    mock_match.assert_not_called()
+    with session_scope() as session:
+        failed_job = session.query(MatchJob).get(job["id"])
+        assert failed_job.status == "FAILED"
+        assert not session.query(Round).get(job["round_id"]).is_concluded
+
+
+def test_run_next_job__heartbeat():
+    job = create_match_job()
+    short_lease_service = MatchService(
+        config={**APP_CONFIG, "ACQUITY_MATCHING_JOB_LEASE": 0.3}
+    )
+
+    def get_heartbeat_at():
+        with session_scope() as session:
+            return session.query(MatchJob).get(job["id"]).heartbeat_at
+
+    heartbeats = []
+
+    def match(*args, **kwargs):
+        heartbeats.append(get_heartbeat_at())
+        time.sleep(0.5)
+        heartbeats.append(get_heartbeat_at())
+        return []
+
+    with patch("src.services.match_buyers_and_sellers", side_effect=match):
+        assert short_lease_service.run_next_job()
+
+    assert heartbeats[1] > heartbeats[0]
+
+
+def test_get_job():
+    job = create_match_job(status="FAILED", error="ValueError('secret')")
+    committee_user = create_user("0", is_committee=True)
+
+    failed_job = match_service.get_job(
+        round_id=job["round_id"], subject_id=committee_user["id"]
+    )
+    assert failed_job["status"] == "FAILED"
+    assert "error" not in failed_job
+
+
+def test_get_job__not_found():
+    round = create_round()
+    committee_user = create_user("0", is_committee=True)
+
+    with pytest.raises(ResourceNotFoundException):
+        match_service.get_job(round_id=round["id"], subject_id=committee_user["id"])
+
+
+def test_get_job__unauthorized():
+    job = create_match_job()
+    user = create_user("0", is_committee=False)
+
+    with pytest.raises(InvisibleUnauthorizedException):
+        match_service.get_job(round_id=job["round_id"], subject_id=user["id"])
+
+
+def test_preview_matches():
+    round = create_round()
+    committee_user = create_user("0", is_committee=True)
+    buy_order = create_buy_order("1", round_id=round["id"])
+    sell_order = create_sell_order("2", round_id=round["id"])
+    sell_order2 = create_sell_order("3", round_id=round["id"])
+
+    match_service = MatchService(config=APP_CONFIG)
+    with patch(
+        "src.services.match_buyers_and_sellers",
+        return_value=[(buy_order["id"], sell_order["id"])],
+    ) as mock_match, patch("src.services.EmailService.send_email") as mock_email:
+        preview = match_service.preview_matches(subject_id=committee_user["id"])
+        assert match_service.preview_matches(subject_id=committee_user["id"]) == preview
+        assert mock_match.call_count == 1
+
+        with session_scope() as session:
+            session.query(SellOrder).get(sell_order2["id"]).price += 1
+        match_service.preview_matches(subject_id=committee_user["id"])
+        assert mock_match.call_count == 2
+
+    assert preview == {
+        "round_id": round["id"],
+        "matches": [
+            {"buy_order_id": buy_order["id"], "sell_order_id": sell_order["id"]}
+        ],
+        "unmatched_buy_order_ids": [],
+        "unmatched_sell_order_ids": [sell_order2["id"]],
+    }
+    mock_email.assert_not_called()
+    with session_scope() as session:
+        assert session.query(Match).count() == 0
+        assert not session.query(Round).get(round["id"]).is_concluded
+
+
+def test_preview_matches__approximate():
+    round = create_round()
+    committee_user = create_user("0", is_committee=True)
+    security = create_security()
+    create_buy_order("1", round_id=round["id"], security_id=security["id"])
+    create_sell_order("2", round_id=round["id"], security_id=security["id"])
+
+    match_service = MatchService(
+        config={**APP_CONFIG, "ACQUITY_MATCHING_APPROXIMATE_MIN_PAIRS": 0}
+    )
+    with patch(
+        "src.services.match_buyers_and_sellers_within_budget",
+        return_value=(set(), MatchingGap.total([])),
+    ) as mock_match_within_budget:
+        match_service.preview_matches(subject_id=committee_user["id"])
+
+    assert (
+        mock_match_within_budget.call_args[1]["time_budget"]
+        == APP_CONFIG["ACQUITY_MATCH_PREVIEW_TIME_BUDGET"]
+    )
+    assert mock_match_within_budget.call_args[1]["max_workers"] == 1
+
+
+def test_preview_matches__not_committee():
+    create_round()
+    user = create_user("0", is_committee=False)
+
+    with pytest.raises(InvisibleUnauthorizedException):
+        match_service.preview_matches(subject_id=user["id"])
+
+
+def test_preview_matches__same_as_run_matches():
+    round = create_round()
+    committee_user = create_user("0", is_committee=True)
+    security = create_security("0")
+    random = Random(0)
+    # Few distinct prices and sizes, so that many matchings are optimal
+    for i in range(1, 16):
+        create_buy_order(
+            str(i),
+            round_id=round["id"],
+            security_id=security["id"],
+            price=random.choice([10, 11, 12]),
+            number_of_shares=random.choice([100, 200]),
+        )
+        create_sell_order(
+            str(i + 100),
+            round_id=round["id"],
+            security_id=security["id"],
+            price=random.choice([9, 10, 11]),
+            number_of_shares=random.choice([100, 200]),
+        )
+
+    match_service = MatchService(config=APP_CONFIG)
+    with patch("src.services.EmailService.send_email"):
+        preview = match_service.preview_matches(subject_id=committee_user["id"])
+        match_service.run_matches(round_id=round["id"])
+
+    with session_scope() as session:
+        matches = sorted(
+            (m.buy_order_id, m.sell_order_id) for m in session.query(Match)
+        )
+    assert matches
+    assert [(m["buy_order_id"], m["sell_order_id"]) for m in preview["matches"]] == (
+        matches
+    )
@@ -0,0 +1,152 @@
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.engine.url import make_url
+
+from src.database import (
+    BuyOrder,
+    Chat,
+    Offer,
+    OfferResponse,
+    Round,
+    SellOrder,
+    User,
+    UserChatRoomAssociation,
+    UserRequest,
+    engine,
+    session_scope,
+)
+
+USER_ID = "00000000-0000-0000-0000-000000000001"
+ROUND_ID = "00000000-0000-0000-0000-000000000002"
+CHAT_ROOM_ID = "00000000-0000-0000-0000-000000000003"
+OFFER_ID = "00000000-0000-0000-0000-000000000004"
+
+# Maps each query to the indexes its plan may use
+HOT_QUERIES = {
+    "user_by_auth_token": (
+        select([User]).where(User.auth_token == "token"),
+        {"ix_users_auth_token"},
+    ),
+    "active_round": (
+        select([Round]).where(
+            (Round.end_time >= datetime.now()) & (Round.is_concluded == False)
+        ),
+        {"ix_rounds_active_end_time"},
+    ),
+    "chat_room_users": (
+        select([UserChatRoomAssociation]).where(
+            UserChatRoomAssociation.chat_room_id == CHAT_ROOM_ID
+        ),
+        {"ix_user_chat_room_association_chat_room_id"},
+    ),
+    "chat_room_chats": (
+        select([Chat])
+        .where(Chat.chat_room_id == CHAT_ROOM_ID)
+        .order_by(Chat.created_at),
+        {"ix_chats_chat_room_id_created_at"},
+    ),
+    "chat_room_offers": (
+        select([Offer])
+        .where(Offer.chat_room_id == CHAT_ROOM_ID)
+        .order_by(Offer.created_at),
+        # Both lead with chat_room_id; which one wins depends on table statistics
+        {"ix_offers_chat_room_id_created_at", "ix_offers_chat_room_id_offer_status"},
+    ),
+    "offer_responses_of_offer": (
+        select([OfferResponse]).where(OfferResponse.offer_id == OFFER_ID),
+        {"ix_offer_responses_offer_id"},
+    ),
+    "chat_room_pending_offers": (
+        select([Offer]).where(
+            (Offer.chat_room_id == CHAT_ROOM_ID) & (Offer.offer_status == "PENDING")
+        ),
+        {"ix_offers_chat_room_id_offer_status"},
+    ),
+    "open_user_requests": (
+        select([UserRequest]).where(UserRequest.closed_by_user_id == None),
+        {"ix_user_requests_open_user_id"},
+    ),
+    "open_user_requests_by_user": (
+        select([UserRequest]).where(
+            (UserRequest.user_id == USER_ID) & (UserRequest.closed_by_user_id == None)
+        ),
+        {"ix_user_requests_open_user_id"},
+    ),
+}
+for order_model in [SellOrder, BuyOrder]:
+    table_name = order_model.__tablename__
+    HOT_QUERIES[f"{table_name}_by_user_in_round"] = (
+        select([order_model]).where(
+            (order_model.user_id == USER_ID)
+            & ((order_model.round_id == ROUND_ID) | (order_model.round_id == None))
+        ),
+        {f"ix_{table_name}_user_id_round_id"},
+    )
+    HOT_QUERIES[f"{table_name}_in_round"] = (
+        select([order_model]).where(order_model.round_id == ROUND_ID),
+        {f"ix_{table_name}_round_id"},
+    )
+    HOT_QUERIES[f"{table_name}_unassigned"] = (
+        select([order_model]).where(order_model.round_id == None),
+        {f"ix_{table_name}_unassigned_user_id"},
+    )
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+MIGRATIONS_DATABASE = "acquity_test_migrations"
+INDEXES_QUERY = (
+    "SELECT indexname, indexdef FROM pg_indexes "
+    "WHERE schemaname = 'public' AND indexname LIKE 'ix\\_%%'"
+)
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES)
+def test_hot_query_uses_index(name):
+    query, expected_indexes = HOT_QUERIES[name]
+    compiled = query.compile(dialect=engine.dialect)
+    with session_scope() as session:
+        cursor = session.connection().connection.cursor()
+        # Sequential scans are then only planned for tables without a usable index
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("EXPLAIN " + str(compiled), compiled.params)
+        plan = "\n".join(row[0] for row in cursor.fetchall())
+
+    assert "Seq Scan" not in plan, plan
+    assert any(f" {index} " in plan for index in expected_indexes), plan
+
+
+def test_migrated_indexes_match_models():
+    admin_engine = create_engine(engine.url, isolation_level="AUTOCOMMIT")
+    admin_engine.execute(f"DROP DATABASE IF EXISTS {MIGRATIONS_DATABASE}")
+    admin_engine.execute(f"CREATE DATABASE {MIGRATIONS_DATABASE}")
+    migrations_url = make_url(str(engine.url))
+    migrations_url.database = MIGRATIONS_DATABASE
+    migrations_engine = create_engine(migrations_url)
+    try:
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "from alembic.config import main; main(argv=['upgrade', 'head'])",
+            ],
+            cwd=ROOT_DIR,
+            env={
+                **os.environ,
+                "PYTHONPATH": ROOT_DIR,
+                "DATABASE_URL": str(migrations_url),
+            },
+            check=True,
+        )
+        migrated_indexes = dict(migrations_engine.execute(INDEXES_QUERY).fetchall())
+    finally:
+        migrations_engine.dispose()
+        admin_engine.execute(f"DROP DATABASE IF EXISTS {MIGRATIONS_DATABASE}")
+        admin_engine.dispose()
+
+    model_indexes = dict(engine.execute(INDEXES_QUERY).fetchall())
+    assert model_indexes
+    assert migrated_indexes == model_indexes
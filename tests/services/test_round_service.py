@@ -1,3 +1,4 @@
+import asyncio
 from datetime import datetime, timedelta
 
 from src.config import APP_CONFIG
@@ -36,6 +37,21 @@ def test_get_active__all_concluded():
     assert round_service.get_active() is None
 
 
+def test_get_all_async():
+    create_round("1")
+    create_round("2")
+    rounds = asyncio.run(round_service.get_all_async())
+    assert sorted(rounds, key=lambda r: r["id"]) == sorted(
+        round_service.get_all(), key=lambda r: r["id"]
+    )
+
+
+def test_get_active_async():
+    create_round("1", end_time=datetime.now() + timedelta(weeks=1), is_concluded=False)
+    create_round("2", end_time=datetime.now() + timedelta(weeks=1), is_concluded=True)
+    assert asyncio.run(round_service.get_active_async()) == round_service.get_active()
+
+
 def test_should_round_start__unique_sellers():
     create_sell_order("1", number_of_shares=5, round_id=None)
     assert not round_service.should_round_start()
@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 
 from src.config import APP_CONFIG
@@ -19,6 +21,15 @@ def test_get_all():
     )
 
 
+def test_get_all_async():
+    create_security("1")
+    create_security("2")
+    securities = asyncio.run(security_service.get_all_async())
+    assert sorted(securities, key=lambda s: s["id"]) == sorted(
+        security_service.get_all(), key=lambda s: s["id"]
+    )
+
+
 def test_edit_market_price():
     security = create_security()
     committee = create_user(is_committee=True)
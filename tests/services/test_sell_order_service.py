@@ -1,10 +1,11 @@
+import asyncio
 from unittest.mock import MagicMock, patch
 
 import pytest
 from apscheduler.schedulers.base import BaseScheduler
 
 from src.config import APP_CONFIG
-from src.database import BuyOrder, Round, SellOrder, session_scope
+from src.database import BuyOrder, MatchJob, Round, SellOrder, session_scope
 from src.exceptions import ResourceNotOwnedException, UnauthorizedException
 from src.services import SellOrderService
 from tests.fixtures import (
@@ -46,6 +47,26 @@ def test_get_orders_by_user_in_current_round():
     )
 
 
+def test_get_orders_by_user_in_current_round_async():
+    user_id = create_user()["id"]
+    current_round = create_round()
+    create_sell_order("1", user_id=user_id, round_id=None)
+    create_sell_order("2", user_id=user_id, round_id=current_round["id"])
+    create_sell_order(
+        "3", user_id=user_id, round_id=create_round("3", is_concluded=True)["id"]
+    )
+
+    orders = asyncio.run(
+        sell_order_service.get_orders_by_user_in_current_round_async(user_id=user_id)
+    )
+    expected_orders = sell_order_service.get_orders_by_user_in_current_round(
+        user_id=user_id
+    )
+    assert sorted(orders, key=lambda o: o["id"]) == sorted(
+        expected_orders, key=lambda o: o["id"]
+    )
+
+
 def test_get_order_by_id():
     sell_order = create_sell_order()
 
@@ -156,7 +177,15 @@ def test_create_order__add_new_round():
     assert scheduler_args[0][1] == "date"
 
     with session_scope() as session:
-        assert scheduler_args[1]["run_date"] == session.query(Round).one().end_time
+        round = session.query(Round).one()
+        assert (
+            scheduler_args[1]["run_date"]
+            == round.end_time
+            - APP_CONFIG["ACQUITY_ROUND_CLOSING_REMINDER_BEFORE_END_TIME"]
+        )
+        match_job = session.query(MatchJob).one()
+        assert match_job.round_id == str(round.id)
+        assert match_job.run_at == round.end_time
 
         sell_order = session.query(SellOrder).get(sell_order_id).asdict()
         sell_order2 = session.query(SellOrder).get(sell_order_id2).asdict()
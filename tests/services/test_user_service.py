@@ -1,9 +1,13 @@
+import asyncio
 from unittest.mock import patch
 
+import pytest
+
 from src.config import APP_CONFIG
 from src.database import User, UserRequest, session_scope
+from src.exceptions import InvisibleUnauthorizedException
 from src.services import UserService
-from tests.fixtures import create_user
+from tests.fixtures import create_user, create_user_request
 from tests.utils import assert_dict_in
 
 user_service = UserService(config=APP_CONFIG)
@@ -106,3 +110,30 @@ def test_get_user_by_linkedin_id():
 
     user = user_service.get_user_by_linkedin_id(provider_user_id="abcdef")
     assert user_params == user
+
+
+def test_get_user_by_linkedin_id_async():
+    create_user("1", provider_user_id="abcdef", can_buy=False, can_sell=False)
+    user = create_user("2", can_buy=False)
+    create_user_request(user_id=user["id"], is_buy=True)
+
+    for provider_user_id in ["abcdef", user["provider_user_id"]]:
+        assert asyncio.run(
+            user_service.get_user_by_linkedin_id_async(
+                provider_user_id=provider_user_id
+            )
+        ) == user_service.get_user_by_linkedin_id(provider_user_id=provider_user_id)
+
+
+def test_get_executor_stats():
+    committee_id = create_user("1", is_committee=True)["id"]
+
+    stats = user_service.get_executor_stats(subject_id=committee_id)
+    assert "max_workers" in stats
+
+
+def test_get_executor_stats__unauthorized():
+    user_id = create_user("1", is_committee=False)["id"]
+
+    with pytest.raises(InvisibleUnauthorizedException):
+        user_service.get_executor_stats(subject_id=user_id)
@@ -0,0 +1,76 @@
+import pytest
+
+from benchmarks.generator import generate_round
+from benchmarks.match_benchmark import match_round, run_benchmarks, time_phases
+from src.match import match_buyers_and_sellers
+
+
+def test_generate_round():
+    buy_orders, sell_orders, banned_pairs = generate_round(
+        200, seed=1, ban_density=0.01
+    )
+
+    assert generate_round(200, seed=1, ban_density=0.01) == (
+        buy_orders,
+        sell_orders,
+        banned_pairs,
+    )
+    assert len(buy_orders) == 100
+    assert 100 <= len(sell_orders) <= 200
+    assert len(banned_pairs) > 0
+    assert all(o.price > 0 and o.number_of_shares >= 100 for o in buy_orders)
+
+
+@pytest.mark.parametrize(
+    "solver,mode,phases",
+    [
+        ("bipartite", "exact", {"build_cost_graph", "solve"}),
+        ("networkx", "exact", {"build_cost_graph", "solve"}),
+        (
+            "bipartite",
+            "nearest",
+            {"count_possible_matches", "build_nearest_cost_graph", "solve"},
+        ),
+        (None, "budgeted", {"build_nearest_cost_graph", "solve_within_budget"}),
+    ],
+)
+def test_time_phases(solver, mode, phases):
+    buy_orders, sell_orders, banned_pairs = generate_round(
+        200, seed=2, number_of_securities=1
+    )
+
+    matches, seconds = time_phases(buy_orders, sell_orders, banned_pairs, solver, mode)
+
+    assert matches == match_round(buy_orders, sell_orders, banned_pairs, solver, mode)
+    assert set(seconds) >= phases | {
+        "partition_by_security",
+        "distribute_remaining_buyers",
+        "total",
+    }
+    assert "build_cost_graph" not in seconds or mode == "exact"
+
+
+def test_match_round():
+    buy_orders, sell_orders, banned_pairs = generate_round(100, seed=2)
+
+    assert match_round(
+        buy_orders, sell_orders, banned_pairs, "bipartite", "exact"
+    ) == match_buyers_and_sellers(
+        buy_orders, sell_orders, banned_pairs, solver="bipartite"
+    )
+
+
+def test_run_benchmarks():
+    report = run_benchmarks(
+        sizes=[10, 20], solvers=["bipartite"], modes=["exact", "budgeted"], repeat=1
+    )
+
+    assert [
+        (r["number_of_orders"], r["mode"], r["solver"]) for r in report["results"]
+    ] == [
+        (10, "exact", "bipartite"),
+        (10, "budgeted", None),
+        (20, "exact", "bipartite"),
+        (20, "budgeted", None),
+    ]
+    assert all("seconds" in r for r in report["results"])
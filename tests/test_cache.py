@@ -0,0 +1,43 @@
+from unittest.mock import patch
+
+from src.cache import LRUCache
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+    assert cache.pop("a") == 1
+    assert cache.get("a", "default") == "default"
+
+
+def test_lru_cache__ttl():
+    cache = LRUCache(maxsize=2, ttl=10)
+
+    with patch("src.cache.monotonic", return_value=100):
+        cache.set("a", 1)
+    with patch("src.cache.monotonic", return_value=109):
+        assert cache.get("a") == 1
+    with patch("src.cache.monotonic", return_value=110):
+        assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_lru_cache__evict():
+    cache = LRUCache(maxsize=3)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("c", 3)
+
+    cache.evict(lambda value: value % 2 == 1)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.get("c") is None
@@ -0,0 +1,123 @@
+import asyncio
+from contextlib import asynccontextmanager
+from unittest.mock import patch
+
+import pytest
+
+from src.chat_service import ChatSocketService
+from src.config import APP_CONFIG
+from src.exceptions import InvalidAuthorizationTokenException
+
+
+def create_chat_socket_service():
+    chat_socket_service = ChatSocketService("/v1/chat", APP_CONFIG)
+    sessions = {}
+
+    async def get_session(sid):
+        return sessions.setdefault(sid, {})
+
+    async def save_session(sid, session):
+        sessions[sid] = session
+
+    chat_socket_service.get_session = get_session
+    chat_socket_service.save_session = save_session
+    return chat_socket_service
+
+
+async def get_user(token):
+    return {"id": f"user of {token}"}
+
+
+def test_authenticate__once_per_connection():
+    chat_socket_service = create_chat_socket_service()
+
+    async def run():
+        with patch(
+            "src.services.LinkedInLogin.get_user_by_token_async", side_effect=get_user
+        ) as mock_get_user:
+            assert await chat_socket_service.authenticate("sid", token="a") == {
+                "id": "user of a"
+            }
+            assert await chat_socket_service.authenticate("sid", token="a") == {
+                "id": "user of a"
+            }
+            assert await chat_socket_service.authenticate("sid") == {"id": "user of a"}
+            assert mock_get_user.call_count == 1
+
+            assert await chat_socket_service.authenticate("sid", token="b") == {
+                "id": "user of b"
+            }
+            assert mock_get_user.call_count == 2
+
+    asyncio.run(run())
+
+
+def test_authenticate__revalidates():
+    chat_socket_service = create_chat_socket_service()
+    interval = APP_CONFIG["ACQUITY_SOCKET_AUTH_REVALIDATE_INTERVAL"]
+
+    async def run():
+        with patch(
+            "src.services.LinkedInLogin.get_user_by_token_async", side_effect=get_user
+        ) as mock_get_user:
+            with patch("src.chat_service.monotonic", return_value=100):
+                await chat_socket_service.authenticate("sid", token="a")
+            with patch("src.chat_service.monotonic", return_value=100 + interval - 1):
+                await chat_socket_service.authenticate("sid")
+            assert mock_get_user.call_count == 1
+
+            with patch("src.chat_service.monotonic", return_value=100 + interval):
+                await chat_socket_service.authenticate("sid")
+            assert mock_get_user.call_count == 2
+
+    asyncio.run(run())
+
+
+def test_authenticate__no_token():
+    chat_socket_service = create_chat_socket_service()
+
+    with pytest.raises(InvalidAuthorizationTokenException):
+        asyncio.run(chat_socket_service.authenticate("sid"))
+
+
+def test_on_connect__authenticates_with_query_string_token():
+    chat_socket_service = create_chat_socket_service()
+
+    async def run():
+        with patch(
+            "src.services.LinkedInLogin.get_user_by_token_async", side_effect=get_user
+        ):
+            await chat_socket_service.on_connect("sid", {"QUERY_STRING": "token=a"})
+        return await chat_socket_service.authenticate("sid")
+
+    assert asyncio.run(run()) == {"id": "user of a"}
+
+
+def test_on_req_new_message__emits_after_commit():
+    chat_socket_service = create_chat_socket_service()
+    events = []
+
+    @asynccontextmanager
+    async def request_scope():
+        yield
+        events.append("commit")
+
+    async def emit(event, data, room):
+        events.append((event, data, room))
+
+    chat_socket_service.emit = emit
+
+    async def run():
+        with patch(
+            "src.services.LinkedInLogin.get_user_by_token_async", side_effect=get_user
+        ), patch("src.chat_service.request_scope", request_scope), patch.object(
+            chat_socket_service.chat_service,
+            "create_new_message",
+            return_value={"type": "chat"},
+        ):
+            await chat_socket_service.on_req_new_message(
+                "sid", {"token": "a", "chat_room_id": "room", "message": "hello"}
+            )
+
+    asyncio.run(run())
+    assert events == ["commit", ("res_new_event", {"type": "chat"}, "room")]
@@ -1,4 +1,21 @@
-from src.database import Base
+import asyncio
+import time
+from unittest.mock import patch
+
+import psycopg2
+import pytest
+from sqlalchemy import func, literal, select
+
+from src.database import (
+    Base,
+    RequestConnectionLimiter,
+    async_engine,
+    request_scope,
+    request_session,
+    session_scope,
+)
+from src.exceptions import ServiceUnavailableException
+from src.executor import offload
 from tests.utils import assert_dict_in
 
 
@@ -12,3 +29,74 @@ class DummyClass(Base):
 
 def test_asdict():
     assert_dict_in({"a": 2}, DummyClass().asdict())
+
+
+def test_async_engine__does_not_block_event_loop():
+    async def run():
+        start = time.monotonic()
+        rows = await asyncio.gather(
+            async_engine.execute(select([func.pg_sleep(0.5).label("a")])),
+            async_engine.execute(select([literal(1).label("b")])),
+            async_engine.execute(select([func.pg_sleep(0.5).label("a")])),
+        )
+        return rows, time.monotonic() - start
+
+    rows, duration = asyncio.run(run())
+    assert rows[1] == [{"b": 1}]
+    assert duration < 0.9
+
+
+def test_async_engine__discards_failed_connections():
+    async def run():
+        with pytest.raises(psycopg2.DataError):
+            await async_engine.execute(select([literal(1) / literal(0)]))
+        return await async_engine.execute_one_or_none(select([literal(1).label("a")]))
+
+    assert asyncio.run(run()) == {"a": 1}
+
+
+def test_request_scope__shares_session():
+    async def run():
+        async with request_scope() as session:
+            with session_scope() as session2, session_scope() as session3:
+                assert session2 is session
+                assert session3 is session
+            assert await offload(lambda: request_session.get()) is session
+
+    asyncio.run(run())
+    assert request_session.get() is None
+
+
+def test_request_scope__rolls_back_on_exception():
+    async def run():
+        async with request_scope():
+            with session_scope():
+                raise ValueError("oops")
+
+    with patch("src.database.Session") as mock_session, patch(
+        "src.database.engine"
+    ), pytest.raises(ValueError):
+        asyncio.run(run())
+
+    mock_session.return_value.rollback.assert_called_once()
+    mock_session.return_value.commit.assert_not_called()
+    mock_session.return_value.close.assert_called_once()
+
+
+def test_request_connection_limiter():
+    limiter = RequestConnectionLimiter(limit=1, timeout=0.1)
+
+    async def run():
+        async with limiter.acquire():
+            with pytest.raises(ServiceUnavailableException):
+                async with limiter.acquire():
+                    pass
+        async with limiter.acquire():
+            pass
+
+    asyncio.run(run())
+
+
+def test_request_connection_limiter__pool_too_small():
+    with pytest.raises(ValueError):
+        RequestConnectionLimiter(limit=0, timeout=1)
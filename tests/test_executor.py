@@ -0,0 +1,62 @@
+import asyncio
+import contextvars
+import threading
+import time
+
+from src.executor import ServiceExecutor
+
+request_id = contextvars.ContextVar("request_id")
+
+
+def test_service_executor__does_not_block_event_loop():
+    executor = ServiceExecutor(max_workers=2)
+
+    async def run():
+        start = time.monotonic()
+        results = await asyncio.gather(
+            executor.run(time.sleep, 0.3),
+            executor.run(time.sleep, 0.3),
+            asyncio.sleep(0.1, result="ticked"),
+        )
+        return results, time.monotonic() - start
+
+    results, duration = asyncio.run(run())
+    assert results == [None, None, "ticked"]
+    assert duration < 0.5
+
+
+def test_service_executor__copies_context():
+    executor = ServiceExecutor(max_workers=1)
+
+    async def run():
+        request_id.set("abc")
+        return await executor.run(request_id.get)
+
+    assert asyncio.run(run()) == "abc"
+
+
+def test_service_executor__stats():
+    executor = ServiceExecutor(max_workers=1)
+    released = threading.Event()
+
+    async def run():
+        calls = [
+            asyncio.ensure_future(executor.run(released.wait, 1)) for _ in range(3)
+        ]
+        await asyncio.sleep(0.1)
+        stats = executor.get_stats()
+        released.set()
+        await asyncio.gather(*calls)
+        return stats
+
+    stats = asyncio.run(run())
+    assert stats["max_workers"] == 1
+    assert stats["running"] == 1
+    assert stats["queued"] == 2
+
+    stats = executor.get_stats()
+    assert stats["running"] == 0
+    assert stats["queued"] == 0
+    assert stats["max_queued"] >= 2
+    assert stats["completed"] == 3
+    assert stats["average_wait_time"] > 0
@@ -1,6 +1,23 @@
+import random
+from unittest.mock import patch
+
 import pytest
 
-from src.match import match_buyers_and_sellers
+from src.match import (
+    SOLVERS,
+    BannedPairIndex,
+    MatchOrder,
+    build_cost_graph,
+    build_nearest_cost_graph,
+    count_candidate_pairs,
+    count_possible_matches,
+    distribute_remaining_buyers,
+    double_sell_orders,
+    match_buyers_and_sellers,
+    match_buyers_and_sellers_within_budget,
+    match_seller_with_nearest_buyer,
+    partition_by_security,
+)
 
 # fmt: off
 TRIVIAL_CASE = (
@@ -314,21 +331,461 @@ TEST_CASES = [
     NO_SELLERS_CASE,
     NO_BUYERS_CASE,
     POPULATED_MARKET_CASE,
-    NEAREST_PRICE_BRACKET_CASE,
     PRICE_MISMATCH_CASE,
     DUPLICATE_IDS_CASE,
     BANNED_PAIR_NO_RESULT_CASE,
     BANNED_PAIR_OTHER_PAIR_MATCH_RESULT_CASE,
 ]
 
+# Cases with several optimal first matchings, where the expected result follows the tie
+# break of the reference solver
+TIED_TEST_CASES = [
+    NEAREST_PRICE_BRACKET_CASE,
+]
+
 
+@pytest.mark.parametrize("solver", SOLVERS)
 @pytest.mark.parametrize(
     "buy_orders,sell_orders,banned_user_matches,match_result", TEST_CASES
 )
 def test_match_buyers_and_sellers(
+    solver, buy_orders, sell_orders, banned_user_matches, match_result
+):
+    assert (
+        match_buyers_and_sellers(
+            buy_orders, sell_orders, banned_user_matches, solver=solver
+        )
+        == match_result
+    )
+
+
+@pytest.mark.parametrize(
+    "buy_orders,sell_orders,banned_user_matches,match_result", TIED_TEST_CASES
+)
+def test_match_buyers_and_sellers__reference_solver_ties(
     buy_orders, sell_orders, banned_user_matches, match_result
 ):
     assert (
-        match_buyers_and_sellers(buy_orders, sell_orders, banned_user_matches)
+        match_buyers_and_sellers(
+            buy_orders, sell_orders, banned_user_matches, solver="networkx"
+        )
         == match_result
     )
+
+
+@pytest.mark.parametrize("solver", SOLVERS)
+@pytest.mark.parametrize(
+    "buy_orders,sell_orders,banned_user_matches,match_result",
+    TEST_CASES + TIED_TEST_CASES,
+)
+def test_match_seller_with_nearest_buyer__same_objective_as_reference(
+    solver, buy_orders, sell_orders, banned_user_matches, match_result
+):
+    max_number_of_shares = max(o["number_of_shares"] for o in buy_orders + sell_orders)
+    costs = {
+        (buy_order["id"], sell_order["id"]): abs(
+            buy_order["price"] - sell_order["price"]
+        )
+        * max_number_of_shares
+        * 2
+        + abs(buy_order["number_of_shares"] - sell_order["number_of_shares"])
+        for sell_order in sell_orders
+        for buy_order in buy_orders
+        if buy_order["price"] >= sell_order["price"]
+    }
+
+    def objective(solver):
+        matches = match_seller_with_nearest_buyer(
+            MatchOrder.from_orders(buy_orders),
+            MatchOrder.from_orders(sell_orders),
+            banned_user_matches,
+            max_number_of_shares,
+            solver=solver,
+        )
+        return len(matches), sum(costs[match] for match in matches)
+
+    assert objective(solver) == objective("networkx")
+
+
+@pytest.mark.parametrize(
+    "buy_orders,sell_orders,banned_user_matches,match_result", TEST_CASES
+)
+def test_match_buyers_and_sellers_within_budget(
+    buy_orders, sell_orders, banned_user_matches, match_result
+):
+    matches, gap = match_buyers_and_sellers_within_budget(
+        buy_orders, sell_orders, banned_user_matches, time_budget=10
+    )
+
+    assert matches == match_result
+    assert gap.is_exact
+
+
+def test_match_buyers_and_sellers_within_budget__expired_budget():
+    rng = random.Random(0)
+    buy_orders = [
+        MatchOrder(f"b{i}", str(rng.randrange(50)), "A", rng.randint(1, 50), 10 * i)
+        for i in range(200)
+    ]
+    sell_orders = [
+        MatchOrder(f"s{i}", str(rng.randrange(50)), "A", rng.randint(1, 50), 10 * i)
+        for i in range(200)
+    ]
+    banned_user_matches = {(str(i), str(i)) for i in range(50)}
+
+    matches, gap = match_buyers_and_sellers_within_budget(
+        buy_orders, sell_orders, banned_user_matches, time_budget=0
+    )
+    exact_matches = match_seller_with_nearest_buyer(
+        buy_orders, sell_orders, banned_user_matches, 1990, solver="bipartite"
+    )
+    exact_cost = sum(
+        abs(b.price - s.price) * 1990 * 2 + abs(b.number_of_shares - s.number_of_shares)
+        for b in buy_orders
+        for s in sell_orders
+        if (b.id, s.id) in exact_matches
+    )
+
+    assert len(matches) >= gap.number_of_matches > 0
+    assert gap.number_of_matches <= len(exact_matches) <= gap.max_number_of_matches
+    assert gap.min_cost <= exact_cost
+
+
+def test_build_cost_graph():
+    cost_graph = build_cost_graph(
+        MatchOrder.from_orders(
+            [
+                {"id": "b1", "user_id": "A", "number_of_shares": 20, "price": 6},
+                {"id": "b2", "user_id": "B", "number_of_shares": 10, "price": 4},
+            ]
+        ),
+        MatchOrder.from_orders(
+            [
+                {"id": "s1", "user_id": "C", "number_of_shares": 15, "price": 5},
+                {"id": "s2", "user_id": "D", "number_of_shares": 20, "price": 6},
+                {"id": "s2", "user_id": "D", "number_of_shares": 20, "price": 6},
+            ]
+        ),
+        [("A", "D")],
+        20,
+    )
+
+    assert cost_graph.buy_order_ids == ["b1", "b2"]
+    assert cost_graph.sell_order_ids == ["s1", "s2"]
+    assert list(cost_graph.rows) == [0]
+    assert list(cost_graph.cols) == [0]
+    assert list(cost_graph.costs) == [45]
+
+
+def test_build_cost_graph__blocks():
+    rng = random.Random(0)
+    buy_orders = [
+        MatchOrder(f"b{i}", str(rng.randrange(5)), "A", rng.randint(1, 20), 20)
+        for i in range(30)
+    ]
+    sell_orders = double_sell_orders(
+        [
+            MatchOrder(f"s{i}", str(rng.randrange(5)), "A", rng.randint(1, 20), 10)
+            for i in range(30)
+        ]
+    )
+    banned_user_matches = [("0", "1"), ("2", "2")]
+
+    cost_graph = build_cost_graph(buy_orders, sell_orders, banned_user_matches, 20)
+    with patch("src.match.COST_GRAPH_BLOCK_PAIRS", 40):
+        blocked_cost_graph = build_cost_graph(
+            buy_orders, sell_orders, banned_user_matches, 20
+        )
+
+    assert blocked_cost_graph.sell_order_ids == cost_graph.sell_order_ids
+    assert list(blocked_cost_graph.rows) == list(cost_graph.rows)
+    assert list(blocked_cost_graph.cols) == list(cost_graph.cols)
+    assert list(blocked_cost_graph.costs) == list(cost_graph.costs)
+
+
+def test_count_candidate_pairs():
+    assert (
+        count_candidate_pairs(
+            MULTIPLE_SECURITIES_BUY_ORDERS, MULTIPLE_SECURITIES_SELL_ORDERS
+        )
+        == 3
+    )
+
+
+def test_build_nearest_cost_graph():
+    cost_graph = build_nearest_cost_graph(
+        MatchOrder.from_orders(
+            [
+                {"id": "b1", "user_id": "A", "number_of_shares": 20, "price": 9},
+                {"id": "b2", "user_id": "B", "number_of_shares": 10, "price": 5},
+                {"id": "b3", "user_id": "A", "number_of_shares": 20, "price": 6},
+                {"id": "b4", "user_id": "C", "number_of_shares": 20, "price": 5},
+            ]
+        ),
+        MatchOrder.from_orders(
+            [
+                {"id": "s1", "user_id": "D", "number_of_shares": 20, "price": 5},
+                {"id": "s2", "user_id": "E", "number_of_shares": 20, "price": 6},
+                {"id": "s2", "user_id": "E", "number_of_shares": 20, "price": 6},
+            ]
+        ),
+        [("C", "D"), ("A", "E")],
+        20,
+        2,
+    )
+
+    assert cost_graph.buy_order_ids == ["b1", "b2", "b3", "b4"]
+    assert cost_graph.sell_order_ids == ["s1", "s2"]
+    assert list(cost_graph.rows) == [1, 2]
+    assert list(cost_graph.cols) == [0, 0]
+    assert list(cost_graph.costs) == [10, 40]
+
+
+def test_count_possible_matches():
+    buy_orders = MatchOrder.from_orders(
+        [
+            {"id": "b1", "user_id": "A", "number_of_shares": 20, "price": 9},
+            {"id": "b2", "user_id": "A", "number_of_shares": 20, "price": 7},
+            {"id": "b3", "user_id": "A", "number_of_shares": 20, "price": 3},
+        ]
+    )
+    sell_orders = MatchOrder.from_orders(
+        [
+            {"id": "s1", "user_id": "B", "number_of_shares": 20, "price": 8},
+            {"id": "s2", "user_id": "B", "number_of_shares": 20, "price": 8},
+            {"id": "s2", "user_id": "B", "number_of_shares": 20, "price": 8},
+            {"id": "s3", "user_id": "B", "number_of_shares": 20, "price": 1},
+        ]
+    )
+
+    assert count_possible_matches(buy_orders, sell_orders) == 2
+
+
+@pytest.mark.parametrize("candidates_per_sell_order", [1, 2])
+@pytest.mark.parametrize(
+    "buy_orders,sell_orders,banned_user_matches,match_result", TEST_CASES
+)
+def test_match_seller_with_nearest_buyer__nearest_candidates(
+    candidates_per_sell_order,
+    buy_orders,
+    sell_orders,
+    banned_user_matches,
+    match_result,
+):
+    buy_orders = MatchOrder.from_orders(buy_orders)
+    sell_orders = MatchOrder.from_orders(sell_orders)
+    max_number_of_shares = max(o.number_of_shares for o in buy_orders + sell_orders)
+
+    def match(candidates_per_sell_order):
+        return match_seller_with_nearest_buyer(
+            buy_orders,
+            sell_orders,
+            banned_user_matches,
+            max_number_of_shares,
+            solver="bipartite",
+            candidates_per_sell_order=candidates_per_sell_order,
+        )
+
+    assert len(match(candidates_per_sell_order)) == len(match(None))
+
+
+def test_match_seller_with_nearest_buyer__nearest_candidates_with_bans():
+    # Bans leave one possible match, while three are counted without them
+    buy_orders = MatchOrder.from_orders(
+        [
+            {"id": f"b{i}", "user_id": "A", "number_of_shares": 20, "price": 9}
+            for i in range(10)
+        ]
+        + [{"id": "b10", "user_id": "C", "number_of_shares": 20, "price": 9}]
+    )
+    sell_orders = MatchOrder.from_orders(
+        [
+            {"id": f"s{i}", "user_id": "B", "number_of_shares": 20, "price": 1}
+            for i in range(3)
+        ]
+    )
+
+    with patch("src.match.build_cost_graph") as mock_build_cost_graph:
+        matches = match_seller_with_nearest_buyer(
+            buy_orders,
+            sell_orders,
+            [("A", "B")],
+            20,
+            solver="bipartite",
+            candidates_per_sell_order=1,
+        )
+
+    mock_build_cost_graph.assert_not_called()
+    assert len(matches) == 1
+    assert next(iter(matches))[0] == "b10"
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_match_seller_with_nearest_buyer__nearest_candidates_random(seed):
+    rng = random.Random(seed)
+    buy_orders = [
+        MatchOrder(f"b{i}", str(rng.randrange(5)), "A", rng.randint(1, 20), 20)
+        for i in range(30)
+    ]
+    sell_orders = [
+        MatchOrder(f"s{i}", str(rng.randrange(5)), "A", rng.randint(1, 20), 20)
+        for i in range(30)
+    ]
+    banned_user_matches = {
+        (str(rng.randrange(5)), str(rng.randrange(5))) for _ in range(8)
+    }
+
+    def match(candidates_per_sell_order):
+        return match_seller_with_nearest_buyer(
+            buy_orders,
+            sell_orders,
+            banned_user_matches,
+            20,
+            solver="bipartite",
+            candidates_per_sell_order=candidates_per_sell_order,
+        )
+
+    assert len(match(2)) == len(match(None))
+
+
+# fmt: off
+MULTIPLE_SECURITIES_BUY_ORDERS = [
+    {"id": "b1", "user_id": "A", "security_id": "X", "number_of_shares": 20, "price": 5},
+    {"id": "b2", "user_id": "B", "security_id": "X", "number_of_shares": 20, "price": 9},
+    {"id": "b3", "user_id": "A", "security_id": "Y", "number_of_shares": 20, "price": 9},
+    {"id": "b4", "user_id": "B", "security_id": "Z", "number_of_shares": 20, "price": 9},
+]
+MULTIPLE_SECURITIES_SELL_ORDERS = [
+    {"id": "s1", "user_id": "C", "security_id": "X", "number_of_shares": 20, "price": 9},
+    {"id": "s2", "user_id": "D", "security_id": "Y", "number_of_shares": 20, "price": 5},
+    {"id": "s3", "user_id": "C", "security_id": "W", "number_of_shares": 20, "price": 5},
+]
+# fmt: on
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_match_buyers_and_sellers__multiple_securities(max_workers):
+    assert match_buyers_and_sellers(
+        MULTIPLE_SECURITIES_BUY_ORDERS,
+        MULTIPLE_SECURITIES_SELL_ORDERS,
+        [],
+        max_workers=max_workers,
+    ) == set([("b2", "s1"), ("b3", "s2")])
+
+
+def test_partition_by_security():
+    partitions = partition_by_security(
+        MatchOrder.from_orders(MULTIPLE_SECURITIES_BUY_ORDERS),
+        MatchOrder.from_orders(MULTIPLE_SECURITIES_SELL_ORDERS),
+    )
+
+    assert [
+        ([o.id for o in buy_orders], [o.id for o in sell_orders])
+        for buy_orders, sell_orders in partitions
+    ] == [(["b1", "b2"], ["s1"]), (["b3"], ["s2"])]
+
+
+def test_distribute_remaining_buyers():
+    # fmt: off
+    buy_orders = MatchOrder.from_orders([
+        {"id": "b1", "user_id": "A", "number_of_shares": 25, "price": 6},
+        {"id": "b2", "user_id": "B", "number_of_shares": 15, "price": 6},
+        {"id": "b3", "user_id": "C", "number_of_shares": 20, "price": 7},
+        {"id": "b4", "user_id": "D", "number_of_shares": 20, "price": 4},
+    ])
+    sell_orders = MatchOrder.from_orders([
+        {"id": "s1", "user_id": "X", "number_of_shares": 20, "price": 5},
+    ])
+    # fmt: on
+
+    assert distribute_remaining_buyers(buy_orders, sell_orders, [("C", "X")]) == set(
+        [
+            # Greatest allowed price, then tie on number of shares broken by order
+            ("b1", "s1"),
+            ("b2", "s1"),
+        ]
+    )
+    assert [o.id for o in buy_orders] == ["b3", "b4"]
+
+
+def test_banned_pair_index():
+    index = BannedPairIndex([("A", "X"), ("A", "Y"), ("B", "X"), ("A", "X")])
+
+    assert ("A", "Y") in index
+    assert ("Y", "A") not in index
+    assert ("C", "X") not in index
+    assert len(index) == 3
+    assert set(index) == {("A", "X"), ("A", "Y"), ("B", "X")}
+    assert BannedPairIndex.of(index) is index
+
+
+def test_banned_pair_index__mask():
+    index = BannedPairIndex([("A", "X"), ("B", "Z")])
+    buy_orders = MatchOrder.from_orders(
+        [
+            {"id": "b1", "user_id": "A", "number_of_shares": 1, "price": 1},
+            {"id": "b2", "user_id": "B", "number_of_shares": 1, "price": 1},
+            {"id": "b3", "user_id": "A", "number_of_shares": 1, "price": 1},
+        ]
+    )
+    sell_orders = MatchOrder.from_orders(
+        [
+            {"id": "s1", "user_id": "X", "number_of_shares": 1, "price": 1},
+            {"id": "s2", "user_id": "Y", "number_of_shares": 1, "price": 1},
+            {"id": "s3", "user_id": "X", "number_of_shares": 1, "price": 1},
+        ]
+    )
+
+    assert index.mask(buy_orders, sell_orders).tolist() == [
+        [True, False, True],
+        [False, False, False],
+        [True, False, True],
+    ]
+
+
+def test_double_sell_orders():
+    sell_orders = MatchOrder.from_orders(
+        [
+            {"id": "s1", "user_id": "X", "number_of_shares": 1, "price": 1},
+            {"id": "s2", "user_id": "Y", "number_of_shares": 1, "price": 1},
+            {"id": "s3", "user_id": "X", "number_of_shares": 1, "price": 1},
+        ]
+    )
+
+    assert [o.id for o in double_sell_orders(sell_orders)] == ["s1", "s2", "s2", "s3"]
+
+
+def test_match_buyers_and_sellers_within_budget__nearest_candidates():
+    rng = random.Random(0)
+    buy_orders = [
+        MatchOrder(f"b{i}", str(rng.randrange(50)), "A", rng.randint(1, 50), i)
+        for i in range(200)
+    ]
+    sell_orders = [
+        MatchOrder(f"s{i}", str(rng.randrange(50)), "A", rng.randint(1, 50), i)
+        for i in range(200)
+    ]
+    banned_user_matches = {(str(i), str(i)) for i in range(50)}
+
+    with patch("src.match.build_cost_graph") as mock_build_cost_graph:
+        matches, gap = match_buyers_and_sellers_within_budget(
+            buy_orders,
+            sell_orders,
+            banned_user_matches,
+            time_budget=10,
+            candidates_per_sell_order=4,
+        )
+    exact_matches = match_seller_with_nearest_buyer(
+        buy_orders, sell_orders, banned_user_matches, 50, solver="bipartite"
+    )
+    exact_cost = sum(
+        abs(b.price - s.price) * 50 * 2 + abs(b.number_of_shares - s.number_of_shares)
+        for b in buy_orders
+        for s in sell_orders
+        if (b.id, s.id) in exact_matches
+    )
+
+    mock_build_cost_graph.assert_not_called()
+    assert len(matches) >= gap.number_of_matches > 0
+    assert gap.number_of_matches <= len(exact_matches) <= gap.max_number_of_matches
+    assert gap.min_cost <= exact_cost